@@ -16,7 +16,9 @@
 
 from oslo.config import cfg
 
+from qonos.common import metrics
 from qonos.common import utils
+from qonos.db import purge
 from qonos.openstack.common.gettextutils import _
 import qonos.openstack.common.log as logging
 import qonos.openstack.common.wsgi as wsgi
@@ -35,6 +37,9 @@ api_opts = [
                     'generate log lines. The following values can be '
                     'formatted into it: client_ip, date_time, request_line, '
                     'status_code, body_length, wall_seconds.'),
+    cfg.IntOpt('metrics_log_interval', default=300,
+               help=_('Seconds between dumps of the counters, timers and '
+                      'gauges to the log, 0 to disable')),
 ]
 
 action_opts = [
@@ -55,20 +60,23 @@ class API(object):
         # This must be done after the 'well-known' config options are loaded
         # so the list of action_overrides can be read
         self.register_action_override_cfg_opts()
-        wsgi_logger = logging.getLogger('eventlet.wsgi.server')
 
         if CONF.api.daemonized:
             import daemon
             # NOTE(ameade): We need to preserve all open files for logging
             open_files = utils.get_qonos_open_file_log_handlers()
             with daemon.DaemonContext(files_preserve=open_files):
-                wsgi.run_server(self.app, CONF.api.port,
-                                log=logging.WritableLogger(wsgi_logger),
-                                log_format=CONF.api.wsgi_log_format)
+                self._serve()
         else:
-            wsgi.run_server(self.app, CONF.api.port,
-                            log=logging.WritableLogger(wsgi_logger),
-                            log_format=CONF.api.wsgi_log_format)
+            self._serve()
+
+    def _serve(self):
+        purge.start_periodic_purge()
+        metrics.start_periodic_log(CONF.api.metrics_log_interval)
+        wsgi_logger = logging.getLogger('eventlet.wsgi.server')
+        wsgi.run_server(self.app, CONF.api.port,
+                        log=logging.WritableLogger(wsgi_logger),
+                        log_format=CONF.api.wsgi_log_format)
 
     def register_action_override_cfg_opts(self):
         for action in CONF.api.action_overrides:
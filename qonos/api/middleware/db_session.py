@@ -0,0 +1,43 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import webob.dec
+
+import qonos.db
+from qonos.openstack.common import wsgi
+
+
+class DBSessionScope(wsgi.Middleware):
+    """Runs each request in a db request scope.
+
+    All the db calls made while handling a request share one session,
+    which is closed, or rolled back on error, when the request ends.
+    """
+
+    def __init__(self, application, db_api=None):
+        super(DBSessionScope, self).__init__(application)
+        self.db_api = db_api or qonos.db.get_api()
+
+    @webob.dec.wsgify(RequestClass=wsgi.Request)
+    def __call__(self, req):
+        with self.db_api.request_scope():
+            return req.get_response(self.application)
+
+    @classmethod
+    def factory(cls, global_conf, **local_conf):
+        def filter(app):
+            return cls(app)
+        return filter
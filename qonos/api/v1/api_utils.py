@@ -85,15 +85,7 @@ def deserialize_job_metadata(job):
 
 
 def schedule_to_next_run(schedule, start_time=None):
-    start_time = start_time or timeutils.utcnow()
-    minute = schedule.get('minute', '*')
-    hour = schedule.get('hour', '*')
-    day_of_month = schedule.get('day_of_month', '*')
-    month = schedule.get('month', '*')
-    day_of_week = schedule.get('day_of_week', '*')
-    return utils.cron_string_to_next_datetime(minute, hour, day_of_month,
-                                              month, day_of_week,
-                                              start_time)
+    return utils.schedule_to_next_run(schedule, start_time)
 
 
 def get_new_timeout_by_action(action):
@@ -104,3 +96,14 @@ def get_new_timeout_by_action(action):
         group = 'action_default'
     job_timeout_seconds = CONF.get(group).timeout_seconds
     return now + datetime.timedelta(seconds=job_timeout_seconds)
+
+
+def get_timeout_seconds_by_action():
+    """Return the job timeout of each overridden action, and of any other
+    action under 'default'."""
+    timeout_seconds = {'default': CONF.action_default.timeout_seconds}
+    for action in CONF.api.action_overrides:
+        group = 'action_' + action
+        if group in CONF:
+            timeout_seconds[action] = CONF.get(group).timeout_seconds
+    return timeout_seconds
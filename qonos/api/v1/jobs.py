@@ -22,6 +22,7 @@ from qonos.common import exception
 from qonos.common import timeutils
 from qonos.common import utils
 import qonos.db
+from qonos.db import db_utils
 from qonos.openstack.common.gettextutils import _
 from qonos.openstack.common import wsgi
 
@@ -39,6 +40,7 @@ class JobsController(object):
 
         try:
             params = utils.get_pagination_limit(params)
+            sort_keys, sort_dirs = db_utils.get_sort_params('jobs', params)[:2]
         except exception.Invalid as e:
             raise webob.exc.HTTPBadRequest(explanation=str(e))
 
@@ -60,7 +62,8 @@ class JobsController(object):
 
         limit = params.get('limit')
         if len(jobs) != 0 and len(jobs) == limit:
-            next_page = '/v1/jobs?marker=%s' % jobs[-1].get('id')
+            next_page = '/v1/jobs?cursor=%s' % db_utils.encode_cursor(
+                jobs[-1], sort_keys, sort_dirs)
         else:
             next_page = None
 
@@ -71,17 +74,28 @@ class JobsController(object):
         links = [{'rel': 'next', 'href': next_page}]
         return {'jobs': jobs, 'jobs_links': links}
 
+    def stats(self, request):
+        stats = self.db_api.job_stats(request.params.get('tenant'))
+
+        now = timeutils.utcnow()
+        for action_stats in stats['actions'].values():
+            oldest = action_stats['oldest_claimable']
+            if oldest is None:
+                action_stats['oldest_claimable_age'] = None
+            else:
+                age = now - oldest
+                action_stats['oldest_claimable_age'] = max(
+                    0, age.days * 86400 + age.seconds)
+
+        utils.serialize_datetimes(stats)
+        return {'stats': stats}
+
     def create(self, request, body):
         if (body is None or body.get('job') is None or
                 body['job'].get('schedule_id') is None):
             raise webob.exc.HTTPBadRequest()
         job = body['job']
 
-        try:
-            schedule = self.db_api.schedule_get_by_id(job['schedule_id'])
-        except exception.NotFound:
-            raise webob.exc.HTTPNotFound()
-
         # Check integrity of schedule and update next run
         expected_next_run = job.get('next_run')
         if expected_next_run:
@@ -92,45 +106,20 @@ class JobsController(object):
                 msg = _('Invalid "next_run" value. Must be ISO 8601 format')
                 raise webob.exc.HTTPBadRequest(explanation=msg)
 
-        next_run = api_utils.schedule_to_next_run(schedule, timeutils.utcnow())
-        next_run = next_run.replace(tzinfo=None)
+        job_values = dict((key, value) for key, value in job.iteritems()
+                          if key not in ('schedule_id', 'next_run'))
         try:
-            self.db_api.schedule_test_and_set_next_run(
-                schedule['id'], expected_next_run, next_run)
-
+            job = self.db_api.job_create_from_schedule(
+                job['schedule_id'], expected_next_run, job_values,
+                api_utils.get_timeout_seconds_by_action())
         except exception.NotFound:
+            raise webob.exc.HTTPNotFound()
+        except exception.Conflict:
             msg = _("Specified next run does not match the current next run"
                     " value. This could mean schedule has either changed"
                     "or has already been scheduled since you last expected.")
             raise webob.exc.HTTPConflict(explanation=msg)
 
-        # Update schedule last_scheduled
-        values = {}
-        values['last_scheduled'] = timeutils.utcnow()
-        self.db_api.schedule_update(schedule['id'], values)
-
-        # Create job
-        values = {}
-        values.update(job)
-        values['tenant'] = schedule['tenant']
-        values['action'] = schedule['action']
-        values['status'] = 'QUEUED'
-
-        job_metadata = []
-        for metadata in schedule['schedule_metadata']:
-            job_metadata.append({'key': metadata['key'],
-                                 'value': metadata['value']
-                                 })
-
-        values['job_metadata'] = job_metadata
-
-        job_action = values['action']
-        if 'timeout' not in values:
-            values['timeout'] = api_utils.get_new_timeout_by_action(job_action)
-            values['hard_timeout'] = \
-                api_utils.get_new_timeout_by_action(job_action)
-
-        job = self.db_api.job_create(values)
         utils.serialize_datetimes(job)
         api_utils.serialize_job_metadata(job)
         job = {'job': job}
@@ -78,6 +78,11 @@ class API(wsgi.Router):
                        action='create',
                        conditions=dict(method=['POST']))
 
+        mapper.connect('/jobs/stats',
+                       controller=jobs_resource,
+                       action='stats',
+                       conditions=dict(method=['GET']))
+
         mapper.connect('/jobs/{job_id}',
                        controller=jobs_resource,
                        action='get',
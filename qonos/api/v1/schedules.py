@@ -21,6 +21,7 @@ from qonos.common import exception
 from qonos.common import timeutils
 from qonos.common import utils
 import qonos.db
+from qonos.db import db_utils
 from qonos.openstack.common.gettextutils import _
 from qonos.openstack.common import wsgi
 
@@ -62,12 +63,16 @@ class SchedulesController(object):
         try:
             filter_args = utils.get_pagination_limit(filter_args)
             limit = filter_args['limit']
+            sort_keys, sort_dirs = db_utils.get_sort_params('schedules',
+                                                            filter_args)[:2]
         except exception.Invalid as e:
             raise webob.exc.HTTPBadRequest(explanation=str(e))
         try:
             schedules = self.db_api.schedule_get_all(filter_args=filter_args)
             if len(schedules) != 0 and len(schedules) == limit:
-                next_page = '/v1/schedules?marker=%s' % schedules[-1].get('id')
+                next_page = '/v1/schedules?cursor=%s' % \
+                    db_utils.encode_cursor(schedules[-1], sort_keys,
+                                           sort_dirs)
             else:
                 next_page = None
         except exception.NotFound:
@@ -177,6 +182,8 @@ class SchedulesController(object):
         except exception.NotFound:
             msg = _('Schedule %s could not be found.') % schedule_id
             raise webob.exc.HTTPNotFound(explanation=msg)
+        except exception.Invalid as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
 
         utils.serialize_datetimes(schedule)
         api_utils.serialize_schedule_metadata(schedule)
@@ -21,6 +21,7 @@ from qonos.api.v1 import api_utils
 from qonos.common import exception
 from qonos.common import utils
 import qonos.db
+from qonos.db import db_utils
 from qonos.openstack.common.gettextutils import _
 from qonos.openstack.common import wsgi
 
@@ -37,20 +38,32 @@ class WorkersController(object):
         params = {}
         params['limit'] = request.params.get('limit')
         params['marker'] = request.params.get('marker')
+        for key in ('cursor', 'sort_key', 'sort_dir'):
+            if request.params.get(key) is not None:
+                params[key] = request.params[key]
         return params
 
     def list(self, request):
         params = self._get_request_params(request)
         try:
             params = utils.get_pagination_limit(params)
+            sort_keys, sort_dirs = db_utils.get_sort_params('workers',
+                                                            params)[:2]
         except exception.Invalid as e:
             raise webob.exc.HTTPBadRequest(explanation=str(e))
         try:
             workers = self.db_api.worker_get_all(params=params)
         except exception.NotFound:
             raise webob.exc.HTTPNotFound()
+        limit = params.get('limit')
+        if len(workers) != 0 and len(workers) == limit:
+            next_page = '/v1/workers?cursor=%s' % db_utils.encode_cursor(
+                workers[-1], sort_keys, sort_dirs)
+        else:
+            next_page = None
         [utils.serialize_datetimes(worker) for worker in workers]
-        return {'workers': workers}
+        links = [{'rel': 'next', 'href': next_page}]
+        return {'workers': workers, 'workers_links': links}
 
     def create(self, request, body):
         worker = self.db_api.worker_create(body.get('worker'))
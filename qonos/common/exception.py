@@ -41,6 +41,10 @@ class Duplicate(QonosException):
     message = _('An object with the specified identifier already exists.')
 
 
+class Conflict(QonosException):
+    message = _('The object was changed since it was last read.')
+
+
 class MissingValue(QonosException):
     message = _('A required value was not provided')
 
@@ -49,6 +53,10 @@ class Invalid(QonosException):
     message = _('The input provided was invalid.')
 
 
+class InvalidSortKey(Invalid):
+    message = _('Sort key supplied was not valid.')
+
+
 class PollingException(QonosException):
     message = _('An error occured when polling.')
 
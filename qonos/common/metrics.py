@@ -0,0 +1,102 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process counters, timers and gauges.
+
+Values are kept per process and can be dumped to the log with log_stats(),
+which qonos-api also does every api.metrics_log_interval seconds.
+"""
+
+import copy
+import threading
+import time
+
+import eventlet
+
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+_LOCK = threading.Lock()
+_COUNTERS = {}
+_TIMERS = {}
+_GAUGES = {}
+
+
+def incr(name, value=1):
+    """Increment the counter called name by value."""
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def timing(name, seconds):
+    """Record a duration, in seconds, for the timer called name."""
+    with _LOCK:
+        timer = _TIMERS.setdefault(name, {'count': 0, 'total': 0.0,
+                                          'max': 0.0})
+        timer['count'] += 1
+        timer['total'] += seconds
+        timer['max'] = max(timer['max'], seconds)
+
+
+def gauge(name, value):
+    """Set the gauge called name to value."""
+    with _LOCK:
+        _GAUGES[name] = value
+
+
+def get_stats():
+    """Return a copy of all recorded counters, timers and gauges."""
+    with _LOCK:
+        return {'counters': copy.deepcopy(_COUNTERS),
+                'timers': copy.deepcopy(_TIMERS),
+                'gauges': copy.deepcopy(_GAUGES)}
+
+
+def reset():
+    with _LOCK:
+        _COUNTERS.clear()
+        _TIMERS.clear()
+        _GAUGES.clear()
+
+
+def log_stats(logger=LOG):
+    stats = get_stats()
+    for name, value in sorted(stats['counters'].iteritems()):
+        logger.info(_('[METRICS] counter %(name)s: %(value)s')
+                    % {'name': name, 'value': value})
+    for name, timer in sorted(stats['timers'].iteritems()):
+        logger.info(_('[METRICS] timer %(name)s: count=%(count)d '
+                      'total=%(total).6f max=%(max).6f')
+                    % dict(timer, name=name))
+    for name, value in sorted(stats['gauges'].iteritems()):
+        logger.info(_('[METRICS] gauge %(name)s: %(value)s')
+                    % {'name': name, 'value': value})
+
+
+def _log_periodically(interval):
+    while True:
+        time.sleep(interval)
+        log_stats()
+
+
+def start_periodic_log(interval):
+    """Log the stats every interval seconds in a greenthread, if interval
+    is positive."""
+    if interval > 0:
+        eventlet.spawn_n(_log_periodically, interval)
@@ -0,0 +1,130 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Small key/value stores for state that must survive between jobs.
+
+MemoryStateStore keeps values in the current process. FileStateStore keeps
+one JSON file per key in a directory and guards each file with an flock, so
+a store created before forking is shared by all child processes.
+"""
+
+import atexit
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from qonos.openstack.common import jsonutils
+
+
+class MemoryStateStore(object):
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def update(self, key, func, default=None):
+        """Atomically replace the value of key with func(old_value)."""
+        with self._lock:
+            value = func(self._data.get(key, default))
+            self._data[key] = value
+            return value
+
+
+class FileStateStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _key_path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key, default=None):
+        try:
+            with open(self._key_path(key), 'r') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return default
+
+        if not data:
+            return default
+        return jsonutils.loads(data)
+
+    def set(self, key, value):
+        self.update(key, lambda old: value)
+
+    def delete(self, key):
+        try:
+            os.unlink(self._key_path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def update(self, key, func, default=None):
+        """Atomically replace the value of key with func(old_value)."""
+        with open(self._key_path(key), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            data = f.read()
+            old = jsonutils.loads(data) if data else default
+            value = func(old)
+            f.seek(0)
+            f.truncate()
+            f.write(jsonutils.dumps(value))
+            f.flush()
+        return value
+
+
+def create_state_store(path=None, shared=False, prefix='qonos-state-'):
+    """Return a FileStateStore for path, or a MemoryStateStore.
+
+    When no path is given but the state must be shared between forked
+    children, a temporary directory is created and removed again when the
+    creating process exits.
+    """
+    if path is None and shared:
+        path = tempfile.mkdtemp(prefix=prefix)
+        atexit.register(shutil.rmtree, path, True)
+
+    if path is None:
+        return MemoryStateStore()
+    return FileStateStore(path)
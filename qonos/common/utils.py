@@ -40,6 +40,11 @@ def generate_notification(context, event_type, payload, level='INFO'):
     notifier_api.notify(context, publisher_id, event_type, level, payload)
 
 
+def flush_notifications():
+    """Wait for notifications queued by asynchronous drivers to be sent."""
+    notifier_api.flush()
+
+
 def serialize_datetimes(data):
     """Serializes datetimes to strings in the top level values of a dict."""
     for (k, v) in data.iteritems():
@@ -65,6 +70,17 @@ def cron_string_to_next_datetime(minute="*", hour="*", day_of_month="*",
     return iter.get_next(datetime.datetime)
 
 
+def schedule_to_next_run(schedule, start_time=None):
+    start_time = start_time or timeutils.utcnow()
+    minute = schedule.get('minute', '*')
+    hour = schedule.get('hour', '*')
+    day_of_month = schedule.get('day_of_month', '*')
+    month = schedule.get('month', '*')
+    day_of_week = schedule.get('day_of_week', '*')
+    return cron_string_to_next_datetime(minute, hour, day_of_month, month,
+                                        day_of_week, start_time)
+
+
 def _default_if_none(value, default):
     if value is None:
         return default
@@ -14,7 +14,65 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
+import datetime
+import json
+
 from qonos.common import exception
+from qonos.common import timeutils
+from qonos.common import utils
+from qonos.openstack.common.gettextutils import _
+
+
+# NOTE: Jobs that will not run again and can be purged once old enough.
+PURGEABLE_JOB_STATUSES = ['DONE', 'CANCELLED', 'MAX_RETRIED',
+                          'HARD_TIMED_OUT']
+
+# NOTE: Jobs a worker cannot claim, whatever their worker and timeout.
+UNCLAIMABLE_JOB_STATUSES = ['DONE', 'CANCELLED', 'HARD_TIMED_OUT',
+                            'MAX_RETRIED']
+
+# NOTE: The keys lists can be sorted by. Each one, followed by the id
+# tiebreaker, is indexed so a page is read as an index range however deep
+# into the list it is. The workers table is small enough not to need it.
+SORT_KEYS = {
+    'jobs': ['id', 'created_at', 'updated_at', 'hard_timeout'],
+    'schedules': ['id', 'next_run', 'created_at', 'updated_at'],
+    'workers': ['id', 'host', 'created_at', 'updated_at'],
+}
+SORT_DIRS = ['asc', 'desc']
+
+# NOTE: List parameters that are not filters.
+PAGINATION_PARAMS = ['limit', 'marker', 'cursor', 'sort_key', 'sort_dir']
+
+
+def job_stats(status_counts, claimable_counts):
+    """Build the job statistics returned by the DB-API job_stats.
+
+    status_counts holds (action, status, count) and claimable_counts
+    (action, count, oldest updated_at) tuples.
+    """
+    actions = {}
+
+    def _action(action):
+        return actions.setdefault(action, {'statuses': {}, 'total': 0,
+                                           'claimable': 0,
+                                           'oldest_claimable': None})
+
+    for action, status, count in status_counts:
+        stats = _action(action)
+        stats['statuses'][status] = count
+        stats['total'] += count
+
+    for action, count, oldest in claimable_counts:
+        stats = _action(action)
+        stats['claimable'] = count
+        stats['oldest_claimable'] = oldest
+
+    return {'actions': actions,
+            'total': sum(stats['total'] for stats in actions.values()),
+            'claimable': sum(stats['claimable']
+                             for stats in actions.values())}
 
 
 def validate_schedule_values(values):
@@ -27,6 +85,129 @@ def validate_job_values(values):
     _validate_values('Job', values, keys)
 
 
+def job_values_from_schedule(schedule, now, job_values=None,
+                             timeout_seconds=None):
+    """Build the values of the next job of a schedule.
+
+    :param schedule: the schedule, with its schedule_metadata
+    :param job_values: values given for the job, overridden by the
+                       schedule's tenant and action
+    :param timeout_seconds: job timeouts per action, with the one for other
+                            actions under 'default'. Used when job_values
+                            has no timeout.
+    """
+    values = dict(job_values or {})
+    values['schedule_id'] = schedule['id']
+    values['tenant'] = schedule['tenant']
+    values['action'] = schedule['action']
+    values['status'] = 'QUEUED'
+    values['job_metadata'] = [{'key': meta['key'], 'value': meta['value']}
+                              for meta in schedule['schedule_metadata']]
+
+    if 'timeout' not in values:
+        if not timeout_seconds:
+            raise exception.MissingValue(
+                '[Job] Values for timeout must be provided')
+        seconds = timeout_seconds.get(values['action'],
+                                      timeout_seconds.get('default'))
+        timeout = now + datetime.timedelta(seconds=seconds)
+        values['timeout'] = timeout
+        values['hard_timeout'] = timeout
+
+    return values
+
+
+def next_run_from_schedule(schedule, now):
+    return utils.schedule_to_next_run(schedule, now).replace(tzinfo=None)
+
+
+def _split_param(value):
+    if not value:
+        return []
+    return [item.strip() for item in value.split(',')]
+
+
+def get_sort_params(resource, params):
+    """Return the sort keys, sort directions and cursor values of a list.
+
+    sort_key and sort_dir are comma separated lists; a single direction
+    applies to every key. id is added as the last key, so the order is
+    total, in the direction of the key before it. A cursor carries the
+    sort of the list it was taken from and overrides both.
+
+    :param resource: 'jobs', 'schedules' or 'workers'
+    :param params: the list parameters
+    :returns: (sort_keys, sort_dirs, cursor_values), with cursor_values
+              None when there is no cursor
+    """
+    if params.get('cursor'):
+        sort_keys, sort_dirs, values = decode_cursor(params['cursor'])
+    else:
+        sort_keys = _split_param(params.get('sort_key'))
+        sort_dirs = _split_param(params.get('sort_dir')) or ['asc']
+        values = None
+        if 'id' not in sort_keys:
+            sort_keys.append('id')
+        if len(sort_dirs) == 1:
+            sort_dirs = sort_dirs * len(sort_keys)
+        elif len(sort_dirs) == len(sort_keys) - 1:
+            sort_dirs.append(sort_dirs[-1])
+
+    if len(sort_dirs) != len(sort_keys):
+        raise exception.Invalid(_('A sort_dir must be given for each '
+                                  'sort_key'))
+    for sort_key in sort_keys:
+        if sort_key not in SORT_KEYS[resource]:
+            raise exception.InvalidSortKey(
+                _('Cannot sort %(resource)s by %(key)s') %
+                {'resource': resource, 'key': sort_key})
+    for sort_dir in sort_dirs:
+        if sort_dir not in SORT_DIRS:
+            raise exception.Invalid(_('Invalid sort_dir %s') % sort_dir)
+
+    return sort_keys, sort_dirs, values
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        value = timeutils.normalize_time(value)
+        return {'datetime': timeutils.strtime(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return timeutils.parse_strtime(value['datetime'])
+    return value
+
+
+def encode_cursor(item, sort_keys, sort_dirs):
+    """Return an opaque token for the page following item.
+
+    The token holds item's sort key values, so the next page is found
+    without reading item again.
+    """
+    values = [_encode_value(item.get(key)) for key in sort_keys]
+    token = json.dumps([sort_keys, sort_dirs, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(token).rstrip('=')
+
+
+def decode_cursor(token):
+    """Return the sort keys, sort directions and values of a cursor."""
+    try:
+        token = str(token)
+        token = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        sort_keys, sort_dirs, values = json.loads(token)
+        if not len(sort_keys) == len(sort_dirs) == len(values):
+            raise ValueError()
+        sort_keys = [str(key) for key in sort_keys]
+        sort_dirs = [str(sort_dir) for sort_dir in sort_dirs]
+        values = [_decode_value(value) for value in values]
+    except Exception:
+        raise exception.Invalid(_('Invalid cursor'))
+    return sort_keys, sort_dirs, values
+
+
 def _validate_values(object_name, values, keys):
     missing_values = []
     for key in keys:
@@ -0,0 +1,117 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Batched purge of finished jobs, their metadata and job faults.
+
+Rows older than the retention window are deleted, or archived to the
+shadow tables, one small batch per transaction with a pause in between so
+the purge does not hold locks the API and workers are waiting for. It is
+run by `qonos-manage purge` and `qonos-manage archive`, and periodically
+by qonos-api when purge.interval is set.
+"""
+
+import datetime
+import time
+
+import eventlet
+from oslo.config import cfg
+
+from qonos.common import metrics
+from qonos.common import timeutils
+from qonos.common import utils
+import qonos.db
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+purge_opts = [
+    cfg.IntOpt('retention_days', default=30,
+               help=_('Age, in days, after which finished jobs and job '
+                      'faults are purged')),
+    cfg.IntOpt('batch_size', default=500,
+               help=_('Number of jobs or faults removed per transaction')),
+    cfg.FloatOpt('batch_sleep', default=0.1,
+                 help=_('Seconds to pause between batches')),
+    cfg.BoolOpt('archive', default=False,
+                help=_('Copy purged rows to the shadow tables')),
+    cfg.IntOpt('interval', default=0,
+               help=_('Seconds between purges run by qonos-api, 0 to '
+                      'disable. Enable it on one API node only')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(purge_opts, group='purge')
+
+
+def purge(db_api, retention_days=None, batch_size=None, batch_sleep=None,
+          archive=None):
+    """Remove the finished jobs and job faults older than retention_days.
+
+    Arguments left as None are taken from the [purge] configuration.
+    Returns the rows removed per table, the elapsed seconds and the
+    overall rate in rows per second.
+    """
+    conf = CONF.purge
+    if retention_days is None:
+        retention_days = conf.retention_days
+    if batch_size is None:
+        batch_size = conf.batch_size
+    if batch_sleep is None:
+        batch_sleep = conf.batch_sleep
+    if archive is None:
+        archive = conf.archive
+
+    older_than = timeutils.utcnow() - datetime.timedelta(days=retention_days)
+    counts = {'jobs': 0, 'job_metadata': 0, 'job_faults': 0}
+    start = time.time()
+
+    for purge_batch, table in ((db_api.job_purge_batch, 'jobs'),
+                               (db_api.job_fault_purge_batch, 'job_faults')):
+        while True:
+            batch = purge_batch(older_than, batch_size, archive)
+            for name, count in batch.iteritems():
+                counts[name] += count
+                metrics.incr('db.purge.%s' % name, count)
+            if batch[table] < batch_size:
+                break
+            time.sleep(batch_sleep)
+
+    elapsed = time.time() - start
+    rows = sum(counts.values())
+    stats = {'rows': counts, 'seconds': elapsed,
+             'rows_per_second': rows / elapsed if elapsed else 0.0}
+    LOG.info(_('%(action)s %(jobs)d jobs, %(job_metadata)d job metadata '
+               'and %(job_faults)d job faults older than %(older_than)s in '
+               '%(seconds).2fs (%(rate).1f rows/sec)')
+             % dict(counts, action='Archived' if archive else 'Purged',
+                    older_than=older_than, seconds=elapsed,
+                    rate=stats['rows_per_second']))
+    return stats
+
+
+def _run_periodic(db_api):
+    while True:
+        time.sleep(CONF.purge.interval)
+        with utils.log_warning_and_dismiss_exception(LOG):
+            purge(db_api)
+
+
+def start_periodic_purge(db_api=None):
+    """Purge every purge.interval seconds in a greenthread, if enabled."""
+    if CONF.purge.interval > 0:
+        eventlet.spawn_n(_run_periodic, db_api or qonos.db.get_api())
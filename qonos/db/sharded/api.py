@@ -0,0 +1,414 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+DB-API spreading tenants over several databases.
+
+sql_connection and the sql_shard_connections are the shards. New
+schedules, jobs and job faults of a tenant are written to the shard the
+tenant hashes to on a consistent hash ring. Rows are never moved: adding a
+shard at the end of sql_shard_connections sends the new rows of about one
+tenant in the new number of shards to it, while their older rows stay
+where they were written. Workers, which belong to no tenant, live on
+sql_connection.
+
+The ids of new schedules and jobs are picked to hash to their tenant's
+shard, so a schedule or job is found by its id without asking the other
+shards; rows whose ids hash elsewhere, given ids or rows created before a
+shard was added, are looked for on the other shards next. Lists and job
+stats, with or without a tenant, are read from every shard and merged, and
+job claims try the shards in turn, starting from the next shard on each
+claim.
+
+Each call runs on one shard through the sqlalchemy DB-API; the shards are
+migrated one at a time with qonos-manage, pointing sql_connection at each.
+"""
+
+import collections
+import contextlib
+import itertools
+
+from oslo.config import cfg
+
+from qonos.common import exception
+import qonos.db.db_utils as db_utils
+from qonos.db.sharded import hash_ring
+import qonos.db.sqlalchemy.api as sa_api
+from qonos.db.sqlalchemy import models
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+from qonos.openstack.common import uuidutils
+
+
+LOG = logging.getLogger(__name__)
+
+_SHARDS = []
+_RING = None
+_CLAIMS = itertools.count()
+
+sharded_opts = [
+    cfg.ListOpt('sql_shard_connections', default=[], secret=True,
+                help=_('Connection strings of the databases tenants are '
+                       'spread over besides sql_connection, with the '
+                       'sharded db_api. Add new ones at the end of the '
+                       'list; rows stay on the database they were written '
+                       'to, so a database holding rows cannot be removed')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(sharded_opts)
+
+
+def configure_db():
+    """Connect to every shard, creating their tables if db_auto_create
+    is set."""
+    global _SHARDS, _RING
+    if _SHARDS:
+        return
+
+    sa_api.configure_db()
+    shards = [sa_api.get_engine()]
+    for sql_connection in CONF.sql_shard_connections:
+        engine = sa_api.connect_engine(sql_connection)
+        if CONF.db_auto_create:
+            models.register_models(engine)
+        shards.append(engine)
+
+    _SHARDS = shards
+    _RING = hash_ring.HashRing(len(shards))
+    LOG.info(_('Spreading tenants over %d database shards') % len(shards))
+
+
+def reset():
+    for engine in _SHARDS:
+        models.unregister_models(engine)
+        models.register_models(engine)
+
+
+@contextlib.contextmanager
+def request_scope():
+    # NOTE: The calls of a request may run on different shards, so each
+    # one uses a session of its own.
+    yield
+
+
+def _run(shard, func, *args, **kwargs):
+    with sa_api.engine_scope(_SHARDS[shard]):
+        return func(*args, **kwargs)
+
+
+def _shard_order(first):
+    """Return the shards starting from first and wrapping around."""
+    return [(first + i) % len(_SHARDS) for i in xrange(len(_SHARDS))]
+
+
+def _on_each_shard(func, *args):
+    return [_run(shard, func, *args) for shard in xrange(len(_SHARDS))]
+
+
+def _tenant_shard(tenant):
+    return _RING.get_node(tenant)
+
+
+def _generate_id(shard):
+    """Return a new UUID that hashes to shard."""
+    while True:
+        row_id = uuidutils.generate_uuid()
+        if _RING.get_node(row_id) == shard:
+            return row_id
+
+
+def _find(row_id, call):
+    """Return call(shard) for the shard holding row_id.
+
+    call is made on the shard row_id hashes to, then on the next ones while
+    it raises NotFound. The last NotFound is raised when no shard has it.
+    """
+    error = None
+    for shard in _shard_order(_RING.get_node(row_id)):
+        try:
+            return call(shard)
+        except exception.NotFound as e:
+            error = e
+    raise error
+
+
+def _on_owner(row_id, func, *args):
+    return _find(row_id, lambda shard: _run(shard, func, row_id, *args))
+
+
+def _first_found(row_id, func):
+    """Return func(row_id) from the first shard, in the order of _find,
+    where it returns something."""
+    result = None
+    for shard in _shard_order(_RING.get_node(row_id)):
+        result = _run(shard, func, row_id)
+        if result:
+            break
+    return result
+
+
+def _owner(row_id, get):
+    """Return the shard where get(row_id) finds row_id."""
+    def call(shard):
+        _run(shard, get, row_id)
+        return shard
+    return _find(row_id, call)
+
+
+def _sort(items, sort_keys, sort_dirs):
+    """Sort items like the database does, NULL first ascending and last
+    descending."""
+    for sort_key, sort_dir in reversed(zip(sort_keys, sort_dirs)):
+        items.sort(key=lambda item: (item[sort_key] is not None,
+                                     item[sort_key]),
+                   reverse=sort_dir == 'desc')
+    return items
+
+
+def _merged_list(func, resource, get, params):
+    """Return a page of a list from every shard.
+
+    Each shard returns up to the page's limit of the items after the
+    cursor, which are merged in order and cut down to the limit. A marker
+    is turned into a cursor once it is found.
+    """
+    params = dict(params)
+    sort_keys, sort_dirs, cursor_values = db_utils.get_sort_params(resource,
+                                                                   params)
+    if cursor_values is None and params.get('marker') is not None:
+        marker = _on_owner(params.pop('marker'), get)
+        params['cursor'] = db_utils.encode_cursor(marker, sort_keys,
+                                                  sort_dirs)
+
+    items = []
+    for shard in xrange(len(_SHARDS)):
+        items.extend(_run(shard, func, dict(params)))
+    _sort(items, sort_keys, sort_dirs)
+
+    limit = params.get('limit')
+    return items if limit is None else items[:limit]
+
+
+def _summed(counts):
+    totals = collections.defaultdict(int)
+    for shard_counts in counts:
+        for name, count in shard_counts.iteritems():
+            totals[name] += count
+    return dict(totals)
+
+
+def _merge_job_stats(shard_stats):
+    status_counts = collections.defaultdict(int)
+    claimable_counts = {}
+    for stats in shard_stats:
+        for action, action_stats in stats['actions'].iteritems():
+            for status, count in action_stats['statuses'].iteritems():
+                status_counts[(action, status)] += count
+            if not action_stats['claimable']:
+                continue
+            count, oldest = claimable_counts.get(action, (0, None))
+            shard_oldest = action_stats['oldest_claimable']
+            if oldest is None or (shard_oldest is not None and
+                                  shard_oldest < oldest):
+                oldest = shard_oldest
+            claimable_counts[action] = (count + action_stats['claimable'],
+                                        oldest)
+
+    return db_utils.job_stats(
+        [key + (total,) for key, total in status_counts.iteritems()],
+        [(action,) + claimable
+         for action, claimable in claimable_counts.iteritems()])
+
+
+# Schedule methods
+
+
+def schedule_create(schedule_values):
+    db_utils.validate_schedule_values(schedule_values)
+    shard = _tenant_shard(schedule_values['tenant'])
+    values = dict(schedule_values)
+    if values.get('id') is None:
+        values['id'] = _generate_id(shard)
+    return _run(shard, sa_api.schedule_create, values)
+
+
+def schedule_get_all(filter_args={}):
+    return _merged_list(sa_api.schedule_get_all, 'schedules',
+                        sa_api.schedule_get_by_id, filter_args)
+
+
+def schedule_get_by_id(schedule_id):
+    return _on_owner(schedule_id, sa_api.schedule_get_by_id)
+
+
+def schedule_update(schedule_id, schedule_values):
+    tenant = schedule_values.get('tenant')
+
+    def update(shard):
+        if tenant is not None and _tenant_shard(tenant) != shard:
+            stored = _run(shard, sa_api.schedule_get_by_id, schedule_id)
+            if stored['tenant'] != tenant:
+                msg = _('Cannot move schedule %s to a tenant on another '
+                        'database shard') % schedule_id
+                raise exception.Invalid(msg)
+        return _run(shard, sa_api.schedule_update, schedule_id,
+                    schedule_values)
+
+    return _find(schedule_id, update)
+
+
+def schedule_test_and_set_next_run(schedule_id, expected_next_run, next_run):
+    return _on_owner(schedule_id, sa_api.schedule_test_and_set_next_run,
+                     expected_next_run, next_run)
+
+
+def schedule_delete(schedule_id):
+    return _on_owner(schedule_id, sa_api.schedule_delete)
+
+
+def schedule_meta_create(schedule_id, values):
+    return _on_owner(schedule_id, sa_api.schedule_meta_create, values)
+
+
+def schedule_meta_get_all(schedule_id):
+    return _on_owner(schedule_id, sa_api.schedule_meta_get_all)
+
+
+def schedule_metadata_update(schedule_id, values):
+    return _on_owner(schedule_id, sa_api.schedule_metadata_update, values)
+
+
+def schedule_meta_delete(schedule_id, key):
+    return _on_owner(schedule_id, sa_api.schedule_meta_delete, key)
+
+
+# Worker methods, on sql_connection
+
+
+worker_get_all = sa_api.worker_get_all
+worker_create = sa_api.worker_create
+worker_get_by_id = sa_api.worker_get_by_id
+worker_delete = sa_api.worker_delete
+
+
+# Job methods
+
+
+def job_create(job_values):
+    db_utils.validate_job_values(job_values)
+    shard = _tenant_shard(job_values['tenant'])
+    values = dict(job_values)
+    if values.get('id') is None:
+        values['id'] = _generate_id(shard)
+    return _run(shard, sa_api.job_create, values)
+
+
+def job_create_from_schedule(schedule_id, expected_next_run=None,
+                             job_values=None, timeout_seconds=None):
+    def create(shard):
+        values = dict(job_values or {})
+        if values.get('id') is None:
+            values['id'] = _generate_id(shard)
+        return _run(shard, sa_api.job_create_from_schedule, schedule_id,
+                    expected_next_run, values, timeout_seconds)
+
+    return _find(schedule_id, create)
+
+
+def job_get_all(params={}):
+    return _merged_list(sa_api.job_get_all, 'jobs', sa_api.job_get_by_id,
+                        params)
+
+
+def job_stats(tenant=None):
+    return _merge_job_stats(_on_each_shard(sa_api.job_stats, tenant))
+
+
+def job_get_by_id(job_id):
+    return _on_owner(job_id, sa_api.job_get_by_id)
+
+
+def job_updated_at_get_by_id(job_id):
+    return _on_owner(job_id, sa_api.job_updated_at_get_by_id)
+
+
+def job_get_and_assign_next_by_action(action, worker_id, new_timeout):
+    """Claim the next job of action from the first shard that has one,
+    starting from the shard after the one the previous claim started
+    from."""
+    first = next(_CLAIMS) % len(_SHARDS)
+    for shard in _shard_order(first):
+        job = _run(shard, sa_api.job_get_and_assign_next_by_action, action,
+                   worker_id, new_timeout)
+        if job is not None:
+            return job
+    return None
+
+
+def _jobs_cleanup_hard_timed_out():
+    return sum(_on_each_shard(sa_api._jobs_cleanup_hard_timed_out))
+
+
+def job_purge_batch(older_than, batch_size, archive=False):
+    # NOTE: purge() stops once a batch is short of batch_size, which the
+    # sum is only when every shard's batch was.
+    return _summed(_on_each_shard(sa_api.job_purge_batch, older_than,
+                                  batch_size, archive))
+
+
+def job_fault_purge_batch(older_than, batch_size, archive=False):
+    return _summed(_on_each_shard(sa_api.job_fault_purge_batch, older_than,
+                                  batch_size, archive))
+
+
+def metadata_backfill(batch_size=500):
+    return _summed(_on_each_shard(sa_api.metadata_backfill, batch_size))
+
+
+def job_update(job_id, job_values):
+    return _on_owner(job_id, sa_api.job_update, job_values)
+
+
+def job_delete(job_id):
+    return _on_owner(job_id, sa_api.job_delete)
+
+
+def job_meta_create(job_id, values):
+    # NOTE: The job is looked up first, as creating metadata does not check
+    # that the job is on the shard it runs on.
+    shard = _owner(job_id, sa_api.job_updated_at_get_by_id)
+    return _run(shard, sa_api.job_meta_create, job_id, values)
+
+
+def job_meta_get_all_by_job_id(job_id):
+    return _first_found(job_id, sa_api.job_meta_get_all_by_job_id)
+
+
+def job_metadata_update(job_id, values):
+    return _on_owner(job_id, sa_api.job_metadata_update, values)
+
+
+# Job fault methods
+
+
+def job_fault_latest_for_job_id(job_id):
+    return _first_found(job_id, sa_api.job_fault_latest_for_job_id)
+
+
+def job_fault_create(values):
+    return _run(_tenant_shard(values['tenant']), sa_api.job_fault_create,
+                values)
@@ -0,0 +1,50 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+import hashlib
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(str(key)).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """Maps keys to one of a number of nodes by consistent hashing.
+
+    Each node is placed at many points of a ring of hashes and a key
+    belongs to the node of the first point at or after the key's hash.
+    Adding a node only moves the keys that fall on its points, about one
+    in the new number of nodes, to it.
+    """
+
+    def __init__(self, nodes, points=100):
+        """
+        :param nodes: the number of nodes, which are numbered from 0
+        :param points: the points of each node on the ring
+        """
+        self.nodes = nodes
+        ring = sorted((_hash('%d-%d' % (node, point)), node)
+                      for node in xrange(nodes) for point in xrange(points))
+        self._hashes = [key_hash for key_hash, _node in ring]
+        self._nodes = [node for _key_hash, node in ring]
+
+    def get_node(self, key):
+        """Return the number of the node key belongs to."""
+        position = bisect.bisect_left(self._hashes, _hash(key))
+        return self._nodes[position % len(self._nodes)]
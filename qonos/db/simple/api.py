@@ -14,12 +14,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
 import copy
 import datetime
 import operator
 import uuid
 
-from operator import itemgetter
 from qonos.common import exception
 from qonos.common import timeutils
 import qonos.db.db_utils as db_utils
@@ -46,6 +46,11 @@ def reset():
         DATA[k] = {}
 
 
+@contextlib.contextmanager
+def request_scope():
+    yield
+
+
 def _gen_base_attributes(item_id=None):
     values = {}
     if item_id is None:
@@ -62,34 +67,58 @@ def _schedule_create(values):
     return copy.deepcopy(values)
 
 
-def _do_pagination(items, marker, limit):
+def _sort_value(value):
+    # NOTE: None sorts before any value, as NULL does on MySQL and SQLite.
+    if isinstance(value, datetime.datetime):
+        value = timeutils.normalize_time(value)
+    return (value is not None, value)
+
+
+def _is_after(item, sort_keys, sort_dirs, marker_values):
+    for sort_key, sort_dir, marker_value in zip(sort_keys, sort_dirs,
+                                                marker_values):
+        value = _sort_value(item.get(sort_key))
+        marker_value = _sort_value(marker_value)
+        if value != marker_value:
+            if sort_dir == 'desc':
+                return value < marker_value
+            return value > marker_value
+    return False
+
+
+def _do_pagination(items, resource, params):
     """
     This method mimics the behavior of sqlalchemy paginate_query.
-    It takes items and pagination parameters - 'limit' and 'marker'
-    to filter out the items to be returned. Items are sorted in
-    lexicographical order based on the sort key - 'id'.
+    It takes items and the list parameters - 'limit', 'cursor' or
+    'marker', 'sort_key' and 'sort_dir' - to filter out the items to be
+    returned. Items are sorted by the sort keys, followed by 'id'.
     """
-    items = sorted(items, key=itemgetter('id'))
-    start = 0
-    end = -1
-    if marker is None:
-        start = 0
-    else:
-        for i, item in enumerate(items):
+    sort_keys, sort_dirs, marker_values = db_utils.get_sort_params(resource,
+                                                                  params)
+    for sort_key, sort_dir in reversed(zip(sort_keys, sort_dirs)):
+        items = sorted(items, key=lambda item: _sort_value(item.get(sort_key)),
+                       reverse=(sort_dir == 'desc'))
+
+    marker = params.get('marker')
+    if marker_values is None and marker is not None:
+        for item in items:
             if item['id'] == marker:
-                start = i + 1
+                marker_values = [item.get(key) for key in sort_keys]
                 break
         else:
             msg = _('Marker %s not found') % marker
             raise exception.NotFound(explanation=msg)
 
-    end = start + limit if limit is not None else None
-    return items[start:end]
+    if marker_values is not None:
+        items = [item for item in items
+                 if _is_after(item, sort_keys, sort_dirs, marker_values)]
+
+    return items[:params.get('limit')]
 
 
 def schedule_get_all(filter_args={}):
     SCHEDULE_BASE_FILTERS = ['next_run_after', 'next_run_before',
-                             'tenant', 'limit', 'marker']
+                             'tenant'] + db_utils.PAGINATION_PARAMS
     schedules = copy.deepcopy(DATA['schedules'].values())
     schedules_mutate = copy.deepcopy(DATA['schedules'].values())
 
@@ -146,9 +175,8 @@ def schedule_get_all(filter_args={}):
                     if schedule in schedules_mutate:
                         del schedules_mutate[schedules_mutate.index(schedule)]
 
-    marker = filter_args.get('marker')
-    limit = filter_args.get('limit')
-    schedules_mutate = _do_pagination(schedules_mutate, marker, limit)
+    schedules_mutate = _do_pagination(schedules_mutate, 'schedules',
+                                      filter_args)
     return schedules_mutate
 
 
@@ -310,9 +338,7 @@ def schedule_meta_delete(schedule_id, key):
 
 def worker_get_all(params={}):
     workers = copy.deepcopy(DATA['workers'].values())
-    marker = params.get('marker')
-    limit = params.get('limit')
-    workers = _do_pagination(workers, marker, limit)
+    workers = _do_pagination(workers, 'workers', params)
     return workers
 
 
@@ -370,6 +396,29 @@ def job_create(job_values):
     return job_get_by_id(job['id'])
 
 
+def job_create_from_schedule(schedule_id, expected_next_run=None,
+                             job_values=None, timeout_seconds=None):
+    schedule = schedule_get_by_id(schedule_id)
+
+    if expected_next_run:
+        current_next_run = schedule.get('next_run')
+        if current_next_run:
+            current_next_run = current_next_run.replace(tzinfo=None)
+        if expected_next_run.replace(tzinfo=None) != current_next_run:
+            raise exception.Conflict()
+
+    now = timeutils.utcnow()
+    values = db_utils.job_values_from_schedule(schedule, now, job_values,
+                                               timeout_seconds)
+    db_utils.validate_job_values(values)
+
+    schedule_update(schedule_id,
+                    {'next_run': db_utils.next_run_from_schedule(schedule,
+                                                                 now),
+                     'last_scheduled': now})
+    return job_create(values)
+
+
 def job_get_all(params={}):
     jobs = copy.deepcopy(DATA['jobs'].values())
     JOB_BASE_FILTERS = ['schedule_id',
@@ -397,13 +446,38 @@ def job_get_all(params={}):
         job['job_metadata'] =\
             job_meta_get_all_by_job_id(job['id'])
 
-    marker = params.get('marker')
-    limit = params.get('limit')
-    jobs = _do_pagination(jobs, marker, limit)
+    jobs = _do_pagination(jobs, 'jobs', params)
 
     return jobs
 
 
+def _job_claimable(job, now):
+    return (job['status'] not in db_utils.UNCLAIMABLE_JOB_STATUSES and
+            (job['worker_id'] is None or job['timeout'] <= now))
+
+
+def job_stats(tenant=None):
+    now = timeutils.utcnow().replace(second=0, microsecond=0)
+    status_counts = {}
+    claimable = {}
+    for job in DATA['jobs'].values():
+        if tenant is not None and job['tenant'] != tenant:
+            continue
+
+        key = (job['action'], job['status'])
+        status_counts[key] = status_counts.get(key, 0) + 1
+        if _job_claimable(job, now):
+            count, oldest = claimable.get(job['action'],
+                                          (0, job['updated_at']))
+            claimable[job['action']] = (count + 1,
+                                        min(oldest, job['updated_at']))
+
+    return db_utils.job_stats(
+        [(action, status, total)
+         for (action, status), total in status_counts.iteritems()],
+        [(action,) + value for action, value in claimable.iteritems()])
+
+
 def job_get_by_id(job_id):
     if job_id not in DATA['jobs']:
         raise exception.NotFound()
@@ -428,11 +502,8 @@ def job_get_and_assign_next_by_action(action, worker_id, new_timeout):
     job_ref = None
     now = timeutils.utcnow().replace(second=0, microsecond=0)
     jobs = _jobs_get_sorted()
-    statuses = ['DONE', 'CANCELLED', 'HARD_TIMED_OUT', 'MAX_RETRIED']
     for job in jobs:
-        if job['action'] == action and \
-                job['status'] not in statuses and \
-                (job['worker_id'] is None or job['timeout'] <= now):
+        if job['action'] == action and _job_claimable(job, now):
             job_ref = job
             break
 
@@ -477,6 +548,35 @@ def _jobs_cleanup_hard_timed_out():
     return len(del_ids)
 
 
+def job_purge_batch(older_than, batch_size, archive=False):
+    # NOTE: The simple backend keeps no archive; archive is ignored.
+    global DATA
+    ids = [job_id for job_id, job in sorted(DATA['jobs'].iteritems())
+           if job['status'] in db_utils.PURGEABLE_JOB_STATUSES and
+           job['updated_at'] < older_than]
+    if len(ids) < batch_size:
+        ids.extend(job_id for job_id, job in sorted(DATA['jobs'].iteritems())
+                   if job['hard_timeout'] < older_than and
+                   job_id not in ids)
+    ids = ids[:batch_size]
+
+    metadata_count = 0
+    for job_id in ids:
+        metadata_count += len(DATA['job_metadata'].pop(job_id, {}))
+        del DATA['jobs'][job_id]
+    return {'jobs': len(ids), 'job_metadata': metadata_count}
+
+
+def job_fault_purge_batch(older_than, batch_size, archive=False):
+    global DATA
+    ids = [fault_id for fault_id, fault
+           in sorted(DATA['job_faults'].iteritems())
+           if fault['created_at'] < older_than][:batch_size]
+    for fault_id in ids:
+        del DATA['job_faults'][fault_id]
+    return {'job_faults': len(ids)}
+
+
 def job_update(job_id, job_values):
     global DATA
     values = job_values.copy()
@@ -18,28 +18,39 @@
 Defines interface for DB access
 """
 
+import contextlib
 import functools
-import inspect
 import logging
+import random
 import time
 
 from oslo.config import cfg
 import sqlalchemy
+import sqlalchemy.ext.compiler as sa_compiler
 import sqlalchemy.orm as sa_orm
+import sqlalchemy.pool as sa_pool
 import sqlalchemy.sql as sa_sql
 
 from qonos.common import exception
+from qonos.common import metrics
 from qonos.common import timeutils
 import qonos.db.db_utils as db_utils
 from qonos.db.sqlalchemy import models
+from qonos.db.sqlalchemy import profiler
 from qonos.openstack.common.gettextutils import _
+from qonos.openstack.common import local
 import qonos.openstack.common.log as os_logging
+from qonos.openstack.common import uuidutils
 
 
 _ENGINE = None
-_MAKER = None
+_SLAVE_ENGINE = None
+_SLAVE_STATE = {'checked_at': None, 'usable': False}
+_MAKERS = {}
+_REQUEST = local.strong_store()
 _MAX_RETRIES = None
 _RETRY_INTERVAL = None
+_SKIP_LOCKED_SUPPORTED = None
 BASE = models.BASE
 sa_logger = None
 LOG = os_logging.getLogger(__name__)
@@ -49,12 +60,171 @@ db_opts = [
     cfg.IntOpt('sql_max_retries', default=60),
     cfg.IntOpt('sql_retry_interval', default=1),
     cfg.BoolOpt('db_auto_create', default=True),
-    cfg.BoolOpt('log_query_times', default=False)
+    cfg.BoolOpt('log_query_times', default=False,
+                help=_('Profile the SQL statements run by each db api '
+                       'function, log the slow ones and dump a summary on '
+                       'SIGUSR2')),
+    cfg.IntOpt('sql_pool_size', default=5,
+               help=_('Number of connections kept open in the pool')),
+    cfg.IntOpt('sql_max_overflow', default=10,
+               help=_('Number of connections that may be opened beyond '
+                      'sql_pool_size when the pool is exhausted')),
+    cfg.IntOpt('sql_pool_timeout', default=30,
+               help=_('Seconds to wait for a connection from an exhausted '
+                      'pool before giving up')),
+    cfg.StrOpt('sql_pool_pre_ping', default='auto',
+               help=_('When to check that a connection is alive as it is '
+                      'checked out of the pool: "idle" when it was idle '
+                      'for longer than sql_pool_ping_idle_time, "auto" '
+                      'like idle for MySQL only, "always" or "never". '
+                      'A db api call whose connection was not checked '
+                      'and turns out dead is retried once')),
+    cfg.IntOpt('sql_pool_ping_idle_time', default=30,
+               help=_('Seconds a connection may stay idle in the pool '
+                      'before it is checked again at checkout')),
+    cfg.StrOpt('sql_isolation_level', default=None,
+               help=_('Transaction isolation level of the database '
+                      'connections, e.g. "READ COMMITTED", instead of the '
+                      'database default')),
+    cfg.IntOpt('sql_transaction_retries', default=5,
+               help=_('Number of times a db api write is retried after a '
+                      'deadlock, lock wait timeout or serialization '
+                      'failure, 0 to disable')),
+    cfg.FloatOpt('sql_transaction_retry_interval', default=0.05,
+                 help=_('Seconds the backoff before the first retry of a '
+                        'write is drawn from; it doubles on each retry')),
+    cfg.FloatOpt('sql_transaction_retry_max_interval', default=2.0,
+                 help=_('Upper bound, in seconds, of the backoff between '
+                        'retries of a write')),
+    cfg.StrOpt('slave_connection', default=None, secret=True,
+               help=_('Connection string of a read replica of the database. '
+                      'When set, schedule, job and worker listings and gets '
+                      'read from it; writes and job claims always use '
+                      'sql_connection')),
+    cfg.IntOpt('slave_max_lag', default=10,
+               help=_('Read from the replica only while its replication '
+                      'lag is at most this many seconds, -1 to read from it '
+                      'whatever its lag')),
+    cfg.BoolOpt('sql_binary_uuids', default=False,
+                help=_('Have migration 019 store the UUID keys of a MySQL '
+                       'database as BINARY(16) instead of VARCHAR(36). '
+                       'Servers find out how the keys are stored when they '
+                       'connect. To convert a database already at version '
+                       '19, downgrade it to 18 and upgrade it again')),
+    cfg.StrOpt('job_claim_strategy', default='auto',
+               help=_('How workers claim jobs: "skip_locked" uses SELECT '
+                      '... FOR UPDATE SKIP LOCKED, "optimistic" relies on '
+                      'the version_id check, "auto" uses skip_locked where '
+                      'the database supports it')),
+    cfg.StrOpt('metadata_storage', default='table',
+               help=_('Where job and schedule metadata is stored: "table" '
+                      'keeps a row per key in job_metadata and '
+                      'schedule_metadata, "json" keeps it in the '
+                      'metadata_json column of the job or schedule, read '
+                      'along with it. Run qonos-manage metadata_backfill '
+                      'after changing it')),
+    cfg.ListOpt('indexed_metadata_keys', default=['instance_id'],
+                help=_('Schedule metadata keys also kept in '
+                       'schedule_metadata with json metadata storage, so '
+                       'schedules are looked up by them through an index')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(db_opts)
 
+JOB_CLAIM_STRATEGIES = ('auto', 'skip_locked', 'optimistic')
+METADATA_STORAGES = ('table', 'json')
+PRE_PING_STRATEGIES = ('auto', 'idle', 'always', 'never')
+
+# NOTE: How long the measured replication lag of the replica is trusted.
+_SLAVE_LAG_CHECK_INTERVAL = 5
+
+# NOTE: Errors after which the transaction was rolled back and may succeed
+# when run again: MySQL deadlock and lock wait timeout, PostgreSQL
+# serialization failure and deadlock, SQLite lock contention.
+_MYSQL_TRANSIENT_ERRORS = (1205, 1213)
+_POSTGRESQL_TRANSIENT_ERRORS = ('40001', '40P01')
+_SQLITE_TRANSIENT_ERRORS = ('database is locked',)
+
+
+@sa_compiler.compiles(sa_sql.expression.Select, 'mysql')
+@sa_compiler.compiles(sa_sql.expression.Select, 'postgresql')
+def _compile_select(select, compiler, **kw):
+    # NOTE: SQLAlchemy only knows FOR UPDATE [NOWAIT]. A select whose
+    # for_update is 'skip_locked' compiles to FOR UPDATE and gets the
+    # SKIP LOCKED suffix appended here; FOR UPDATE always comes last.
+    text = compiler.visit_select(select, **kw)
+    if select.for_update == 'skip_locked':
+        text += ' SKIP LOCKED'
+    return text
+
+
+class Upsert(sa_sql.expression.Executable, sa_sql.expression.ClauseElement):
+    """A multi-row INSERT that updates the rows already present instead.
+
+    Only compiles for the databases _upsert_supported accepts.
+
+    :param table: the table to insert into
+    :param rows: dicts of the values of each row, all with the same keys
+    :param unique_columns: the columns of the unique key rows collide on
+    :param update_columns: the columns set from the row inserted when a
+                           row with its unique key is already present
+    """
+    _execution_options = \
+        sa_sql.expression.Executable._execution_options.union(
+            {'autocommit': True})
+
+    def __init__(self, table, rows, unique_columns, update_columns):
+        self.table = table
+        self.rows = rows
+        self.unique_columns = unique_columns
+        self.update_columns = update_columns
+
+
+def _upsert_supported(dialect):
+    """Return True if the server behind dialect understands Upsert."""
+    version = tuple(dialect.server_version_info or ())
+    if dialect.name == 'mysql':
+        return True
+    if dialect.name == 'sqlite':
+        return version >= (3, 24)
+    if dialect.name == 'postgresql':
+        return version >= (9, 5)
+    return False
+
+
+@sa_compiler.compiles(Upsert)
+def _compile_upsert(upsert, compiler, **kw):
+    # NOTE: MySQL updates on a duplicate of any unique key; SQLite 3.24+
+    # and PostgreSQL 9.5+ on a conflict with the key named.
+    if not _upsert_supported(compiler.dialect):
+        raise sqlalchemy.exc.CompileError(
+            _('%s does not support upserts') % compiler.dialect.name)
+    table = upsert.table
+    column_names = sorted(upsert.rows[0])
+    quote = compiler.preparer.quote_identifier
+    values = []
+    for i, row in enumerate(upsert.rows):
+        binds = [compiler.process(sa_sql.bindparam(
+                 '%s_%d' % (name, i), row[name], type_=table.c[name].type))
+                 for name in column_names]
+        values.append('(%s)' % ', '.join(binds))
+
+    text = 'INSERT INTO %s (%s) VALUES %s' % (
+        compiler.preparer.format_table(table),
+        ', '.join(quote(name) for name in column_names),
+        ', '.join(values))
+    if compiler.dialect.name == 'mysql':
+        text += ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+            '%s = VALUES(%s)' % (quote(name), quote(name))
+            for name in upsert.update_columns)
+    else:
+        text += ' ON CONFLICT (%s) DO UPDATE SET %s' % (
+            ', '.join(quote(name) for name in upsert.unique_columns),
+            ', '.join('%s = excluded.%s' % (quote(name), quote(name))
+                      for name in upsert.update_columns))
+    return text
+
 
 def force_dict(func):
     """Ensure returned object is a dict or list of dicts."""
@@ -128,6 +298,135 @@ def ping_listener(dbapi_conn, connection_rec, connection_proxy):
             raise
 
 
+def binary_uuids_listener(dialect, dbapi_conn, connection_rec):
+    """Flag dialect when migration 019 stored the keys as BINARY(16).
+
+    Run on the first connection of a MySQL engine, before any statement
+    using the keys is compiled.
+    """
+    cursor = dbapi_conn.cursor()
+    cursor.execute("SELECT DATA_TYPE FROM information_schema.COLUMNS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'jobs' "
+                   "AND COLUMN_NAME = 'id'")
+    row = cursor.fetchone()
+    cursor.close()
+    dialect.binary_uuids = row is not None and row[0].lower() == 'binary'
+
+
+def generic_ping_listener(dbapi_conn, connection_rec, connection_proxy):
+    """Ensures that connections of any database checked out of the
+    pool are alive."""
+    try:
+        dbapi_conn.cursor().execute('select 1')
+    except dbapi_conn.OperationalError, ex:
+        msg = 'Database connection is no longer usable: %s' % ex
+        LOG.warn(msg)
+        raise sqlalchemy.exc.DisconnectionError(msg)
+
+
+class LivenessChecker(object):
+    """Check that pooled connections are alive only when it is worth it.
+
+    A connection is pinged at checkout only when it sat in the pool for at
+    least idle_time seconds, when the server is likely to have closed it.
+    Any other connection is used as it is: if it turns out dead, the error
+    of its first statement is flagged with first_use so the db api call
+    can be retried on a new connection by retry_on_disconnect. Pings made
+    and avoided are counted in db.pool.pings and db.pool.pings_avoided.
+
+    :param ping: the checkout listener pinging a connection
+    :param idle_time: seconds of idleness after which a connection is
+                      pinged, None to never ping
+    """
+
+    def __init__(self, ping, idle_time):
+        self.ping = ping
+        self.idle_time = idle_time
+
+    def listen(self, engine):
+        sqlalchemy.event.listen(engine, 'connect', self.connect)
+        sqlalchemy.event.listen(engine, 'checkin', self.checkin)
+        sqlalchemy.event.listen(engine, 'checkout', self.checkout)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute',
+                                self.after_cursor_execute)
+        sqlalchemy.event.listen(engine, 'dbapi_error', self.dbapi_error)
+
+    def connect(self, dbapi_conn, connection_rec):
+        connection_rec.info.pop('checked_in_at', None)
+
+    def checkin(self, dbapi_conn, connection_rec):
+        connection_rec.info['checked_in_at'] = time.time()
+
+    def checkout(self, dbapi_conn, connection_rec, connection_proxy):
+        connection_rec.info['used'] = False
+        if self.idle_time is None:
+            return
+
+        # NOTE: A connection that was never checked in was just opened.
+        checked_in_at = connection_rec.info.get('checked_in_at')
+        if checked_in_at is None or \
+                time.time() - checked_in_at < self.idle_time:
+            metrics.incr('db.pool.pings_avoided')
+            return
+
+        metrics.incr('db.pool.pings')
+        self.ping(dbapi_conn, connection_rec, connection_proxy)
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        conn.info['used'] = True
+
+    def dbapi_error(self, conn, cursor, statement, parameters, context,
+                    exception):
+        if not conn.info.get('used'):
+            try:
+                exception.first_use = True
+            except (AttributeError, TypeError):
+                # NOTE: Errors of DB-API modules written in C may not take
+                # attributes; the call is then not retried.
+                pass
+
+
+class TimedQueuePool(sa_pool.QueuePool):
+    """QueuePool reporting checkout wait time and saturation as metrics.
+
+    db.pool.checkout_wait is the time spent getting a connection out of
+    the pool, including opening a new one. db.pool.saturation is the
+    fraction of sql_pool_size + sql_max_overflow checked out.
+    """
+
+    _local = local.strong_store()
+
+    def _do_get(self):
+        # NOTE: QueuePool._do_get calls itself when it loses a race, only
+        # the outermost call is timed.
+        if getattr(self._local, 'timing', False):
+            return super(TimedQueuePool, self)._do_get()
+
+        self._local.timing = True
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            metrics.incr('db.pool.timeouts')
+            raise
+        finally:
+            self._local.timing = False
+            metrics.timing('db.pool.checkout_wait', time.time() - start)
+            self._report_usage()
+
+    def _do_return_conn(self, conn):
+        super(TimedQueuePool, self)._do_return_conn(conn)
+        self._report_usage()
+
+    def _report_usage(self):
+        checked_out = self.checkedout()
+        capacity = self.size() + max(self._max_overflow, 0)
+        metrics.gauge('db.pool.checked_out', checked_out)
+        metrics.gauge('db.pool.saturation',
+                      float(checked_out) / capacity if capacity else 0.0)
+
+
 def configure_db():
     """
     Establish the database, create an engine if needed, and
@@ -154,89 +453,218 @@ def reset():
     models.register_models(_ENGINE)
 
 
-def _before_cursor_execute(conn,
-                           cursor,
-                           statement,
-                           parameters,
-                           context,
-                           executemany,
-                           ):
-    stack = inspect.stack()
+def _create_engine(sql_connection):
+    connection_dict = sqlalchemy.engine.url.make_url(sql_connection)
+    engine_args = {'pool_recycle': CONF.sql_idle_timeout,
+                   'echo': False,
+                   'convert_unicode': True
+                   }
+
+    # NOTE: SQLite uses its own pools which cannot be sized.
+    if 'sqlite' not in connection_dict.drivername:
+        engine_args.update({'poolclass': TimedQueuePool,
+                            'pool_size': CONF.sql_pool_size,
+                            'max_overflow': CONF.sql_max_overflow,
+                            'pool_timeout': CONF.sql_pool_timeout})
+
+    if CONF.sql_isolation_level:
+        engine_args['isolation_level'] = CONF.sql_isolation_level
+
+    pre_ping = CONF.sql_pool_pre_ping
+    if pre_ping not in PRE_PING_STRATEGIES:
+        raise exception.QonosException(
+            _('Invalid sql_pool_pre_ping %s') % pre_ping)
+
+    engine = sqlalchemy.create_engine(sql_connection, **engine_args)
+
+    is_mysql = 'mysql' in connection_dict.drivername
+    if is_mysql:
+        sqlalchemy.event.listen(
+            engine, 'first_connect',
+            functools.partial(binary_uuids_listener, engine.dialect))
+    if pre_ping == 'auto':
+        pre_ping = 'idle' if is_mysql else 'never'
+    idle_time = {'idle': CONF.sql_pool_ping_idle_time, 'always': 0,
+                 'never': None}[pre_ping]
+    ping = ping_listener if is_mysql else generic_ping_listener
+    LivenessChecker(ping, idle_time).listen(engine)
+
+    if CONF.log_query_times:
+        profiler.install(engine)
+
+    return engine
+
+
+def connect_engine(sql_connection):
+    """Create an engine for sql_connection, set up like the one of
+    sql_connection, and connect to it, retrying as configured by
+    sql_max_retries and sql_retry_interval."""
+    global _MAX_RETRIES, _RETRY_INTERVAL
+    _MAX_RETRIES = CONF.sql_max_retries
+    _RETRY_INTERVAL = CONF.sql_retry_interval
     try:
-        # NOTE(alaski): stack is a list of tuples like (_, filename, _,
-        # method_name, _, _) where _ are irrelevant slots. The list is
-        # filtered to find the call through sqlalchemy/api.py and then
-        # the method_name is pulled from that stack frame.
-        db_frames = filter(lambda x: x[1].endswith('sqlalchemy/api.py'), stack)
-        method = db_frames[0][3]
-    except IndexError:
-        method = 'unknown'
-    conn.info['query_start_time'] = timeutils.utcnow()
-    conn.info['query_method'] = method
-
-
-def _after_cursor_execute(conn,
-                          cursor,
-                          statement,
-                          parameters,
-                          context,
-                          executemany,
-                          ):
-    method = conn.info.get('query_method')
-    start_time = conn.info.get('query_start_time')
-    if start_time:
-        now = timeutils.utcnow()
-        total = (now - start_time).total_seconds()
-    else:
-        total = -1.0
-    msg = "Query time for '%s': %f. Query statement: %s"
-    LOG.debug(msg % (method, total, statement))
+        engine = _create_engine(sql_connection)
+        engine.connect = wrap_db_error(engine.connect)
+        engine.connect()
+    except Exception, err:
+        msg = _("Error configuring registry database with supplied "
+                "sql_connection '%(sql_connection)s'. "
+                "Got error:\n%(err)s") % locals()
+        LOG.error(msg)
+        raise
+    return engine
 
 
 def get_engine():
-    global _ENGINE, _MAX_RETRIES, _RETRY_INTERVAL
+    global _ENGINE
     if not _ENGINE:
-        sql_connection = CONF.sql_connection
-        _MAX_RETRIES = CONF.sql_max_retries
-        _RETRY_INTERVAL = CONF.sql_retry_interval
-        connection_dict = sqlalchemy.engine.url.make_url(sql_connection)
-        engine_args = {'pool_recycle': CONF.sql_idle_timeout,
-                       'echo': False,
-                       'convert_unicode': True
-                       }
+        _ENGINE = connect_engine(CONF.sql_connection)
+    return _ENGINE
+
 
+def get_slave_engine():
+    """Return the engine of the slave_connection replica, None if unset."""
+    global _SLAVE_ENGINE
+    if _SLAVE_ENGINE is None and CONF.slave_connection:
+        _SLAVE_ENGINE = _create_engine(CONF.slave_connection)
+    return _SLAVE_ENGINE
+
+
+def _replication_lag(engine):
+    """Return how many seconds the replica behind engine lags, or None
+    when replication is broken."""
+    dialect = engine.dialect.name
+    if dialect == 'mysql':
+        status = engine.execute('SHOW SLAVE STATUS').first()
+        # NOTE: A server that is not replicating has no slave status.
+        return status['Seconds_Behind_Master'] if status else 0
+    if dialect == 'postgresql':
+        return engine.execute(
+            'SELECT CASE WHEN pg_is_in_recovery() THEN '
+            'EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) '
+            'ELSE 0 END').scalar()
+    return 0
+
+
+def _use_slave():
+    """Return True if reads may go to the replica.
+
+    The replication lag is measured at most every
+    _SLAVE_LAG_CHECK_INTERVAL seconds; a replica whose lag cannot be read
+    is not used until the next check.
+    """
+    engine = get_slave_engine()
+    if engine is None:
+        return False
+    if CONF.slave_max_lag < 0:
+        return True
+
+    now = time.time()
+    checked_at = _SLAVE_STATE['checked_at']
+    if checked_at is None or now - checked_at >= _SLAVE_LAG_CHECK_INTERVAL:
         try:
-            _ENGINE = sqlalchemy.create_engine(sql_connection, **engine_args)
-
-            if 'mysql' in connection_dict.drivername:
-                sqlalchemy.event.listen(_ENGINE, 'checkout', ping_listener)
-
-            if CONF.log_query_times:
-                sqlalchemy.event.listen(_ENGINE, 'before_cursor_execute',
-                                        _before_cursor_execute())
-                sqlalchemy.event.listen(_ENGINE, 'after_cursor_execute',
-                                        _after_cursor_execute())
-
-            _ENGINE.connect = wrap_db_error(_ENGINE.connect)
-            _ENGINE.connect()
-        except Exception, err:
-            msg = _("Error configuring registry database with supplied "
-                    "sql_connection '%(sql_connection)s'. "
-                    "Got error:\n%(err)s") % locals()
-            LOG.error(msg)
-            raise
-    return _ENGINE
+            lag = _replication_lag(engine)
+        except Exception as e:
+            LOG.warn(_('Could not read the replication lag of the slave '
+                       'database, reading from the primary: %s') % e)
+            lag = None
+
+        if lag is None:
+            usable = False
+        else:
+            metrics.gauge('db.slave.lag', float(lag))
+            usable = lag <= CONF.slave_max_lag
+        if usable != _SLAVE_STATE['usable']:
+            LOG.info(_('Reads %s the slave database')
+                     % ('moved to' if usable else 'moved off'))
+        _SLAVE_STATE.update(checked_at=now, usable=usable)
+
+    return _SLAVE_STATE['usable']
+
+
+def _make_session(autocommit, expire_on_commit, use_slave):
+    engine = getattr(_REQUEST, 'engine', None)
+    if engine is not None:
+        key = (engine, autocommit, expire_on_commit)
+    else:
+        key = (autocommit, expire_on_commit, use_slave)
+    if key not in _MAKERS:
+        if engine is None:
+            engine = _SLAVE_ENGINE if use_slave else _ENGINE
+        assert engine
+        _MAKERS[key] = sa_orm.sessionmaker(bind=engine,
+                                           autocommit=autocommit,
+                                           expire_on_commit=expire_on_commit)
+    return _MAKERS[key]()
+
+
+def get_session(autocommit=True, expire_on_commit=False, use_slave=False):
+    """Helper method to grab session.
+
+    Inside request_scope() the request's session is returned for the
+    default arguments. With use_slave, the session reads from the
+    slave_connection replica while it is within slave_max_lag of the
+    primary; it must only be used for reads. Inside engine_scope() the
+    session is bound to the scope's engine, whatever the arguments.
+    """
+    if getattr(_REQUEST, 'engine', None) is not None:
+        return _make_session(autocommit, expire_on_commit, False)
+
+    use_slave = use_slave and _use_slave()
+    in_scope = getattr(_REQUEST, 'session', None) is not None
+    if in_scope and autocommit and not expire_on_commit:
+        if not use_slave:
+            return _REQUEST.session
+        if getattr(_REQUEST, 'slave_session', None) is None:
+            _REQUEST.slave_session = _make_session(autocommit,
+                                                   expire_on_commit, True)
+        return _REQUEST.slave_session
 
+    return _make_session(autocommit, expire_on_commit, use_slave)
 
-def get_session(autocommit=True, expire_on_commit=False):
-    """Helper method to grab session."""
-    global _MAKER
-    if not _MAKER:
-        assert _ENGINE
-        _MAKER = sa_orm.sessionmaker(bind=_ENGINE,
-                                     autocommit=autocommit,
-                                     expire_on_commit=expire_on_commit)
-    return _MAKER()
+
+@contextlib.contextmanager
+def request_scope():
+    """Share one session between the db calls made in the block.
+
+    The session is closed on exit, returning its connection to the pool,
+    and rolled back first if the block raised. Nested scopes use the
+    outer one.
+    """
+    if getattr(_REQUEST, 'session', None) is not None:
+        yield
+        return
+
+    session = get_session()
+    _REQUEST.session = session
+    try:
+        yield
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        _REQUEST.session = None
+        session.close()
+        slave_session = getattr(_REQUEST, 'slave_session', None)
+        if slave_session is not None:
+            _REQUEST.slave_session = None
+            slave_session.close()
+
+
+@contextlib.contextmanager
+def engine_scope(engine):
+    """Run the db calls made in the block on engine instead of the
+    sql_connection one.
+
+    The calls neither read from the replica nor share the session of a
+    request_scope(). Used by the sharded backend to run a call on a shard.
+    """
+    previous = getattr(_REQUEST, 'engine', None)
+    _REQUEST.engine = engine
+    try:
+        yield
+    finally:
+        _REQUEST.engine = previous
 
 
 def is_db_connection_error(args):
@@ -279,10 +707,100 @@ def wrap_db_error(f):
     return _wrap
 
 
+def is_transient_error(error):
+    """Return True if the DBAPIError error is a deadlock, lock wait
+    timeout or serialization failure, after which the transaction can be
+    run again."""
+    orig = getattr(error, 'orig', None)
+    if orig is None:
+        return False
+    pgcode = getattr(orig, 'pgcode', None)
+    if pgcode is not None:
+        return pgcode in _POSTGRESQL_TRANSIENT_ERRORS
+    args = getattr(orig, 'args', ())
+    if args and args[0] in _MYSQL_TRANSIENT_ERRORS:
+        return True
+    return any(message in str(orig) for message in _SQLITE_TRANSIENT_ERRORS)
+
+
+def _in_transaction():
+    session = getattr(_REQUEST, 'session', None)
+    return session is not None and session.transaction is not None
+
+
+def is_first_use_disconnect(error):
+    """Return True if the DBAPIError error is a dead connection found by
+    the first statement run on it since it was checked out, so nothing
+    was done on it."""
+    return (error.connection_invalidated and
+            getattr(error.orig, 'first_use', False))
+
+
+def retry_on_disconnect(func):
+    """Run func once more when a pooled connection it was given was dead.
+
+    The pool was emptied of the dead connections when the disconnect was
+    detected, so the retry runs on a new one. Retries are counted in the
+    db.disconnect_retries metric.
+    """
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except sqlalchemy.exc.DBAPIError as e:
+            if not is_first_use_disconnect(e) or _in_transaction():
+                raise
+
+        LOG.warn(_('%(func)s found a dead database connection, retrying: '
+                   '%(error)s') % {'func': func.__name__, 'error': e})
+        metrics.incr('db.disconnect_retries')
+        return func(*args, **kwargs)
+    return wrapped
+
+
+def retry_on_deadlock(func):
+    """Run func again when its transaction fails with a transient error.
+
+    Up to sql_transaction_retries retries are made, after a backoff drawn
+    at random below sql_transaction_retry_interval doubled on each retry,
+    at most sql_transaction_retry_max_interval. Each retry is counted in
+    the db.transaction_retries metric. Calls inside a transaction begun by
+    the caller are not retried, only the caller can run it again.
+
+    Each attempt is also retried once on a dead connection, as by
+    retry_on_disconnect.
+    """
+    func = retry_on_disconnect(func)
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except sqlalchemy.exc.DBAPIError as e:
+                if (attempt >= CONF.sql_transaction_retries or
+                        not is_transient_error(e) or _in_transaction()):
+                    raise
+
+            interval = min(CONF.sql_transaction_retry_max_interval,
+                           CONF.sql_transaction_retry_interval * 2 ** attempt)
+            attempt += 1
+            LOG.warn(_('%(func)s failed with a transient database error, '
+                       'retry %(attempt)d of %(retries)d: %(error)s')
+                     % {'func': func.__name__, 'attempt': attempt,
+                        'retries': CONF.sql_transaction_retries,
+                        'error': e})
+            metrics.incr('db.transaction_retries')
+            time.sleep(random.uniform(0, interval))
+    return wrapped
+
+
 # Schedule methods
 
 
-@force_dict
+@profiler.profiled
+@retry_on_deadlock
 def schedule_create(schedule_values):
     db_utils.validate_schedule_values(schedule_values)
     # make a copy so we can remove 'schedule_metadata'
@@ -294,31 +812,69 @@ def schedule_create(schedule_values):
 
     if 'schedule_metadata' in values:
         metadata = values['schedule_metadata']
-        _set_schedule_metadata(schedule_ref, metadata)
+        _set_metadata(schedule_ref, metadata)
         del values['schedule_metadata']
 
     schedule_ref.update(values)
     schedule_ref.save(session=session)
 
-    return _schedule_get_by_id(schedule_ref['id'])
+    return _ref_to_dict(schedule_ref, 'schedule_metadata')
+
+
+def _after_criterion(column, value, sort_dir):
+    """Return the criterion for column values sorting after value.
+
+    NULL sorts first ascending and last descending, as on MySQL and SQLite.
+    """
+    if sort_dir == 'asc':
+        if value is None:
+            return column != None
+        return column > value
+
+    if value is None:
+        return sa_sql.false()
+    if column.nullable:
+        return sa_sql.or_(column < value, column == None)
+    return column < value
+
+
+def _bound_criterion(column, value, sort_dir):
+    """Return the range of column values at or after value, if any.
+
+    It repeats the leading term of the keyset criteria in a form the
+    database can read as an index range.
+    """
+    if sort_dir == 'asc':
+        if value is None:
+            return None
+        return column >= value
+
+    if value is None:
+        return column == None
+    if column.nullable:
+        return sa_sql.or_(column <= value, column == None)
+    return column <= value
 
 
-def paginate_query(query, model, sort_keys, limit=None, marker=None):
+def paginate_query(query, model, sort_keys, limit=None, marker=None,
+                   sort_dirs=None, marker_values=None):
     """
     Returns a query with sorting and(or) pagination criteria added.
 
     Pagination works by requiring a unique sort_key, specified by sort_keys.
     (If sort_keys is not unique, then we risk looping through values.)
-    We use the last row in the previous page as the 'marker' for pagination.
-    So we must return values that follow the passed marker in the order.
-    With a single-valued sort_key, this would be easy: sort_key > X.
-    With a compound-values sort_key, (k1, k2, k3) we must do this to repeat
-    the lexicographical ordering:
+    We use the sort key values of the last row in the previous page as the
+    marker for pagination. So we must return values that follow them in
+    the order. With a single-valued sort_key, this would be easy:
+    sort_key > X. With a compound-values sort_key, (k1, k2, k3) we must do
+    this to repeat the lexicographical ordering:
     (k1 > X1) or (k1 == X1 && k2 > X2) or (k1 == X1 && k2 == X2 && k3 > X3)
+    with > replaced by < for the keys sorted descending. k1 >= X1 is added
+    as well so the rows are read as a range of an index on the sort keys,
+    and a page costs the same however deep into the results it is.
 
-    Typically, the id of the last row is used as the client-facing pagination
-    marker, then the actual marker object must be fetched from the db and
-    passed in to us as marker.
+    The marker values are either taken from a cursor, or from the row of
+    the previous page passed in as marker.
 
     :param query: the query object to which we should add paging/sorting
     :param model: the ORM model class
@@ -326,55 +882,448 @@ def paginate_query(query, model, sort_keys, limit=None, marker=None):
     :param limit: maximum number of items to return
     :param marker: the last item of the previous page; we returns the next
                     results after this value.
+    :param sort_dirs: 'asc' or 'desc' for each of sort_keys, ascending by
+                      default
+    :param marker_values: the sort key values of the last item of the
+                          previous page, used instead of marker
 
     :rtype: sqlalchemy.orm.query.Query
     :return: The query with sorting and(or) pagination added.
     """
-    # Note(nikhil): Curently pagination does not support sort directions. By
-    # default the items are sorted in ascending order.
-    for sort_key in sort_keys:
+    if sort_dirs is None:
+        sort_dirs = ['asc'] * len(sort_keys)
+
+    columns = []
+    for sort_key, sort_dir in zip(sort_keys, sort_dirs):
         try:
-            sort_key_attr = getattr(model, sort_key)
-        except AttributeError:
+            column = model.__table__.c[sort_key]
+        except KeyError:
             raise exception.InvalidSortKey()
-        query = query.order_by(sqlalchemy.asc(sort_key_attr))
+        columns.append(column)
+        if sort_dir == 'desc':
+            query = query.order_by(sqlalchemy.desc(column))
+        else:
+            query = query.order_by(sqlalchemy.asc(column))
 
-    if marker is not None:
-        marker_values = []
-        for sort_key in sort_keys:
-            v = getattr(marker, sort_key)
-            marker_values.append(v)
+    if marker_values is None and marker is not None:
+        marker_values = [getattr(marker, sort_key) for sort_key in sort_keys]
 
-    # Note(nikhil): the underlying code only supports asc order of sort_dir
-    # at the moment. However, more than one sort_keys could be supplied.
+    if marker_values is not None:
         criteria_list = []
         for i in xrange(0, len(sort_keys)):
             crit_attrs = []
             for j in xrange(0, i):
-                model_attr = getattr(model, sort_keys[j])
-                crit_attrs.append((model_attr == marker_values[j]))
-            model_attr = getattr(model, sort_keys[i])
-            crit_attrs.append((model_attr > marker_values[i]))
+                if marker_values[j] is None:
+                    crit_attrs.append(columns[j] == None)
+                else:
+                    crit_attrs.append(columns[j] == marker_values[j])
+            crit_attrs.append(_after_criterion(columns[i], marker_values[i],
+                                               sort_dirs[i]))
             criteria = sa_sql.and_(*crit_attrs)
             criteria_list.append(criteria)
 
         f = sa_sql.or_(*criteria_list)
         query = query.filter(f)
 
+        bound = _bound_criterion(columns[0], marker_values[0], sort_dirs[0])
+        if bound is not None:
+            query = query.filter(bound)
+
     if limit is not None:
         query = query.limit(limit)
 
     return query
 
 
-@force_dict
-def schedule_get_all(filter_args={}):
+def _paginate_list(session, query, model, resource, params):
+    """Sort and paginate a list query by its limit, cursor or marker.
+
+    A marker, the id of the last row of the previous page, is still
+    accepted in place of a cursor at the cost of reading that row.
+    """
+    sort_keys, sort_dirs, marker_values = db_utils.get_sort_params(resource,
+                                                                  params)
+    if marker_values is None and params.get('marker') is not None:
+        marker_row = _project_by_id(session, model, params['marker'])
+        marker_values = [marker_row[sort_key] for sort_key in sort_keys]
+
+    return paginate_query(query, model, sort_keys, limit=params.get('limit'),
+                          sort_dirs=sort_dirs, marker_values=marker_values)
+
+
+# NOTE: The maximum number of ids in one IN clause; SQLite allows 999
+# bound parameters per statement.
+_IN_CHUNK_SIZE = 500
+
+# NOTE: The models with metadata, with their metadata model, the key of
+# the parent in it and the name of their metadata.
+_METADATA = {
+    models.Schedule: (models.ScheduleMetadata, 'schedule_id',
+                      'schedule_metadata'),
+    models.Job: (models.JobMetadata, 'job_id', 'job_metadata'),
+}
+
+
+def _project(session, query):
+    """Return the rows of an entity query as plain dicts.
+
+    The query's statement is run through Core, skipping the ORM identity
+    map and object construction, so this is much cheaper than force_dict.
+    """
+    return [dict(row.items()) for row in session.execute(query.statement)]
+
+
+# NOTE: The statements of the hot queries, built on first use and compiled
+# once per dialect rather than on every call. SQLAlchemy 0.7 has no baked
+# queries, so these are Core statements with bound parameters.
+_STATEMENTS = {}
+_COMPILED = {}
+
+
+def _execute_cached(session, name, build, params):
+    """Execute the statement build returns, cached under name.
+
+    The statement runs on the session's connection, in its transaction if
+    one is open. ORM instances can be made from the result with
+    Query.instances.
+    """
+    statement = _STATEMENTS.get(name)
+    if statement is None:
+        statement = _STATEMENTS[name] = build()
+
+    connection = session.connection(close_with_result=True)
+    key = (name, connection.dialect)
+    compiled = _COMPILED.get(key)
+    if compiled is None:
+        compiled = _COMPILED[key] = statement.compile(
+            dialect=connection.dialect)
+    return connection.execute(compiled, params)
+
+
+def _by_id_statement(model, collection=None, lock=False):
+    """Select a row by its id, with the rows of collection outer joined.
+
+    A statement with a collection cannot lock: PostgreSQL rejects FOR
+    UPDATE on the nullable side of an outer join.
+    """
+    assert not (lock and collection is not None)
+    table = model.__table__
+    id_param = sa_sql.bindparam('id', type_=table.c.id.type)
+    if collection is None:
+        statement = sa_sql.select([table]).where(table.c.id == id_param)
+    else:
+        prop = sa_orm.class_mapper(model).get_property(collection)
+        statement = sa_sql.select([table, prop.target],
+                                  from_obj=table.outerjoin(prop.target,
+                                                           prop.primaryjoin))\
+            .where(table.c.id == id_param)\
+            .apply_labels()
+    statement.for_update = lock
+    return statement
+
+
+def _execute_by_id(session, model, row_id, collection=None, lock=False):
+    if lock and collection is not None:
+        # NOTE: Only the row of model is locked, by a statement of its own,
+        # then it is read again with its collection. The collection is
+        # only changed under the lock of its parent.
+        _execute_by_id(session, model, row_id, lock=True).close()
+        lock = False
+
+    name = '%s_by_id' % model.__tablename__
+    if collection is not None:
+        name += '_with_%s' % collection
+    if lock:
+        name += '_for_update'
+    return _execute_cached(session, name,
+                           lambda: _by_id_statement(model, collection, lock),
+                           {'id': row_id})
+
+
+def _project_by_id(session, model, row_id, collection=None, lock=False):
+    """Return a row as a dict, with the metadata in collection as a list of
+    dicts under its name, in one cached query.
+
+    With lock, the row is read FOR UPDATE.
+    """
+    json_metadata = collection is not None and _json_metadata()
+    join = None if json_metadata else collection
+    rows = _execute_by_id(session, model, row_id, join, lock).fetchall()
+    if not rows:
+        raise exception.NotFound()
+
+    table = model.__table__
+    item = dict((column.name, rows[0][column]) for column in table.c)
+    metadata_json = item.pop('metadata_json', None)
+    if json_metadata:
+        parent_key = _METADATA[model][1]
+        item[collection] = models.metadata_from_json(metadata_json,
+                                                     parent_key, row_id)
+    elif collection is not None:
+        target = sa_orm.class_mapper(model).get_property(collection).target
+        item[collection] = [dict((column.name, row[column])
+                                 for column in target.c)
+                            for row in rows if row[target.c.id] is not None]
+    return item
+
+
+def _instance_by_id(session, model, row_id, collection=None, lock=False):
+    """Return the ORM instance of a row in one cached query.
+
+    The metadata in collection is loaded along with it, unless it is
+    stored as JSON. With lock, the row is read FOR UPDATE.
+    """
+    if collection is not None and _json_metadata():
+        collection = None
+    query = session.query(model)
+    if collection is not None:
+        query = query.options(sa_orm.contains_eager(collection))
+    instances = list(query.instances(_execute_by_id(session, model, row_id,
+                                                    collection, lock)))
+    if not instances:
+        raise exception.NotFound()
+    return instances[0]
+
+
+def _json_metadata():
+    """Return True if metadata is stored in the metadata_json columns."""
+    storage = CONF.metadata_storage
+    if storage not in METADATA_STORAGES:
+        msg = _('Invalid metadata_storage %(storage)s, must be one of '
+                '%(choices)s') % {'storage': storage,
+                                  'choices': ', '.join(METADATA_STORAGES)}
+        raise exception.QonosException(msg)
+    return storage == 'json'
+
+
+def _indexed_metadata(model, metadata):
+    """Return copies of the items of metadata that are also kept in the
+    metadata table with json storage."""
+    if model is not models.Schedule:
+        return []
+    keys = CONF.indexed_metadata_keys
+    return [dict(meta) for meta in metadata if meta['key'] in keys]
+
+
+def _attach_metadata(session, rows, meta_model, parent_key, key):
+    """Add the metadata of each row as a list of dicts under key.
+
+    All the metadata is fetched with one IN query per chunk of rows.
+    """
+    rows_by_id = {}
+    for row in rows:
+        row[key] = []
+        rows_by_id[row['id']] = row
+
+    table = meta_model.__table__
+    ids = rows_by_id.keys()
+    for i in xrange(0, len(ids), _IN_CHUNK_SIZE):
+        query = sa_sql.select([table])\
+            .where(table.c[parent_key].in_(ids[i:i + _IN_CHUNK_SIZE]))
+        for meta_row in session.execute(query):
+            meta = dict(meta_row.items())
+            rows_by_id[meta[parent_key]][key].append(meta)
+
+    return rows
+
+
+def _with_metadata(session, model, rows):
+    """Add the metadata of each row of model as a list of dicts."""
+    meta_model, parent_key, key = _METADATA[model]
+    json_metadata = _json_metadata()
+    for row in rows:
+        metadata_json = row.pop('metadata_json', None)
+        if json_metadata:
+            row[key] = models.metadata_from_json(metadata_json, parent_key,
+                                                 row['id'])
+
+    if json_metadata:
+        return rows
+    return _attach_metadata(session, rows, meta_model, parent_key, key)
+
+
+def _merge_metadata(parent_key, parent_id, existing, metadata):
+    """Return the items of metadata as the new metadata of a parent.
+
+    existing is the current metadata of the parent; the items of keys
+    whose value is unchanged are kept as they are. The items that are new
+    or changed are returned as well.
+    """
+    now = timeutils.utcnow()
+    new_values = {}
+    keys = []
+    for item in metadata:
+        if item['key'] not in new_values:
+            keys.append(item['key'])
+        new_values[item['key']] = item['value']
+
+    existing = dict((meta['key'], meta) for meta in existing)
+    result = []
+    changed = []
+    for key in keys:
+        value = new_values[key]
+        meta = existing.get(key)
+        if meta is not None and meta['value'] == value:
+            result.append(meta)
+            continue
+
+        if meta is None:
+            meta = {'id': uuidutils.generate_uuid(), parent_key: parent_id,
+                    'key': key, 'created_at': now}
+        meta = dict(meta, value=value, updated_at=now)
+        changed.append(meta)
+        result.append(meta)
+    return result, changed
+
+
+def _write_metadata_rows(session, meta_model, parent_key, parent_id,
+                         existing, result, changed):
+    """Write the change of a parent's metadata from existing to result to
+    its metadata rows.
+
+    The keys dropped are removed with one DELETE and the changed items
+    written with one multi-row upsert. Where upserts are not supported the
+    changed items already present are updated one by one and the new ones
+    inserted with one INSERT, which is safe under the lock of the parent.
+    """
+    table = meta_model.__table__
+    keys = [meta['key'] for meta in result]
+    if set(meta['key'] for meta in existing) - set(keys):
+        delete = table.delete().where(table.c[parent_key] == parent_id)
+        if keys:
+            delete = delete.where(~table.c.key.in_(keys))
+        session.execute(delete)
+
+    if changed:
+        update_columns = ['value', 'updated_at']
+        if 'value_hash' in table.c:
+            update_columns.append('value_hash')
+            for meta in changed:
+                meta['value_hash'] = models.metadata_value_hash(
+                    meta['value'])
+        if _upsert_supported(session.get_bind().dialect):
+            session.execute(Upsert(table, changed, (parent_key, 'key'),
+                                   update_columns))
+            return
+
+        existing_keys = set(meta['key'] for meta in existing)
+        for meta in changed:
+            if meta['key'] in existing_keys:
+                update = table.update().where(
+                    table.c[parent_key] == parent_id).where(
+                        table.c.key == meta['key'])
+                session.execute(update.values(
+                    dict((name, meta[name]) for name in update_columns)))
+        inserts = [meta for meta in changed
+                   if meta['key'] not in existing_keys]
+        if inserts:
+            session.execute(table.insert(), inserts)
+
+
+def _replace_metadata(session, model, parent_id, existing, metadata):
+    """Make metadata the whole metadata of a job or schedule and return it
+    as dicts.
+
+    existing is the current metadata of the parent. Only what changed is
+    written, so the result is known without reading it back.
+    """
+    meta_model, parent_key, _key = _METADATA[model]
+    result, changed = _merge_metadata(parent_key, parent_id, existing,
+                                      metadata)
+    if not _json_metadata():
+        _write_metadata_rows(session, meta_model, parent_key, parent_id,
+                             existing, result, changed)
+        return result
+
+    if changed or len(result) != len(existing):
+        # NOTE: As with metadata rows, changing the metadata does not
+        # change the parent's updated_at.
+        table = model.__table__
+        session.execute(table.update()
+                        .where(table.c.id == parent_id)
+                        .values(metadata_json=models.metadata_to_json(result),
+                                updated_at=table.c.updated_at))
+        _write_metadata_rows(session, meta_model, parent_key, parent_id,
+                             _indexed_metadata(model, existing),
+                             _indexed_metadata(model, result),
+                             _indexed_metadata(model, changed))
+    return result
+
+
+def _set_metadata(ref, metadata):
+    """Give a new job or schedule its metadata, written when it is saved."""
+    meta_model, parent_key, key = _METADATA[type(ref)]
+    if _json_metadata():
+        now = timeutils.utcnow()
+        items = [dict(metadatum, id=uuidutils.generate_uuid(),
+                      created_at=now, updated_at=now)
+                 for metadatum in metadata]
+        ref.metadata_json = models.metadata_to_json(items)
+        metadata = _indexed_metadata(type(ref), items)
+
+    for metadatum in metadata:
+        metadata_ref = meta_model()
+        # NOTE: With the ids known before the flush the ORM inserts all
+        # the metadata in one executemany.
+        metadata_ref.id = metadatum.get('id') or uuidutils.generate_uuid()
+        metadata_ref.update(metadatum)
+        ref[key].append(metadata_ref)
+
+
+def _ref_to_dict(ref, metadata_key=None):
+    """Return the state of a model instance, and its metadata, as dicts.
+
+    Used after a flush to return what was written without reading it back.
+    """
+    values = dict((column.name, getattr(ref, column.name))
+                  for column in ref.__table__.columns)
+    metadata_json = values.pop('metadata_json', None)
+    if metadata_key is not None:
+        if _json_metadata():
+            parent_key = _METADATA[type(ref)][1]
+            values[metadata_key] = models.metadata_from_json(
+                metadata_json, parent_key, ref.id)
+        else:
+            values[metadata_key] = [_ref_to_dict(meta)
+                                    for meta in ref[metadata_key]]
+    return values
+
+
+def _json_meta_create(model, parent_id, values):
+    """Add one metadata item to the metadata_json of a job or schedule."""
+    collection = _METADATA[model][2]
     session = get_session()
-    query = session.query(models.Schedule)\
-                   .options(sa_orm.joinedload_all(
-                            models.Schedule.schedule_metadata))
+    with session.begin():
+        existing = _project_by_id(session, model, parent_id, collection,
+                                  lock=True)[collection]
+        if values['key'] in [meta['key'] for meta in existing]:
+            raise exception.Duplicate()
+        result = _replace_metadata(session, model, parent_id, existing,
+                                   existing + [values])
+    return result[-1]
+
+
+def _json_meta_delete(model, parent_id, key):
+    """Remove one metadata item from the metadata_json of a job or
+    schedule."""
+    collection = _METADATA[model][2]
+    session = get_session()
+    with session.begin():
+        existing = _project_by_id(session, model, parent_id, collection,
+                                  lock=True)[collection]
+        remaining = [meta for meta in existing if meta['key'] != key]
+        if len(remaining) == len(existing):
+            raise exception.NotFound()
+        _replace_metadata(session, model, parent_id, existing, remaining)
+
+
+@profiler.profiled
+@retry_on_disconnect
+def schedule_get_all(filter_args={}):
+    session = get_session(use_slave=True)
+    query = session.query(models.Schedule)
     SCHEDULE_BASE_FILTERS = ['next_run_after', 'next_run_before', 'tenant',
-                             'limit', 'marker', 'action']
+                             'action'] + db_utils.PAGINATION_PARAMS
 
     if 'next_run_after' in filter_args:
         query = query.filter(
@@ -395,56 +1344,88 @@ def schedule_get_all(filter_args={}):
 
     for filter_key in filter_args.keys():
         if filter_key not in SCHEDULE_BASE_FILTERS:
-            query = query.filter(models.Schedule.schedule_metadata.any(
-                                 key=filter_key,
-                                 value=filter_args[filter_key]))
+            query = query.filter(_schedule_metadata_filter(
+                session, filter_key, filter_args[filter_key]))
 
-    marker_schedule = None
-    if filter_args.get('marker') is not None:
-        marker_schedule = _schedule_get_by_id(filter_args['marker'])
+    query = _paginate_list(session, query, models.Schedule, 'schedules',
+                           filter_args)
 
-    query = paginate_query(query, models.Schedule, ['id'],
-                           limit=filter_args.get('limit'),
-                           marker=marker_schedule)
+    return _with_metadata(session, models.Schedule, _project(session, query))
 
-    return query.all()
 
+def _schedule_metadata_filter(session, key, value):
+    """Return the criterion of the schedules with metadata key set to
+    value.
 
-def _schedule_get_by_id(schedule_id, session=None):
-    session = session or get_session()
-    try:
-        schedule = session.query(models.Schedule)\
-                          .options(sa_orm.joinedload_all('schedule_metadata'))\
-                          .filter_by(id=schedule_id)\
-                          .one()
-    except sa_orm.exc.NoResultFound:
-        raise exception.NotFound()
+    With json storage, keys that are not in indexed_metadata_keys are
+    matched in the metadata_json text of every schedule.
+    """
+    if _json_metadata() and key not in CONF.indexed_metadata_keys:
+        pattern = models.metadata_json_pattern(key, value)
+        for char in '!%_':
+            pattern = pattern.replace(char, '!' + char)
+        return models.Schedule.metadata_json.like('%%%s%%' % pattern,
+                                                  escape='!')
+    return models.Schedule.id.in_(_schedule_ids_by_metadata(session, key,
+                                                            value))
 
-    return schedule
 
+def _schedule_ids_by_metadata(session, key, value):
+    """Return a subquery of the ids of the schedules with key set to value.
 
-@force_dict
+    The rows are found through schedule_metadata_value_idx; comparing value
+    as well rules out hash collisions.
+    """
+    meta = models.ScheduleMetadata
+    return session.query(meta.schedule_id)\
+                  .filter(meta.key == key)\
+                  .filter(meta.value_hash ==
+                          models.metadata_value_hash(value))\
+                  .filter(meta.value == value)\
+                  .subquery()
+
+
+def _schedule_get_by_id(schedule_id, session=None, lock=False):
+    session = session or get_session()
+    return _instance_by_id(session, models.Schedule, schedule_id,
+                           'schedule_metadata', lock)
+
+
+@profiler.profiled
+@retry_on_disconnect
 def schedule_get_by_id(schedule_id):
-    return _schedule_get_by_id(schedule_id)
+    session = get_session(use_slave=True)
+    return _project_by_id(session, models.Schedule, schedule_id,
+                          'schedule_metadata')
 
 
-@force_dict
+@profiler.profiled
+@retry_on_deadlock
 def schedule_update(schedule_id, schedule_values):
     # make a copy so we can remove 'schedule_metadata'
     # without affecting the caller
     values = schedule_values.copy()
+    metadata = values.pop('schedule_metadata', None)
     session = get_session()
-    schedule_ref = _schedule_get_by_id(schedule_id, session)
-
-    if 'schedule_metadata' in values:
-        metadata = values.pop('schedule_metadata')
-        _schedule_metadata_update_in_place(schedule_ref, metadata)
-
-    schedule_ref.update(values)
-    schedule_ref.save(session=session)
-    return _schedule_get_by_id(schedule_id)
+    with session.begin():
+        schedule_ref = _schedule_get_by_id(schedule_id, session,
+                                           lock=metadata is not None)
+        existing = _ref_to_dict(schedule_ref,
+                                'schedule_metadata')['schedule_metadata']
+        schedule_ref.update(values)
+        session.flush()
+
+        if metadata is not None:
+            existing = _replace_metadata(session, models.Schedule,
+                                         schedule_id, existing, metadata)
+
+    schedule = _ref_to_dict(schedule_ref)
+    schedule['schedule_metadata'] = existing
+    return schedule
 
 
+@profiler.profiled
+@retry_on_deadlock
 def schedule_test_and_set_next_run(schedule_id, expected_next_run, next_run):
     session = get_session()
     if expected_next_run:
@@ -459,45 +1440,24 @@ def schedule_test_and_set_next_run(schedule_id, expected_next_run, next_run):
         raise exception.NotFound()
 
 
-def _schedule_metadata_update_in_place(schedule, metadata):
-    new_meta = {}
-    for item in metadata:
-        new_meta[item['key']] = item['value']
-    to_delete = []
-    for meta in schedule.schedule_metadata:
-        if not meta['key'] in new_meta:
-            to_delete.append(meta)
-        else:
-            meta['value'] = new_meta[meta['key']]
-            del new_meta[meta['key']]
-
-    for key, value in new_meta.iteritems():
-        meta_ref = models.ScheduleMetadata()
-        meta_ref.key = key
-        meta_ref.value = value
-        schedule.schedule_metadata.append(meta_ref)
-
-    for meta in to_delete:
-        schedule['schedule_metadata'].remove(meta)
-
-
+@profiler.profiled
+@retry_on_deadlock
 def schedule_delete(schedule_id):
     session = get_session()
     schedule_ref = _schedule_get_by_id(schedule_id, session)
     schedule_ref.delete(session=session)
 
 
-def _set_schedule_metadata(schedule_ref, metadata):
-    for metadatum in metadata:
-        metadata_ref = models.ScheduleMetadata()
-        metadata_ref.update(metadatum)
-        schedule_ref.schedule_metadata.append(metadata_ref)
-
 # Schedule Metadata methods
 
 
+@profiler.profiled
+@retry_on_deadlock
 @force_dict
 def schedule_meta_create(schedule_id, values):
+    if _json_metadata():
+        return _json_meta_create(models.Schedule, schedule_id, values)
+
     session = get_session()
     _schedule_get_by_id(schedule_id, session)
     meta_ref = models.ScheduleMetadata()
@@ -512,9 +1472,19 @@ def schedule_meta_create(schedule_id, values):
     return _schedule_meta_get(schedule_id, values['key'])
 
 
+@profiler.profiled
+@retry_on_disconnect
 @force_dict
 def schedule_meta_get_all(schedule_id):
-    session = get_session()
+    if _json_metadata():
+        return _project_by_id(get_session(use_slave=True), models.Schedule,
+                              schedule_id,
+                              'schedule_metadata')['schedule_metadata']
+    return _schedule_meta_get_all(schedule_id,
+                                  get_session(use_slave=True))
+
+
+def _schedule_meta_get_all(schedule_id, session):
     _schedule_get_by_id(schedule_id, session)
     query = session.query(models.ScheduleMetadata)\
                    .filter_by(schedule_id=schedule_id)
@@ -549,18 +1519,25 @@ def _schedule_meta_update(schedule_id, key, values):
     return meta_ref
 
 
+@profiler.profiled
+@retry_on_deadlock
 @force_dict
 def schedule_metadata_update(schedule_id, values):
     session = get_session()
-    schedule = _schedule_get_by_id(schedule_id, session)
-    _schedule_metadata_update_in_place(schedule, values)
-
-    schedule.save(session=session)
-
-    return schedule_meta_get_all(schedule_id)
+    with session.begin():
+        existing = _project_by_id(session, models.Schedule, schedule_id,
+                                  'schedule_metadata',
+                                  lock=True)['schedule_metadata']
+        return _replace_metadata(session, models.Schedule, schedule_id,
+                                 existing, values)
 
 
+@profiler.profiled
+@retry_on_deadlock
 def schedule_meta_delete(schedule_id, key):
+    if _json_metadata():
+        return _json_meta_delete(models.Schedule, schedule_id, key)
+
     session = get_session()
     _schedule_get_by_id(schedule_id, session)
     meta_ref = _schedule_meta_get(schedule_id, key, session)
@@ -570,48 +1547,42 @@ def schedule_meta_delete(schedule_id, key):
 # Worker methods
 
 
-@force_dict
+@profiler.profiled
+@retry_on_disconnect
 def worker_get_all(params={}):
-    session = get_session()
+    session = get_session(use_slave=True)
     query = session.query(models.Worker)
 
-    marker_worker = None
-    if params.get('marker') is not None:
-        marker_worker = _worker_get_by_id(params['marker'])
+    query = _paginate_list(session, query, models.Worker, 'workers', params)
 
-    query = paginate_query(query, models.Worker, ['id'],
-                           limit=params.get('limit'), marker=marker_worker)
-
-    return query.all()
+    return _project(session, query)
 
 
-@force_dict
+@profiler.profiled
+@retry_on_deadlock
 def worker_create(values):
     session = get_session()
     worker_ref = models.Worker()
     worker_ref.update(values)
     worker_ref.save(session=session)
 
-    return _worker_get_by_id(worker_ref['id'])
+    return _ref_to_dict(worker_ref)
 
 
-def _worker_get_by_id(worker_id):
-    session = get_session()
-    query = session.query(models.Worker).filter_by(id=worker_id)
-
-    try:
-        worker = query.one()
-    except sa_orm.exc.NoResultFound:
-        raise exception.NotFound
-
-    return worker
+def _worker_get_by_id(worker_id, session=None):
+    session = session or get_session()
+    return _instance_by_id(session, models.Worker, worker_id)
 
 
-@force_dict
+@profiler.profiled
+@retry_on_disconnect
 def worker_get_by_id(worker_id):
-    return _worker_get_by_id(worker_id)
+    session = get_session(use_slave=True)
+    return _project_by_id(session, models.Worker, worker_id)
 
 
+@profiler.profiled
+@retry_on_deadlock
 def worker_delete(worker_id):
     session = get_session()
 
@@ -623,7 +1594,8 @@ def worker_delete(worker_id):
 # Job methods
 
 
-@force_dict
+@profiler.profiled
+@retry_on_deadlock
 def job_create(job_values):
     db_utils.validate_job_values(job_values)
     values = job_values.copy()
@@ -632,13 +1604,56 @@ def job_create(job_values):
 
     if 'job_metadata' in values:
         metadata = values['job_metadata']
-        _set_job_metadata(job_ref, metadata)
+        _set_metadata(job_ref, metadata)
         del values['job_metadata']
 
     job_ref.update(values)
     job_ref.save(session=session)
 
-    return _job_get_by_id(job_ref['id'])
+    return _ref_to_dict(job_ref, 'job_metadata')
+
+
+@profiler.profiled
+@retry_on_deadlock
+def job_create_from_schedule(schedule_id, expected_next_run=None,
+                             job_values=None, timeout_seconds=None):
+    """Create the next job of a schedule and advance the schedule.
+
+    Runs in one transaction holding the schedule's row lock, so the
+    schedule never moves on without its job being created. Raises
+    Conflict if expected_next_run is given and the schedule's next_run
+    differs.
+    """
+    now = timeutils.utcnow()
+    session = get_session()
+    with session.begin():
+        try:
+            schedule_ref = session.query(models.Schedule)\
+                                  .filter_by(id=schedule_id)\
+                                  .with_lockmode('update')\
+                                  .one()
+        except sa_orm.exc.NoResultFound:
+            raise exception.NotFound()
+
+        if expected_next_run and schedule_ref.next_run != expected_next_run:
+            raise exception.Conflict()
+
+        schedule = _ref_to_dict(schedule_ref, 'schedule_metadata')
+        values = db_utils.job_values_from_schedule(schedule, now, job_values,
+                                                   timeout_seconds)
+        db_utils.validate_job_values(values)
+
+        schedule_ref.update({
+            'next_run': db_utils.next_run_from_schedule(schedule, now),
+            'last_scheduled': now})
+
+        job_ref = models.Job()
+        _set_metadata(job_ref, values.pop('job_metadata'))
+        job_ref.update(values)
+        session.add(job_ref)
+        session.flush()
+
+    return _ref_to_dict(job_ref, 'job_metadata')
 
 
 def _filter_query_on_attributes(query, params, model, allowed_filters):
@@ -651,11 +1666,11 @@ def _filter_query_on_attributes(query, params, model, allowed_filters):
     return query
 
 
-@force_dict
+@profiler.profiled
+@retry_on_disconnect
 def job_get_all(params={}):
-    session = get_session()
-    query = session.query(models.Job)\
-                   .options(sa_orm.subqueryload('job_metadata'))
+    session = get_session(use_slave=True)
+    query = session.query(models.Job)
     JOB_BASE_FILTERS = ['schedule_id',
                         'tenant',
                         'action',
@@ -669,43 +1684,74 @@ def job_get_all(params={}):
                                         models.Job,
                                         JOB_BASE_FILTERS)
 
-    marker_job = None
-    if params.get('marker') is not None:
-        marker_job = _job_get_by_id(params['marker'])
+    query = _paginate_list(session, query, models.Job, 'jobs', params)
 
-    query = paginate_query(query, models.Job, ['id'],
-                           limit=params.get('limit'), marker=marker_job)
+    return _with_metadata(session, models.Job, _project(session, query))
 
-    return query.all()
 
+@profiler.profiled
+@retry_on_disconnect
+def job_stats(tenant=None):
+    """Count the jobs by action and status, and the claimable ones and the
+    oldest of those by action, with two GROUP BY queries."""
+    session = get_session(use_slave=True)
+    now = timeutils.utcnow().replace(second=0, microsecond=0)
+    Job = models.Job
 
-def _job_get_by_id(job_id, session=None):
-    session = session or get_session()
-    try:
-        job = session.query(models.Job)\
-                     .options(sa_orm.subqueryload('job_metadata'))\
-                     .filter_by(id=job_id)\
-                     .one()
-    except sa_orm.exc.NoResultFound:
-        raise exception.NotFound()
+    status_query = session.query(Job.action, Job.status,
+                                 sa_sql.func.count(Job.id))\
+        .group_by(Job.action, Job.status)
+    claimable_query = session.query(Job.action, sa_sql.func.count(Job.id),
+                                    sa_sql.func.min(Job.updated_at))\
+        .filter(_job_claimable(now))\
+        .group_by(Job.action)
+    if tenant is not None:
+        status_query = status_query.filter(Job.tenant == tenant)
+        claimable_query = claimable_query.filter(Job.tenant == tenant)
 
-    return job
+    return db_utils.job_stats(status_query.all(), claimable_query.all())
 
 
-@force_dict
+def _job_get_by_id(job_id, session=None, lock=False):
+    session = session or get_session()
+    return _instance_by_id(session, models.Job, job_id, 'job_metadata',
+                           lock)
+
+
+@profiler.profiled
+@retry_on_disconnect
 def job_get_by_id(job_id):
-    return _job_get_by_id(job_id)
+    session = get_session(use_slave=True)
+    return _project_by_id(session, models.Job, job_id, 'job_metadata')
 
 
+@profiler.profiled
+@retry_on_disconnect
 def job_updated_at_get_by_id(job_id):
-    return _job_get_by_id(job_id)['updated_at']
+    return _project_by_id(get_session(), models.Job, job_id)['updated_at']
 
 
-@force_dict
+@profiler.profiled
+@retry_on_deadlock
 def job_get_and_assign_next_by_action(action, worker_id, new_timeout):
     """Get the next available job for the given action and assign it
     to the worker for worker_id."""
     now = timeutils.utcnow()
+
+    if _use_skip_locked():
+        try:
+            return _job_assign_next_skip_locked(now, action, worker_id,
+                                                new_timeout)
+        except sqlalchemy.exc.DBAPIError as e:
+            if (CONF.job_claim_strategy != 'auto' or
+                    not _is_syntax_error(e)):
+                raise
+            _disable_skip_locked(e)
+
+    return _job_assign_next_optimistic(now, action, worker_id, new_timeout)
+
+
+def _job_assign_next_optimistic(now, action, worker_id, new_timeout):
     session = get_session()
 
     job_ref = _job_get_next_by_action(session, now, action)
@@ -731,6 +1777,7 @@ def job_get_and_assign_next_by_action(action, worker_id, new_timeout):
         return None
     except sa_orm.exc.StaleDataError:
         # In case the job was picked up by another transaction return nothing
+        metrics.incr('db.job_claim.optimistic.stale')
         LOG.warn(_('[JOB2WORKER] StaleDataError:'
                    ' Could not assign the job to worker_id: %(worker_id)s'
                    ' Job already assigned to another worker,'
@@ -739,35 +1786,135 @@ def job_get_and_assign_next_by_action(action, worker_id, new_timeout):
                     'job_id': job_id})
         return None
 
+    metrics.incr('db.job_claim.optimistic.claimed')
     LOG.info(_('[JOB2WORKER] Assigned Job: %(job_id)s'
                ' To Worker: %(worker_id)s')
              % {'job_id': job_id, 'worker_id': job_values['worker_id']})
 
-    return _job_get_by_id(job_id)
+    return _ref_to_dict(job_ref, 'job_metadata')
 
 
-def _job_get_next_by_action(session, now, action):
+def _job_assign_next_skip_locked(now, action, worker_id, new_timeout):
+    """Claim the next job while holding its row lock.
+
+    Rows locked by other workers' claims are skipped rather than waited
+    on, so concurrent workers each get a different job instead of racing
+    for the oldest one. Returns the claimed job or None.
+    """
+    session = get_session()
+    with session.begin():
+        job_ref = _job_next_by_action(session, now, action,
+                                      skip_locked=True)
+
+        if job_ref is None:
+            return None
+
+        job_ref.update({'worker_id': worker_id,
+                        'timeout': new_timeout,
+                        'retry_count': job_ref['retry_count'] + 1})
+        job_ref.save(session=session)
+        job = _ref_to_dict(job_ref, 'job_metadata')
+
+    metrics.incr('db.job_claim.skip_locked.claimed')
+    LOG.info(_('[JOB2WORKER] Assigned Job: %(job_id)s'
+               ' To Worker: %(worker_id)s')
+             % {'job_id': job['id'], 'worker_id': worker_id})
+    return job
+
+
+def _use_skip_locked():
+    strategy = CONF.job_claim_strategy
+    if strategy not in JOB_CLAIM_STRATEGIES:
+        msg = _('Invalid job_claim_strategy %(strategy)s, must be one of '
+                '%(choices)s') % {'strategy': strategy,
+                                  'choices': ', '.join(JOB_CLAIM_STRATEGIES)}
+        raise exception.QonosException(msg)
+    if strategy != 'auto':
+        return strategy == 'skip_locked'
+
+    global _SKIP_LOCKED_SUPPORTED
+    if _SKIP_LOCKED_SUPPORTED is None:
+        _SKIP_LOCKED_SUPPORTED = _skip_locked_supported(get_engine().dialect)
+        LOG.info(_('Claiming jobs with the %s strategy')
+                 % ('skip_locked' if _SKIP_LOCKED_SUPPORTED
+                    else 'optimistic'))
+    return _SKIP_LOCKED_SUPPORTED
+
+
+def _skip_locked_supported(dialect):
+    """Return True if the server behind dialect understands SKIP LOCKED."""
+    version = tuple(dialect.server_version_info or ())
+    if dialect.name == 'postgresql':
+        return version >= (9, 5)
+    if dialect.name == 'mysql':
+        if 'MariaDB' in version:
+            return version[:2] >= (10, 6)
+        return version[:3] >= (8, 0, 1)
+    return False
+
+
+def _is_syntax_error(e):
+    # NOTE: 1064 is MySQL's ER_PARSE_ERROR, 42601 PostgreSQL's syntax_error
+    orig = getattr(e, 'orig', None)
+    code = getattr(orig, 'pgcode', None)
+    if code is None and getattr(orig, 'args', None):
+        code = orig.args[0]
+    return code in (1064, '42601')
+
+
+def _disable_skip_locked(e):
+    global _SKIP_LOCKED_SUPPORTED
+    _SKIP_LOCKED_SUPPORTED = False
+    LOG.warn(_('Database rejected SELECT ... FOR UPDATE SKIP LOCKED, '
+               'falling back to optimistic job claims: %s') % e)
+
+
+def _job_next_by_action_statement(skip_locked=False):
+    jobs = models.Job.__table__
+    statement = sa_sql.select([jobs])\
+        .where(jobs.c.action == sa_sql.bindparam('action',
+                                                 type_=jobs.c.action.type))\
+        .where(_job_claimable(sa_sql.bindparam('now',
+                                               type_=jobs.c.timeout.type)))\
+        .order_by(jobs.c.updated_at.asc())\
+        .limit(1)
+    if skip_locked:
+        statement.for_update = 'skip_locked'
+    return statement
+
+
+def _job_next_by_action(session, now, action, skip_locked=False):
+    """Return the next job a worker can claim for action, or None.
+
+    With skip_locked the job is locked FOR UPDATE SKIP LOCKED. Its
+    metadata is lazily loaded.
+    """
     # Round off 'now' to minute precision to allow the SQL query cache to
     # do more work
-
-    # Testing showed that lazyload is apparently fastest in our specific
-    # case since we only fetch a single job here and there's only one
-    # child table, hence only two simple queries vs. subqueryload which
-    # issues as second more complex query or joinedload which issues
-    # a single more complex join
     now_round_off = now.replace(second=0, microsecond=0)
-    statuses = ['DONE', 'CANCELLED', 'HARD_TIMED_OUT', 'MAX_RETRIED']
-    job_ref = session.query(models.Job)\
-        .options(sa_orm.lazyload('job_metadata'))\
-        .filter_by(action=action)\
-        .filter(~models.Job.status.in_(statuses))\
-        .filter(sa_sql.or_(models.Job.worker_id.is_(None),
-                           models.Job.timeout <= now_round_off))\
-        .order_by(models.Job.updated_at.asc())\
-        .first()
+    name = 'job_next_by_action'
+    if skip_locked:
+        name += '_skip_locked'
+    result = _execute_cached(
+        session, name,
+        lambda: _job_next_by_action_statement(skip_locked),
+        {'action': action, 'now': now_round_off})
+    instances = list(session.query(models.Job).instances(result))
+    return instances[0] if instances else None
+
+
+def _job_claimable(now):
+    return sa_sql.and_(
+        ~models.Job.status.in_(db_utils.UNCLAIMABLE_JOB_STATUSES),
+        sa_sql.or_(models.Job.worker_id.is_(None),
+                   models.Job.timeout <= now))
+
+
+def _job_get_next_by_action(session, now, action):
+    job_ref = _job_next_by_action(session, now, action)
 
     # Force loading of the job_metadata
-    if job_ref is not None:
+    if job_ref is not None and not _json_metadata():
         m = job_ref['job_metadata']
         LOG.info(_('Job Metatdata forcefully loaded: %s' % m))
 
@@ -786,60 +1933,207 @@ def _jobs_cleanup_hard_timed_out():
     return num_del
 
 
-@force_dict
+def _purgeable_job_ids(session, older_than, batch_size):
+    ids = [row.id for row in session.query(models.Job.id)
+           .filter(models.Job.status.in_(db_utils.PURGEABLE_JOB_STATUSES))
+           .filter(models.Job.updated_at < older_than)
+           .limit(batch_size)]
+
+    # NOTE: Jobs whose hard timeout passed before older_than were
+    # abandoned, whatever their status.
+    if len(ids) < batch_size:
+        for row in session.query(models.Job.id)\
+                .filter(models.Job.hard_timeout < older_than)\
+                .limit(batch_size):
+            if row.id not in ids and len(ids) < batch_size:
+                ids.append(row.id)
+    return ids
+
+
+def _purge_rows(session, table, column, ids, archive):
+    where = table.c[column].in_(ids)
+    if archive:
+        rows = [dict(row.items()) for row in
+                session.execute(sa_sql.select([table]).where(where))]
+        if rows:
+            session.execute(models.SHADOW_TABLES[table.name].insert(), rows)
+    return session.execute(table.delete().where(where)).rowcount
+
+
+@profiler.profiled
+@retry_on_deadlock
+def job_purge_batch(older_than, batch_size, archive=False):
+    """Delete up to batch_size finished jobs last updated before older_than.
+
+    Their metadata goes with them. With archive, the rows are copied to the
+    shadow tables first. Returns the number of rows deleted per table.
+    """
+    session = get_session()
+    with session.begin():
+        ids = _purgeable_job_ids(session, older_than, batch_size)
+        if not ids:
+            return {'jobs': 0, 'job_metadata': 0}
+
+        return {
+            'job_metadata': _purge_rows(session,
+                                        models.JobMetadata.__table__,
+                                        'job_id', ids, archive),
+            'jobs': _purge_rows(session, models.Job.__table__, 'id', ids,
+                                archive),
+        }
+
+
+@profiler.profiled
+@retry_on_deadlock
+def job_fault_purge_batch(older_than, batch_size, archive=False):
+    """Delete up to batch_size job faults created before older_than."""
+    session = get_session()
+    with session.begin():
+        ids = [row.id for row in session.query(models.JobFault.id)
+               .filter(models.JobFault.created_at < older_than)
+               .limit(batch_size)]
+        if not ids:
+            return {'job_faults': 0}
+
+        return {'job_faults': _purge_rows(session,
+                                          models.JobFault.__table__, 'id',
+                                          ids, archive)}
+
+
+def _metadata_to_json_batch(session, model, batch_size):
+    """Move the metadata rows of up to batch_size parents without
+    metadata_json into it. Rows of indexed keys are kept."""
+    meta_model, parent_key, _key = _METADATA[model]
+    table = model.__table__
+    meta_table = meta_model.__table__
+    with session.begin():
+        ids = [row[0] for row in session.execute(
+            sa_sql.select([table.c.id])
+            .where(table.c.metadata_json.is_(None))
+            .limit(batch_size))]
+        if not ids:
+            return 0
+
+        metadata = dict((parent_id, []) for parent_id in ids)
+        for row in session.execute(
+                sa_sql.select([meta_table])
+                .where(meta_table.c[parent_key].in_(ids))
+                .order_by(meta_table.c.created_at)):
+            metadata[row[parent_key]].append(dict(row.items()))
+        for parent_id, items in metadata.iteritems():
+            session.execute(table.update()
+                            .where(table.c.id == parent_id)
+                            .values(metadata_json=models.metadata_to_json(
+                                items),
+                                updated_at=table.c.updated_at))
+
+        delete = meta_table.delete().where(meta_table.c[parent_key].in_(ids))
+        if model is models.Schedule and CONF.indexed_metadata_keys:
+            delete = delete.where(
+                ~meta_table.c.key.in_(CONF.indexed_metadata_keys))
+        session.execute(delete)
+    return len(ids)
+
+
+def _metadata_to_rows_batch(session, model, batch_size):
+    """Move the metadata_json of up to batch_size parents back into
+    metadata rows."""
+    meta_model, parent_key, _key = _METADATA[model]
+    table = model.__table__
+    meta_table = meta_model.__table__
+    with session.begin():
+        rows = session.execute(
+            sa_sql.select([table.c.id, table.c.metadata_json])
+            .where(table.c.metadata_json.isnot(None))
+            .limit(batch_size)).fetchall()
+        if not rows:
+            return 0
+
+        ids = [row[0] for row in rows]
+        items = []
+        for parent_id, metadata_json in rows:
+            items.extend(models.metadata_from_json(metadata_json, parent_key,
+                                                   parent_id))
+        if 'value_hash' in meta_table.c:
+            for meta in items:
+                meta['value_hash'] = models.metadata_value_hash(
+                    meta['value'])
+
+        session.execute(meta_table.delete()
+                        .where(meta_table.c[parent_key].in_(ids)))
+        if items:
+            session.execute(meta_table.insert(), items)
+        session.execute(table.update()
+                        .where(table.c.id.in_(ids))
+                        .values(metadata_json=None,
+                                updated_at=table.c.updated_at))
+    return len(ids)
+
+
+@retry_on_deadlock
+def metadata_backfill(batch_size=500):
+    """Move existing metadata into the storage metadata_storage selects.
+
+    With json storage, the metadata rows of schedules and jobs are written
+    to their metadata_json; with table storage, metadata_json is written
+    back to rows. Runs one transaction per batch_size parents and returns
+    the number of schedules and jobs moved.
+    """
+    if _json_metadata():
+        move_batch = _metadata_to_json_batch
+    else:
+        move_batch = _metadata_to_rows_batch
+
+    session = get_session()
+    counts = {}
+    for model, name in ((models.Schedule, 'schedules'), (models.Job, 'jobs')):
+        counts[name] = 0
+        while True:
+            moved = move_batch(session, model, batch_size)
+            counts[name] += moved
+            if moved < batch_size:
+                break
+    return counts
+
+
+@profiler.profiled
+@retry_on_deadlock
 def job_update(job_id, job_values):
     # make a copy so we can remove 'job_metadata'
     # without affecting the caller
     values = job_values.copy()
+    metadata = values.pop('job_metadata', None)
     session = get_session()
-    job_ref = _job_get_by_id(job_id, session)
-
-    if 'job_metadata' in values:
-        metadata = values.pop('job_metadata')
-        _job_metadata_update_in_place(job_ref, metadata)
-
-    job_ref.update(values)
-    job_ref.save(session=session)
-    return _job_get_by_id(job_id)
-
-
-def _job_metadata_update_in_place(job, metadata):
-    new_meta = {}
-    for item in metadata:
-        new_meta[item['key']] = item['value']
-    to_delete = []
-    for meta in job.job_metadata:
-        if not meta['key'] in new_meta:
-            to_delete.append(meta)
-        else:
-            meta['value'] = new_meta[meta['key']]
-            del new_meta[meta['key']]
+    with session.begin():
+        job_ref = _job_get_by_id(job_id, session, lock=metadata is not None)
+        existing = _ref_to_dict(job_ref, 'job_metadata')['job_metadata']
+        job_ref.update(values)
+        session.flush()
 
-    for key, value in new_meta.iteritems():
-        meta_ref = models.JobMetadata()
-        meta_ref.key = key
-        meta_ref.value = value
-        job.job_metadata.append(meta_ref)
+        if metadata is not None:
+            existing = _replace_metadata(session, models.Job, job_id,
+                                         existing, metadata)
 
-    for meta in to_delete:
-        job['job_metadata'].remove(meta)
+    job = _ref_to_dict(job_ref)
+    job['job_metadata'] = existing
+    return job
 
 
+@profiler.profiled
+@retry_on_deadlock
 def job_delete(job_id):
     session = get_session()
-    job_ref = _job_get_by_id(job_id)
+    job_ref = _job_get_by_id(job_id, session)
     job_ref.delete(session=session)
 
 
-def _set_job_metadata(job_ref, metadata):
-    for metadatum in metadata:
-        metadata_ref = models.JobMetadata()
-        metadata_ref.update(metadatum)
-        job_ref.job_metadata.append(metadata_ref)
-
-
+@profiler.profiled
+@retry_on_deadlock
 @force_dict
 def job_meta_create(job_id, values):
+    if _json_metadata():
+        return _json_meta_create(models.Job, job_id, values)
+
     values['job_id'] = job_id
     session = get_session()
     meta_ref = models.JobMetadata()
@@ -865,8 +2159,8 @@ def _job_meta_get_by_id(meta_id):
     return meta
 
 
-def _job_meta_get_all_by_job_id(job_id):
-    session = get_session()
+def _job_meta_get_all_by_job_id(job_id, session=None):
+    session = session or get_session()
     try:
         meta = session.query(models.JobMetadata)\
                       .filter_by(job_id=job_id)\
@@ -890,24 +2184,36 @@ def _job_meta_get(job_id, key):
     return meta
 
 
+@profiler.profiled
+@retry_on_disconnect
 @force_dict
 def job_meta_get_all_by_job_id(job_id):
-    return _job_meta_get_all_by_job_id(job_id)
+    if _json_metadata():
+        session = get_session(use_slave=True)
+        try:
+            return _project_by_id(session, models.Job, job_id,
+                                  'job_metadata')['job_metadata']
+        except exception.NotFound:
+            return []
+    return _job_meta_get_all_by_job_id(job_id, get_session(use_slave=True))
 
 
+@profiler.profiled
+@retry_on_deadlock
 @force_dict
 def job_metadata_update(job_id, values):
     session = get_session()
-    job = _job_get_by_id(job_id, session)
-    _job_metadata_update_in_place(job, values)
-
-    job.save(session=session)
-
-    return job_meta_get_all_by_job_id(job_id)
+    with session.begin():
+        existing = _project_by_id(session, models.Job, job_id,
+                                  'job_metadata', lock=True)['job_metadata']
+        return _replace_metadata(session, models.Job, job_id, existing,
+                                 values)
 
 
 # Job fault methods
 
+@profiler.profiled
+@retry_on_disconnect
 def job_fault_latest_for_job_id(job_id):
     session = get_session()
     try:
@@ -920,6 +2226,8 @@ def job_fault_latest_for_job_id(job_id):
         return None
 
 
+@profiler.profiled
+@retry_on_deadlock
 @force_dict
 def job_fault_create(values):
     session = get_session()
@@ -0,0 +1,125 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Index report of the current database.
+
+The indexes the models define, which the schedule and job list filters,
+claims, purge and sorts rely on, are compared with the indexes the
+database has. An expected index is covered by any index whose leading
+columns are its columns, whatever its name. Where the database keeps
+statistics, MySQL in performance_schema and PostgreSQL in
+pg_stat_user_indexes, the number of reads of each index is reported so
+that unused ones can be found. Run by `qonos-manage index_report`.
+"""
+
+import sqlalchemy
+from sqlalchemy.engine import reflection
+
+from qonos.db.sqlalchemy import models
+import qonos.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: Reads per index since the server started, or the statistics were
+# reset. The primary keys are left out.
+USAGE_QUERIES = {
+    'mysql': ("SELECT OBJECT_NAME, INDEX_NAME, COUNT_READ "
+              "FROM performance_schema.table_io_waits_summary_by_index_usage "
+              "WHERE OBJECT_SCHEMA = DATABASE() AND INDEX_NAME IS NOT NULL "
+              "AND INDEX_NAME != 'PRIMARY'"),
+    'postgresql': ("SELECT s.relname, s.indexrelname, s.idx_scan "
+                   "FROM pg_stat_user_indexes s JOIN pg_index i "
+                   "ON i.indexrelid = s.indexrelid "
+                   "WHERE NOT i.indisprimary"),
+}
+
+
+def expected_indexes():
+    """Return the indexes the models define, as (table name, index name,
+    columns) sorted by table and name."""
+    expected = []
+    for table in models.BASE.metadata.sorted_tables:
+        for index in table.indexes:
+            expected.append((table.name, index.name,
+                             tuple(column.name for column in index.columns)))
+    return sorted(expected)
+
+
+def database_indexes(engine, table_names):
+    """Return the indexes of the tables of table_names in the database, as
+    a dict of the (index name, columns) of each table."""
+    inspector = reflection.Inspector.from_engine(engine)
+    existing = set(inspector.get_table_names())
+    indexes = {}
+    for table_name in table_names:
+        if table_name not in existing:
+            indexes[table_name] = []
+            continue
+        indexes[table_name] = [(index['name'], tuple(index['column_names']))
+                               for index in inspector.get_indexes(table_name)]
+    return indexes
+
+
+def index_usage(engine):
+    """Return the reads of each index as a dict keyed by (table name,
+    index name), or None when the database keeps no such statistics."""
+    query = USAGE_QUERIES.get(engine.dialect.name)
+    if query is None:
+        return None
+    try:
+        rows = engine.execute(query).fetchall()
+    except sqlalchemy.exc.DBAPIError as e:
+        LOG.warn('Could not read the index statistics: %s' % e)
+        return None
+    return dict(((table_name, index_name), int(reads or 0))
+                for table_name, index_name, reads in rows)
+
+
+def _covers(columns, expected_columns):
+    return columns[:len(expected_columns)] == expected_columns
+
+
+def report(engine):
+    """Return the indexes of the qonos tables of the database behind engine
+    and the expected indexes it is missing.
+
+    :returns: a dict with 'indexes', a list of dicts with the table, name,
+              columns and reads, None when unknown, of each index, and
+              'missing', a list of dicts with the table, name and columns
+              of each expected index no index of the database covers
+    """
+    expected = expected_indexes()
+    table_names = sorted(set(table_name for table_name, _name, _columns
+                             in expected))
+    indexes = database_indexes(engine, table_names)
+    usage = index_usage(engine)
+
+    result = {'indexes': [], 'missing': []}
+    for table_name in table_names:
+        for name, columns in sorted(indexes[table_name]):
+            reads = None
+            if usage is not None:
+                reads = usage.get((table_name, name), 0)
+            result['indexes'].append({'table': table_name, 'name': name,
+                                      'columns': columns, 'reads': reads})
+
+    for table_name, name, expected_columns in expected:
+        if not any(_covers(columns, expected_columns)
+                   for _name, columns in indexes[table_name]):
+            result['missing'].append({'table': table_name, 'name': name,
+                                      'columns': expected_columns})
+    return result
@@ -0,0 +1,60 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import MetaData, Table, Index
+
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: Serves the worker's next job query. action is matched for equality
+# and updated_at gives the ORDER BY, so the oldest candidates are read in
+# index order without a sort; status, worker_id and timeout let the
+# remaining conditions be checked from the index before touching the row.
+INDEX_NAME = 'job_claim_idx'
+INDEX_COLUMNS = ('action', 'updated_at', 'status', 'worker_id', 'timeout')
+
+
+def _has_index(indexes, idx_name):
+    for index in indexes:
+        if idx_name == index.name:
+            return True
+
+    return False
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    jobs = Table('jobs', meta, autoload=True)
+
+    if not _has_index(jobs.indexes, INDEX_NAME):
+        index = Index(INDEX_NAME, *[jobs.c[name] for name in INDEX_COLUMNS])
+        index.create(migrate_engine)
+    else:
+        LOG.info(_('Index %s already exists.') % INDEX_NAME)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    jobs = Table('jobs', meta, autoload=True)
+
+    index = Index(INDEX_NAME, *[jobs.c[name] for name in INDEX_COLUMNS])
+    index.drop(migrate_engine)
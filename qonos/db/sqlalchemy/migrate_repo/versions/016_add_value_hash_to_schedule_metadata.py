@@ -0,0 +1,87 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+
+from sqlalchemy import MetaData, Table, Index
+from sqlalchemy.schema import Column
+from sqlalchemy import select
+
+from qonos.db.sqlalchemy.migrate_repo.schema import String
+
+# NOTE: schedule_metadata.value is a Text column and cannot be indexed, so
+# metadata filters look rows up by key and a hash of the value.
+# schedule_id is included so the matching schedules are read from the
+# index alone.
+INDEX_NAME = 'schedule_metadata_value_idx'
+INDEX_COLUMNS = ('key', 'value_hash', 'schedule_id')
+BATCH_SIZE = 1000
+
+
+def _value_hash(value):
+    # NOTE: Must match qonos.db.sqlalchemy.models.metadata_value_hash.
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return hashlib.sha1(str(value)).hexdigest()
+
+
+def _backfill(migrate_engine, schedule_metadata):
+    while True:
+        rows = migrate_engine.execute(
+            select([schedule_metadata.c.id, schedule_metadata.c.value])
+            .where(schedule_metadata.c.value_hash.is_(None))
+            .limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+
+        for row_id, value in rows:
+            migrate_engine.execute(
+                schedule_metadata.update()
+                .where(schedule_metadata.c.id == row_id)
+                .values(value_hash=_value_hash(value)))
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    schedule_metadata = Table('schedule_metadata', meta, autoload=True)
+    schedule_metadata.create_column(Column('value_hash', String(40),
+                                           nullable=True))
+
+    _backfill(migrate_engine, schedule_metadata)
+
+    index = Index(INDEX_NAME,
+                  *[schedule_metadata.c[name] for name in INDEX_COLUMNS])
+    index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    schedule_metadata = Table('schedule_metadata', meta, autoload=True)
+
+    index = Index(INDEX_NAME,
+                  *[schedule_metadata.c[name] for name in INDEX_COLUMNS])
+    index.drop(migrate_engine)
+
+    # NOTE: Reflect the table again so the dropped index is not recreated
+    # along with the table when sqlite drops the column.
+    meta = MetaData()
+    meta.bind = migrate_engine
+    schedule_metadata = Table('schedule_metadata', meta, autoload=True)
+    schedule_metadata.drop_column('value_hash')
@@ -0,0 +1,103 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import MetaData, Table, Index
+from sqlalchemy.schema import Column
+
+from qonos.db.sqlalchemy.migrate_repo.schema import create_tables
+from qonos.db.sqlalchemy.migrate_repo.schema import DateTime
+from qonos.db.sqlalchemy.migrate_repo.schema import drop_tables
+from qonos.db.sqlalchemy.migrate_repo.schema import Integer
+from qonos.db.sqlalchemy.migrate_repo.schema import String
+from qonos.db.sqlalchemy.migrate_repo.schema import Text
+
+# NOTE: The purge finds finished jobs by status and age, and faults by age,
+# a batch at a time.
+INDEXES = (('jobs', 'job_purge_idx', ('status', 'updated_at')),
+           ('job_faults', 'job_faults_created_at_idx', ('created_at',)))
+
+
+def define_shadow_tables(meta):
+    def base_columns():
+        return [Column('id', String(36), primary_key=True, nullable=False),
+                Column('created_at', DateTime(), nullable=False),
+                Column('updated_at', DateTime(), nullable=False)]
+
+    shadow_jobs = Table('shadow_jobs',
+                        meta,
+                        Column('schedule_id', String(36)),
+                        Column('tenant', String(255), nullable=False),
+                        Column('worker_id', String(36), nullable=True),
+                        Column('status', String(255), nullable=False),
+                        Column('action', String(255), nullable=False),
+                        Column('retry_count', Integer(), nullable=False),
+                        Column('timeout', DateTime(), nullable=False),
+                        Column('hard_timeout', DateTime(), nullable=False),
+                        Column('version_id', String(36)),
+                        mysql_engine='InnoDB',
+                        mysql_charset='utf8',
+                        *base_columns())
+
+    shadow_job_metadata = Table('shadow_job_metadata',
+                                meta,
+                                Column('job_id', String(36),
+                                       nullable=False),
+                                Column('key', String(255), nullable=False),
+                                Column('value', Text(), nullable=False),
+                                mysql_engine='InnoDB',
+                                mysql_charset='utf8',
+                                *base_columns())
+
+    shadow_job_faults = Table('shadow_job_faults',
+                              meta,
+                              Column('job_id', String(36), nullable=False),
+                              Column('schedule_id', String(36),
+                                     nullable=False),
+                              Column('tenant', String(255), nullable=False),
+                              Column('worker_id', String(36),
+                                     nullable=False),
+                              Column('action', String(255), nullable=False),
+                              Column('message', String(255), nullable=True),
+                              Column('job_metadata', Text(), nullable=True),
+                              mysql_engine='InnoDB',
+                              mysql_charset='utf8',
+                              *base_columns())
+
+    return [shadow_jobs, shadow_job_metadata, shadow_job_faults]
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    for table_name, index_name, columns in INDEXES:
+        table = Table(table_name, meta, autoload=True)
+        Index(index_name, *[table.c[name] for name in columns])\
+            .create(migrate_engine)
+
+    create_tables(define_shadow_tables(meta))
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    drop_tables(define_shadow_tables(meta))
+
+    for table_name, index_name, columns in INDEXES:
+        table = Table(table_name, meta, autoload=True)
+        Index(index_name, *[table.c[name] for name in columns])\
+            .drop(migrate_engine)
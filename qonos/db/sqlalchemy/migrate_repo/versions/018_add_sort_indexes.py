@@ -0,0 +1,89 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import MetaData, Table, Index
+
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: Serve the list sort keys. id is the tiebreaker of every sort, so
+# a page after a cursor is read as a range of one of these indexes in
+# order, however deep into the list it is.
+INDEXES = {
+    'jobs': [('jobs_created_at_idx', ('created_at', 'id')),
+             ('jobs_updated_at_idx', ('updated_at', 'id'))],
+    'schedules': [('schedules_created_at_idx', ('created_at', 'id')),
+                  ('schedules_updated_at_idx', ('updated_at', 'id'))],
+}
+
+# NOTE: Existing single column indexes on sort keys, rebuilt with id.
+REBUILT_INDEXES = {
+    'jobs': ('hard_timeout_idx', ('hard_timeout',)),
+    'schedules': ('next_run_idx', ('next_run',)),
+}
+
+
+def _has_index(indexes, idx_name):
+    for index in indexes:
+        if idx_name == index.name:
+            return True
+
+    return False
+
+
+def _rebuild_index(migrate_engine, table, index_name, old_columns,
+                   new_columns):
+    if _has_index(table.indexes, index_name):
+        index = Index(index_name, *[table.c[name] for name in old_columns])
+        index.drop(migrate_engine)
+    index = Index(index_name, *[table.c[name] for name in new_columns])
+    index.create(migrate_engine)
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    for table_name, indexes in INDEXES.iteritems():
+        table = Table(table_name, meta, autoload=True)
+        for index_name, columns in indexes:
+            if not _has_index(table.indexes, index_name):
+                index = Index(index_name,
+                              *[table.c[name] for name in columns])
+                index.create(migrate_engine)
+            else:
+                LOG.info(_('Index %s already exists.') % index_name)
+
+        index_name, columns = REBUILT_INDEXES[table_name]
+        _rebuild_index(migrate_engine, table, index_name, columns,
+                       columns + ('id',))
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    for table_name, indexes in INDEXES.iteritems():
+        table = Table(table_name, meta, autoload=True)
+        for index_name, columns in indexes:
+            index = Index(index_name, *[table.c[name] for name in columns])
+            index.drop(migrate_engine)
+
+        index_name, columns = REBUILT_INDEXES[table_name]
+        _rebuild_index(migrate_engine, table, index_name, columns + ('id',),
+                       columns)
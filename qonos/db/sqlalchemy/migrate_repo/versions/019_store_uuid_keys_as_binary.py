@@ -0,0 +1,157 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from migrate.changeset.constraint import ForeignKeyConstraint
+from oslo.config import cfg
+from sqlalchemy import MetaData, Table
+from sqlalchemy.dialects import mysql
+
+from qonos.common import exception
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+CONF.import_opt('sql_binary_uuids', 'qonos.db.sqlalchemy.api')
+
+# NOTE: The UUID columns of each table. version_id is not a key and the
+# worker_id of job faults can be 'UNASSIGNED', so both stay strings.
+KEY_COLUMNS = {
+    'schedules': ('id',),
+    'schedule_metadata': ('id', 'schedule_id'),
+    'workers': ('id',),
+    'jobs': ('id', 'schedule_id', 'worker_id'),
+    'job_metadata': ('id', 'job_id'),
+    'job_faults': ('id', 'job_id', 'schedule_id'),
+    'shadow_jobs': ('id', 'schedule_id', 'worker_id'),
+    'shadow_job_metadata': ('id', 'job_id'),
+    'shadow_job_faults': ('id', 'job_id', 'schedule_id'),
+}
+
+# NOTE: MySQL needs both sides of a foreign key to have the same type, so
+# these are dropped while the columns are converted.
+FOREIGN_KEYS = (('schedule_metadata', 'schedule_id', 'schedules'),
+                ('job_metadata', 'job_id', 'jobs'))
+
+UUID_REGEXP = ('^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+               '[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+TO_BINARY = "UNHEX(REPLACE(%(column)s, '-', ''))"
+TO_STRING = ("LOWER(CONCAT_WS('-', HEX(SUBSTRING(%(column)s, 1, 4)), "
+             "HEX(SUBSTRING(%(column)s, 5, 2)), "
+             "HEX(SUBSTRING(%(column)s, 7, 2)), "
+             "HEX(SUBSTRING(%(column)s, 9, 2)), "
+             "HEX(SUBSTRING(%(column)s, 11, 6))))")
+
+
+def _is_binary(meta):
+    jobs = Table('jobs', meta, autoload=True)
+    return isinstance(jobs.c.id.type, mysql.BINARY)
+
+
+def _foreign_keys(meta):
+    """Return the foreign keys of FOREIGN_KEYS found in the database, as
+    (table name, column, parent table name, constraint name)."""
+    found = []
+    for table_name, column, parent_name in FOREIGN_KEYS:
+        table = Table(table_name, meta, autoload=True)
+        for fkey in table.foreign_keys:
+            if fkey.parent.name == column:
+                found.append((table_name, column, parent_name,
+                              fkey.constraint.name))
+    return found
+
+
+def _foreign_key(meta, table_name, column, parent_name, name):
+    table = Table(table_name, meta, autoload=True)
+    parent = Table(parent_name, meta, autoload=True)
+    return ForeignKeyConstraint([table.c[column]], [parent.c.id], name=name)
+
+
+def _convert_keys(migrate_engine, column_type, conversion):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    foreign_keys = _foreign_keys(meta)
+    for foreign_key in foreign_keys:
+        _foreign_key(meta, *foreign_key).drop()
+
+    _convert(migrate_engine, meta, column_type, conversion)
+
+    meta = MetaData()
+    meta.bind = migrate_engine
+    for foreign_key in foreign_keys:
+        _foreign_key(meta, *foreign_key).create()
+
+
+def _check_uuids(migrate_engine):
+    invalid = []
+    for table_name, columns in KEY_COLUMNS.iteritems():
+        for column in columns:
+            count = migrate_engine.execute(
+                "SELECT COUNT(*) FROM %s WHERE %s NOT REGEXP '%s'"
+                % (table_name, column, UUID_REGEXP)).scalar()
+            if count:
+                invalid.append('%s.%s' % (table_name, column))
+    if invalid:
+        msg = (_('Cannot store keys as BINARY(16), these columns hold '
+                 'values that are not UUIDs: %s') % ', '.join(invalid))
+        raise exception.DatabaseMigrationError(msg)
+
+
+def _convert(migrate_engine, meta, column_type, conversion):
+    for table_name, columns in KEY_COLUMNS.iteritems():
+        table = Table(table_name, meta, autoload=True)
+        for column in columns:
+            null = 'NULL' if table.c[column].nullable else 'NOT NULL'
+            values = {'table': table_name, 'column': column, 'null': null}
+            # NOTE: VARBINARY keeps the bytes of either form as they are
+            # while they are rewritten.
+            migrate_engine.execute(
+                'ALTER TABLE %(table)s MODIFY %(column)s VARBINARY(36) '
+                '%(null)s' % values)
+            migrate_engine.execute(
+                'UPDATE %s SET %s = %s' % (table_name, column,
+                                           conversion % values))
+            migrate_engine.execute(
+                'ALTER TABLE %(table)s MODIFY %(column)s %(type)s %(null)s'
+                % dict(values, type=column_type))
+
+
+def upgrade(migrate_engine):
+    if migrate_engine.name != 'mysql' or not CONF.sql_binary_uuids:
+        LOG.info(_('Keeping UUID keys as strings.'))
+        return
+
+    meta = MetaData()
+    meta.bind = migrate_engine
+    if _is_binary(meta):
+        return
+
+    _check_uuids(migrate_engine)
+    _convert_keys(migrate_engine, 'BINARY(16)', TO_BINARY)
+
+
+def downgrade(migrate_engine):
+    if migrate_engine.name != 'mysql':
+        return
+
+    meta = MetaData()
+    meta.bind = migrate_engine
+    if not _is_binary(meta):
+        return
+
+    _convert_keys(migrate_engine, 'VARCHAR(36)', TO_STRING)
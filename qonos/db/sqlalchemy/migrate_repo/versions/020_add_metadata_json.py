@@ -0,0 +1,59 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import MetaData, Table, select
+from sqlalchemy.schema import Column
+
+from qonos.common import exception
+from qonos.db.sqlalchemy.migrate_repo.schema import Text
+from qonos.openstack.common.gettextutils import _
+
+# NOTE: The column holds the whole metadata of a job or schedule when
+# metadata_storage is "json". It starts out empty; qonos-manage
+# metadata_backfill moves the existing metadata rows into it.
+TABLES = ('schedules', 'jobs', 'shadow_jobs')
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    for table_name in TABLES:
+        table = Table(table_name, meta, autoload=True)
+        table.create_column(Column('metadata_json', Text(), nullable=True))
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    # NOTE: Dropping the column would lose the metadata stored in it.
+    for table_name in TABLES:
+        table = Table(table_name, meta, autoload=True)
+        rows = migrate_engine.execute(
+            select([table.c.id])
+            .where(table.c.metadata_json.isnot(None))
+            .limit(1)).fetchall()
+        if rows:
+            msg = (_('%s still holds metadata in metadata_json, move it '
+                     'back with qonos-manage metadata_backfill and '
+                     'metadata_storage set to "table", or purge it, '
+                     'first') % table_name)
+            raise exception.DatabaseMigrationError(msg)
+
+    for table_name in TABLES:
+        table = Table(table_name, meta, autoload=True)
+        table.drop_column('metadata_json')
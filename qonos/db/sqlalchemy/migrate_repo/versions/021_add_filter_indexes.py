@@ -0,0 +1,66 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import MetaData, Table, Index
+
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: Serve the tenant, action, status and schedule_id filters of the
+# schedule and job lists, and the latest fault of a job.
+INDEXES = {
+    'schedules': [('schedules_tenant_idx', ('tenant', 'action')),
+                  ('schedules_action_idx', ('action',))],
+    'jobs': [('jobs_tenant_idx', ('tenant', 'status')),
+             ('jobs_schedule_id_idx', ('schedule_id',))],
+    'job_faults': [('job_faults_job_id_idx', ('job_id', 'created_at'))],
+}
+
+
+def _has_index(indexes, idx_name):
+    for index in indexes:
+        if idx_name == index.name:
+            return True
+
+    return False
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    for table_name, indexes in INDEXES.iteritems():
+        table = Table(table_name, meta, autoload=True)
+        for index_name, columns in indexes:
+            if not _has_index(table.indexes, index_name):
+                index = Index(index_name,
+                              *[table.c[name] for name in columns])
+                index.create(migrate_engine)
+            else:
+                LOG.info(_('Index %s already exists.') % index_name)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    for table_name, indexes in INDEXES.iteritems():
+        table = Table(table_name, meta, autoload=True)
+        for index_name, columns in indexes:
+            index = Index(index_name, *[table.c[name] for name in columns])
+            index.drop(migrate_engine)
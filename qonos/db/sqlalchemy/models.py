@@ -19,11 +19,17 @@
 SQLAlchemy models for qonos data
 """
 
+import hashlib
+import json
+import uuid
+
 from sqlalchemy import Column, Integer, String, Index
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import ForeignKey, DateTime, Text
-from sqlalchemy.orm import relationship, backref, object_mapper
-from sqlalchemy import UniqueConstraint
+from sqlalchemy.orm import relationship, backref, object_mapper, validates
+from sqlalchemy import Table, UniqueConstraint
+from sqlalchemy import types
 
 from qonos.common import timeutils
 from qonos.openstack.common import uuidutils
@@ -35,6 +41,85 @@ COMMON_TABLE_ARGS = {
 }
 
 
+def metadata_value_hash(value):
+    """Return the indexable digest of a metadata value."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return hashlib.sha1(str(value)).hexdigest()
+
+
+# NOTE: The metadata_json column of a job or schedule holds its metadata
+# as a list of [key, value, id, created_at, updated_at] lists, with the
+# separators below, so a key and value can be matched by the text
+# '["key", "value", '.
+METADATA_JSON_SEPARATORS = (', ', ': ')
+METADATA_JSON_FIELDS = ('key', 'value', 'id', 'created_at', 'updated_at')
+
+
+def metadata_to_json(metadata):
+    """Return the metadata_json text of a list of metadata dicts."""
+    items = []
+    for meta in metadata:
+        items.append([meta['key'], meta['value'], meta['id'],
+                      timeutils.strtime(meta['created_at']),
+                      timeutils.strtime(meta['updated_at'])])
+    return json.dumps(items, separators=METADATA_JSON_SEPARATORS)
+
+
+def metadata_from_json(text, parent_key, parent_id):
+    """Return the metadata dicts of metadata_json text."""
+    metadata = []
+    for item in json.loads(text or '[]'):
+        meta = dict(zip(METADATA_JSON_FIELDS, item))
+        meta['created_at'] = timeutils.parse_strtime(meta['created_at'])
+        meta['updated_at'] = timeutils.parse_strtime(meta['updated_at'])
+        meta[parent_key] = parent_id
+        metadata.append(meta)
+    return metadata
+
+
+def metadata_json_pattern(key, value):
+    """Return the text metadata_json holds where key is set to value."""
+    return json.dumps([key, value],
+                      separators=METADATA_JSON_SEPARATORS)[:-1] + ', '
+
+
+def uses_binary_uuids(dialect):
+    """Return True if the keys of the database behind dialect are stored
+    as BINARY(16)."""
+    return getattr(dialect, 'binary_uuids', False)
+
+
+class UUID(types.TypeDecorator):
+    """A UUID key, which is a 36 character string to the rest of qonos.
+
+    On MySQL databases whose keys were converted by migration 019 it is
+    stored as BINARY(16), less than half the size in the clustered index
+    and in every index holding it. It is a String(36) everywhere else.
+    """
+    impl = String(36)
+
+    def load_dialect_impl(self, dialect):
+        if uses_binary_uuids(dialect):
+            return dialect.type_descriptor(mysql.BINARY(16))
+        return dialect.type_descriptor(String(36))
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not uses_binary_uuids(dialect):
+            return value
+        try:
+            return uuid.UUID(value).bytes
+        except (TypeError, ValueError):
+            # NOTE: Anything else cannot be a stored key, so it is passed
+            # on to match nothing.
+            return value
+
+    def process_result_value(self, value, dialect):
+        if value is None or not uses_binary_uuids(dialect):
+            return value
+        return str(uuid.UUID(bytes=str(value)))
+
+
 class ModelBase(object):
     """Base class for Qonos Models."""
     __table_args__ = COMMON_TABLE_ARGS
@@ -44,7 +129,7 @@ class ModelBase(object):
                         nullable=False)
     updated_at = Column(DateTime, default=timeutils.utcnow,
                         nullable=False, onupdate=timeutils.utcnow)
-    id = Column(String(36), primary_key=True, default=uuidutils.generate_uuid)
+    id = Column(UUID, primary_key=True, default=uuidutils.generate_uuid)
 
     def save(self, session=None):
         """Save this object."""
@@ -97,7 +182,11 @@ class ModelBase(object):
 class Schedule(BASE, ModelBase):
     """Represents a schedule in the datastore."""
     __tablename__ = 'schedules'
-    __table_args__ = (Index('next_run_idx', 'next_run'),
+    __table_args__ = (Index('next_run_idx', 'next_run', 'id'),
+                      Index('schedules_created_at_idx', 'created_at', 'id'),
+                      Index('schedules_updated_at_idx', 'updated_at', 'id'),
+                      Index('schedules_tenant_idx', 'tenant', 'action'),
+                      Index('schedules_action_idx', 'action'),
                       COMMON_TABLE_ARGS)
 
     tenant = Column(String(255), nullable=False)
@@ -109,22 +198,34 @@ class Schedule(BASE, ModelBase):
     day_of_week = Column(Integer, nullable=True)
     last_scheduled = Column(DateTime, nullable=True)
     next_run = Column(DateTime, nullable=True, index=True)
+    # NOTE: The metadata, when it is stored as JSON rather than in
+    # schedule_metadata. See metadata_to_json.
+    metadata_json = Column(Text, nullable=True)
 
 
 class ScheduleMetadata(BASE, ModelBase):
     """Represents metadata of a schedule in the datastore."""
     __tablename__ = 'schedule_metadata'
     __table_args__ = (UniqueConstraint('schedule_id', 'key'),
+                      Index('schedule_metadata_value_idx', 'key',
+                            'value_hash', 'schedule_id'),
                       COMMON_TABLE_ARGS)
 
-    schedule_id = Column(String(36),
-                         ForeignKey('schedules.id'), nullable=False)
+    schedule_id = Column(UUID, ForeignKey('schedules.id'), nullable=False)
     key = Column(String(255), nullable=False)
     value = Column(Text, nullable=False)
+    # NOTE: value is a Text column, which cannot be indexed, so metadata
+    # filters look rows up by key and the hash of the value instead.
+    value_hash = Column(String(40), nullable=True)
     parent = relationship(Schedule, backref=backref('schedule_metadata',
                                                     cascade='all,delete,'
                                                             'delete-orphan'))
 
+    @validates('value')
+    def _set_value_hash(self, key, value):
+        self.value_hash = metadata_value_hash(value)
+        return value
+
 
 class Worker(BASE, ModelBase):
     """Represents a worker in the datastore."""
@@ -137,18 +238,26 @@ class Worker(BASE, ModelBase):
 class Job(BASE, ModelBase):
     """Represents a job in the datastore."""
     __tablename__ = 'jobs'
-    __table_args__ = (Index('hard_timeout_idx', 'hard_timeout'),
+    __table_args__ = (Index('hard_timeout_idx', 'hard_timeout', 'id'),
+                      Index('job_claim_idx', 'action', 'updated_at',
+                            'status', 'worker_id', 'timeout'),
+                      Index('job_purge_idx', 'status', 'updated_at'),
+                      Index('jobs_created_at_idx', 'created_at', 'id'),
+                      Index('jobs_updated_at_idx', 'updated_at', 'id'),
+                      Index('jobs_tenant_idx', 'tenant', 'status'),
+                      Index('jobs_schedule_id_idx', 'schedule_id'),
                       COMMON_TABLE_ARGS)
 
-    schedule_id = Column(String(36))
+    schedule_id = Column(UUID)
     tenant = Column(String(255), nullable=False)
-    worker_id = Column(String(36), nullable=True)
+    worker_id = Column(UUID, nullable=True)
     status = Column(String(255), default='QUEUED', nullable=False)
     action = Column(String(255), nullable=False)
     retry_count = Column(Integer, nullable=False, default=0)
     timeout = Column(DateTime, nullable=False)
     hard_timeout = Column(DateTime, nullable=False, index=True)
     version_id = Column(String(36))
+    metadata_json = Column(Text, nullable=True)
 
     __mapper_args__ = {
         'version_id_col': version_id,
@@ -161,7 +270,7 @@ class JobMetadata(BASE, ModelBase):
     __tablename__ = 'job_metadata'
     __table_args__ = (UniqueConstraint('job_id', 'key'), COMMON_TABLE_ARGS)
 
-    job_id = Column(String(36), ForeignKey('jobs.id'), nullable=False)
+    job_id = Column(UUID, ForeignKey('jobs.id'), nullable=False)
     key = Column(String(255), nullable=False)
     value = Column(Text, nullable=False)
     parent = relationship(Job, backref=backref('job_metadata',
@@ -172,16 +281,36 @@ class JobMetadata(BASE, ModelBase):
 class JobFault(BASE, ModelBase):
     """Represents a job fault in the datastore."""
     __tablename__ = 'job_faults'
+    __table_args__ = (Index('job_faults_created_at_idx', 'created_at'),
+                      Index('job_faults_job_id_idx', 'job_id', 'created_at'),
+                      COMMON_TABLE_ARGS)
 
-    job_id = Column(String(36), nullable=False)
-    schedule_id = Column(String(36), nullable=False)
+    job_id = Column(UUID, nullable=False)
+    schedule_id = Column(UUID, nullable=False)
     tenant = Column(String(255), nullable=False)
+    # NOTE: Not a UUID key, faults of unassigned jobs hold 'UNASSIGNED'.
     worker_id = Column(String(36), nullable=False)
     action = Column(String(255), nullable=False)
     message = Column(String(255), nullable=True)
     job_metadata = Column(Text, nullable=True)
 
 
+def _shadow_table(table):
+    """Define the archive copy of table: its columns, without constraints."""
+    columns = [Column(column.name, column.type,
+                      primary_key=column.primary_key,
+                      nullable=column.nullable)
+               for column in table.columns]
+    return Table('shadow_' + table.name, BASE.metadata, *columns,
+                 **COMMON_TABLE_ARGS)
+
+
+# NOTE: Purged jobs, their metadata and faults are copied here when they
+# are archived.
+SHADOW_TABLES = dict((model.__tablename__, _shadow_table(model.__table__))
+                     for model in (Job, JobMetadata, JobFault))
+
+
 def register_models(engine):
     """
     Creates database tables for all models with the given engine.
@@ -0,0 +1,183 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Per db api function SQL statement profiler.
+
+Public db api functions are decorated with profiled(), which records the
+name of the outermost one running in the current greenthread. Once
+install() has added its cursor listeners to an engine, the time and row
+count of every statement is charged to that name, statements slower than
+slow_query_seconds are written to the qonos.db.slow_query log, and
+SIGUSR2 logs a summary of the latency histograms.
+"""
+
+import functools
+import signal
+import threading
+import time
+
+from oslo.config import cfg
+import sqlalchemy
+
+from qonos.openstack.common.gettextutils import _
+from qonos.openstack.common import local
+import qonos.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+SLOW_LOG = logging.getLogger('qonos.db.slow_query')
+
+profiler_opts = [
+    cfg.FloatOpt('slow_query_seconds', default=1.0,
+                 help=_('Statements taking longer than this are written to '
+                        'the qonos.db.slow_query log when log_query_times '
+                        'is enabled')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(profiler_opts)
+
+# NOTE: Upper bounds, in milliseconds, of the latency histogram buckets.
+# Slower statements go in a last, unbounded bucket.
+BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+UNKNOWN = 'unknown'
+
+_CALLER = local.strong_store()
+_LOCK = threading.Lock()
+_STATS = {}
+
+
+def profiled(func):
+    """Charge the statements run by func, and what it calls, to func."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        if getattr(_CALLER, 'name', None) is not None:
+            return func(*args, **kwargs)
+
+        _CALLER.name = name
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _CALLER.name = None
+    return wrapped
+
+
+def current_function():
+    """Return the name of the profiled function running, if any."""
+    return getattr(_CALLER, 'name', None) or UNKNOWN
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info['query_start_time'] = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start_time = conn.info.pop('query_start_time', None)
+    if start_time is None:
+        return
+
+    elapsed = time.time() - start_time
+    function = current_function()
+    # NOTE: Drivers report -1 when they do not know the row count, as
+    # sqlite does for selects.
+    rows = max(getattr(cursor, 'rowcount', -1), 0)
+    record(function, elapsed, rows)
+
+    if elapsed >= CONF.slow_query_seconds:
+        SLOW_LOG.warning(_('Slow query in %(function)s: %(elapsed).6fs, '
+                           '%(rows)d rows. Query statement: %(statement)s')
+                         % {'function': function, 'elapsed': elapsed,
+                            'rows': rows, 'statement': statement})
+
+
+def _bucket(elapsed):
+    milliseconds = elapsed * 1000
+    for index, bound in enumerate(BUCKETS):
+        if milliseconds <= bound:
+            return index
+    return len(BUCKETS)
+
+
+def record(function, elapsed, rows=0):
+    """Record a statement of function that took elapsed seconds."""
+    bucket = _bucket(elapsed)
+    with _LOCK:
+        stats = _STATS.get(function)
+        if stats is None:
+            stats = _STATS[function] = {
+                'count': 0, 'total': 0.0, 'max': 0.0, 'rows': 0,
+                'histogram': [0] * (len(BUCKETS) + 1)}
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        stats['rows'] += rows
+        stats['histogram'][bucket] += 1
+
+
+def _bucket_labels():
+    labels = ['<=%dms' % bound for bound in BUCKETS]
+    labels.append('>%dms' % BUCKETS[-1])
+    return labels
+
+
+def get_stats():
+    """Return the statement count, time, rows and histogram per function."""
+    labels = _bucket_labels()
+    with _LOCK:
+        return dict((function, {'count': stats['count'],
+                                'total': stats['total'],
+                                'max': stats['max'],
+                                'rows': stats['rows'],
+                                'histogram': zip(labels,
+                                                 stats['histogram'])})
+                    for function, stats in _STATS.iteritems())
+
+
+def reset():
+    with _LOCK:
+        _STATS.clear()
+
+
+def log_stats(logger=LOG):
+    for function, stats in sorted(get_stats().iteritems()):
+        histogram = ' '.join('%s:%d' % bucket
+                             for bucket in stats['histogram'] if bucket[1])
+        logger.info(_('[QUERIES] %(function)s: count=%(count)d '
+                      'total=%(total).6f max=%(max).6f rows=%(rows)d '
+                      '%(histogram)s')
+                    % dict(stats, function=function, histogram=histogram))
+
+
+def _dump_stats(signum, frame):
+    log_stats()
+
+
+def install(engine):
+    """Profile the statements run through engine."""
+    sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                            _before_cursor_execute)
+    sqlalchemy.event.listen(engine, 'after_cursor_execute',
+                            _after_cursor_execute)
+    try:
+        signal.signal(signal.SIGUSR2, _dump_stats)
+    except ValueError:
+        # NOTE: Handlers can only be set from the main thread.
+        LOG.warn(_('Could not install the SIGUSR2 query profile dump'))
@@ -177,6 +177,21 @@ def add_driver(notification_driver):
         _drivers[notification_driver] = notification_driver
 
 
+def flush():
+    """Wait for drivers that send asynchronously to deliver pending
+    notifications.
+    """
+    for driver in _get_drivers():
+        driver_flush = getattr(driver, 'flush', None)
+        if driver_flush is None:
+            continue
+        try:
+            driver_flush()
+        except Exception:
+            LOG.exception(_("Problem flushing notification driver %s")
+                          % driver)
+
+
 def _reset_drivers():
     """Used by unit tests to reset the drivers."""
     global _drivers
@@ -0,0 +1,218 @@
+# Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Notifier driver that sends notifications from a background thread.
+
+notify() only puts the message on a bounded in-memory queue. A background
+thread takes messages off the queue in batches and hands them to the
+drivers listed in batching_notification_driver. When the queue is full the
+message is either dropped or the caller blocks, depending on
+batching_notification_overflow_policy.
+
+Pending messages are flushed when the process exits. Processes that leave
+through os._exit(), such as forked workers, must call flush() first.
+"""
+
+import atexit
+import os
+import Queue
+import threading
+import time
+
+from oslo.config import cfg
+
+from qonos.openstack.common.gettextutils import _
+from qonos.openstack.common import importutils
+from qonos.openstack.common import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop', 'block')
+
+batching_notifier_opts = [
+    cfg.MultiStrOpt('batching_notification_driver',
+                    default=['qonos.openstack.common.notifier.rpc_notifier'],
+                    help='Driver or drivers the batching notifier sends '
+                         'notifications to'),
+    cfg.IntOpt('batching_notification_queue_size',
+               default=1000,
+               help='Maximum number of notifications waiting to be sent'),
+    cfg.IntOpt('batching_notification_batch_size',
+               default=100,
+               help='Maximum number of notifications sent in one batch'),
+    cfg.StrOpt('batching_notification_overflow_policy',
+               default='drop',
+               choices=OVERFLOW_POLICIES,
+               help='What to do with a notification when the queue is '
+                    'full: "drop" it or "block" until there is room'),
+    cfg.FloatOpt('batching_notification_flush_timeout',
+                 default=5.0,
+                 help='Seconds to wait for pending notifications to be sent '
+                      'when the process exits'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(batching_notifier_opts)
+
+_lock = threading.Lock()
+_sent = threading.Condition()
+_queue = None
+_pending = 0
+_pid = None
+_drivers = None
+_dropped = 0
+_atexit_registered = False
+
+
+def _get_drivers():
+    global _drivers
+    if _drivers is None:
+        _drivers = []
+        for driver_name in CONF.batching_notification_driver:
+            try:
+                _drivers.append(importutils.import_module(driver_name))
+            except ImportError:
+                LOG.exception(_("Failed to load notifier %s. "
+                                "These notifications will not be sent.") %
+                              driver_name)
+    return _drivers
+
+
+def _send_batch(batch):
+    for driver in _get_drivers():
+        for context, message in batch:
+            try:
+                driver.notify(context, message)
+            except Exception:
+                LOG.exception(_("Problem attempting to send to notification "
+                                "system. Payload=%s") % message)
+
+
+def _take_batch(queue, batch_size):
+    batch = [queue.get()]
+    while len(batch) < batch_size:
+        try:
+            batch.append(queue.get_nowait())
+        except Queue.Empty:
+            break
+    return batch
+
+
+def _run(queue, batch_size):
+    global _pending
+    while True:
+        batch = _take_batch(queue, batch_size)
+        try:
+            _send_batch(batch)
+        finally:
+            with _sent:
+                # NOTE: A queue replaced after a fork or by _reset() no
+                # longer counts towards the pending notifications.
+                if queue is _queue:
+                    _pending -= len(batch)
+                _sent.notify_all()
+
+
+def _get_queue():
+    """Return the queue of this process, starting its sender if needed.
+
+    A forked child inherits the queue but not the sender thread, so a new
+    queue and thread are created the first time it sends a notification.
+    """
+    global _queue, _pid, _pending, _atexit_registered
+    with _lock:
+        if _queue is None or _pid != os.getpid():
+            policy = CONF.batching_notification_overflow_policy
+            if policy not in OVERFLOW_POLICIES:
+                raise ValueError(_("Unknown batching_notification_overflow_"
+                                   "policy %(policy)s, expected one of "
+                                   "%(choices)s")
+                                 % {'policy': policy,
+                                    'choices': ', '.join(OVERFLOW_POLICIES)})
+            _queue = Queue.Queue(CONF.batching_notification_queue_size)
+            _pid = os.getpid()
+            with _sent:
+                _pending = 0
+            sender = threading.Thread(
+                target=_run,
+                args=(_queue, max(1, CONF.batching_notification_batch_size)))
+            sender.daemon = True
+            sender.start()
+            if not _atexit_registered:
+                atexit.register(flush)
+                _atexit_registered = True
+        return _queue
+
+
+def notify(context, message):
+    """Queue a notification to be sent by the background thread."""
+    global _dropped, _pending
+    queue = _get_queue()
+    with _sent:
+        _pending += 1
+
+    if CONF.batching_notification_overflow_policy == 'block':
+        queue.put((context, message))
+        return
+
+    try:
+        queue.put_nowait((context, message))
+    except Queue.Full:
+        with _sent:
+            _pending -= 1
+        with _lock:
+            _dropped += 1
+            dropped = _dropped
+        LOG.warn(_("Notification queue is full, dropped notification "
+                   "%(message_id)s (%(dropped)d dropped so far)")
+                 % {'message_id': message.get('message_id'),
+                    'dropped': dropped})
+
+
+def flush(timeout=None):
+    """Wait until the queued notifications have been sent.
+
+    Returns False if some were still pending after timeout seconds.
+    """
+    if timeout is None:
+        timeout = CONF.batching_notification_flush_timeout
+
+    with _lock:
+        if _pid != os.getpid():
+            return True
+
+    deadline = time.time() + timeout
+    with _sent:
+        while _pending > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                LOG.warn(_("%d notifications were not sent before the "
+                           "flush timeout") % _pending)
+                return False
+            _sent.wait(remaining)
+    return True
+
+
+def _reset():
+    """Used by unit tests to forget the queue and the loaded drivers."""
+    global _queue, _pid, _drivers, _dropped, _pending
+    with _lock:
+        _queue = None
+        _pid = None
+        _drivers = None
+        _dropped = 0
+    with _sent:
+        _pending = 0
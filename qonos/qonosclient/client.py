@@ -162,6 +162,12 @@ class Client(object):
             query += ('%s=%s&' % (key, params[key]))
         return self._do_request('GET', path % query)['jobs']
 
+    def get_job_stats(self, tenant=None):
+        path = '/v1/jobs/stats'
+        if tenant is not None:
+            path += '?tenant=%s' % tenant
+        return self._do_request('GET', path)['stats']
+
     def create_job(self, schedule_id, next_run=None):
         job = {'job': {'schedule_id': schedule_id}}
         if next_run:
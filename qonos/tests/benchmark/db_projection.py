@@ -0,0 +1,192 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Per-row cost of the sqlalchemy db api list and get calls.
+
+Seeds a database with schedules, jobs (each with metadata) and workers, then
+times every list and get call two ways: loading ORM objects and converting
+them with force_dict, as the db api used to, and through the Core
+projections the db api uses now. Reports microseconds per returned row.
+
+Run from the top of the source tree with:
+
+    python -m qonos.tests.benchmark.db_projection --rows 1000 --metadata 3
+"""
+
+import argparse
+import datetime
+import time
+
+from oslo.config import cfg
+import sqlalchemy.orm as sa_orm
+
+from qonos.common import timeutils
+import qonos.db.sqlalchemy.api as db_api
+from qonos.db.sqlalchemy import models
+
+
+CONF = cfg.CONF
+
+
+@db_api.force_dict
+def _orm_schedule_get_all():
+    return db_api.get_session().query(models.Schedule)\
+        .options(sa_orm.joinedload_all('schedule_metadata'))\
+        .order_by(models.Schedule.id).all()
+
+
+@db_api.force_dict
+def _orm_schedule_get_by_id(schedule_id):
+    return db_api._schedule_get_by_id(schedule_id)
+
+
+@db_api.force_dict
+def _orm_job_get_all():
+    return db_api.get_session().query(models.Job)\
+        .options(sa_orm.subqueryload('job_metadata'))\
+        .order_by(models.Job.id).all()
+
+
+@db_api.force_dict
+def _orm_job_get_by_id(job_id):
+    return db_api._job_get_by_id(job_id)
+
+
+@db_api.force_dict
+def _orm_worker_get_all():
+    return db_api.get_session().query(models.Worker)\
+        .order_by(models.Worker.id).all()
+
+
+@db_api.force_dict
+def _orm_worker_get_by_id(worker_id):
+    return db_api._worker_get_by_id(worker_id)
+
+
+def seed(rows, metadata):
+    now = timeutils.utcnow()
+    schedule_ids, job_ids, worker_ids = [], [], []
+    for i in xrange(rows):
+        meta = [{'key': 'key%d' % m, 'value': 'value%d' % m}
+                for m in xrange(metadata)]
+        schedule = db_api.schedule_create({
+            'tenant': 'TENANT_%d' % (i % 20),
+            'action': 'snapshot',
+            'hour': i % 24,
+            'minute': i % 60,
+            'schedule_metadata': meta,
+        })
+        schedule_ids.append(schedule['id'])
+        job = db_api.job_create({
+            'tenant': schedule['tenant'],
+            'action': 'snapshot',
+            'schedule_id': schedule['id'],
+            'status': 'QUEUED',
+            'retry_count': 0,
+            'timeout': now + datetime.timedelta(hours=1),
+            'hard_timeout': now + datetime.timedelta(hours=4),
+            'job_metadata': meta,
+        })
+        job_ids.append(job['id'])
+        worker = db_api.worker_create({'host': 'host%d' % i})
+        worker_ids.append(worker['id'])
+    return schedule_ids, job_ids, worker_ids
+
+
+def _time_list(func, repeat):
+    best = None
+    for _i in xrange(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / max(len(result), 1)
+
+
+def _time_get(func, ids, repeat):
+    best = None
+    for _i in xrange(repeat):
+        start = time.time()
+        for row_id in ids:
+            func(row_id)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / max(len(ids), 1)
+
+
+def run(rows, metadata, gets, repeat):
+    schedule_ids, job_ids, worker_ids = seed(rows, metadata)
+    schedule_ids, job_ids = schedule_ids[:gets], job_ids[:gets]
+    worker_ids = worker_ids[:gets]
+
+    return [
+        ('schedule_get_all',
+         _time_list(_orm_schedule_get_all, repeat),
+         _time_list(db_api.schedule_get_all, repeat)),
+        ('schedule_get_by_id',
+         _time_get(_orm_schedule_get_by_id, schedule_ids, repeat),
+         _time_get(db_api.schedule_get_by_id, schedule_ids, repeat)),
+        ('job_get_all',
+         _time_list(_orm_job_get_all, repeat),
+         _time_list(db_api.job_get_all, repeat)),
+        ('job_get_by_id',
+         _time_get(_orm_job_get_by_id, job_ids, repeat),
+         _time_get(db_api.job_get_by_id, job_ids, repeat)),
+        ('worker_get_all',
+         _time_list(_orm_worker_get_all, repeat),
+         _time_list(db_api.worker_get_all, repeat)),
+        ('worker_get_by_id',
+         _time_get(_orm_worker_get_by_id, worker_ids, repeat),
+         _time_get(db_api.worker_get_by_id, worker_ids, repeat)),
+    ]
+
+
+def report(results):
+    print '%-20s %14s %14s %8s' % ('call', 'orm us/row', 'core us/row',
+                                   'speedup')
+    for name, before, after in results:
+        print '%-20s %14.1f %14.1f %7.1fx' % (name, before * 1e6,
+                                              after * 1e6, before / after)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Per-row cost of the QonoS sqlalchemy db api reads')
+    parser.add_argument('--sql-connection', default='sqlite://',
+                        help='Database to seed; it must be empty')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='Number of schedules, jobs and workers')
+    parser.add_argument('--metadata', type=int, default=3,
+                        help='Metadata items per schedule and job')
+    parser.add_argument('--gets', type=int, default=200,
+                        help='Number of rows fetched one by one by the get '
+                             'calls')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each call; the fastest is reported')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    CONF([], project='qonos')
+    CONF.set_override('sql_connection', args.sql_connection)
+    db_api.configure_db()
+    report(run(args.rows, args.metadata, args.gets, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Per-call overhead of the hot sqlalchemy db api queries.
+
+Seeds an in-memory sqlite database, then times the get by id calls and the
+job claim query two ways: with their statements cached, as the db api runs
+them, and with the statement cache cleared before every call, which costs
+what building and compiling the query on each call used to. Reports
+microseconds per call.
+
+Run from the top of the source tree with:
+
+    python -m qonos.tests.benchmark.db_statements --calls 2000 \\
+        --max-us 400
+
+With --max-us the run exits with status 1 when a cached call takes longer,
+so it can guard against regressions.
+"""
+
+import argparse
+import datetime
+import sys
+import time
+
+from oslo.config import cfg
+
+from qonos.common import timeutils
+import qonos.db.sqlalchemy.api as db_api
+
+
+CONF = cfg.CONF
+
+
+def seed(rows, metadata):
+    now = timeutils.utcnow()
+    meta = [{'key': 'key%d' % m, 'value': 'value%d' % m}
+            for m in xrange(metadata)]
+    schedule_ids, job_ids, worker_ids = [], [], []
+    for i in xrange(rows):
+        schedule = db_api.schedule_create({
+            'tenant': 'TENANT_%d' % (i % 20),
+            'action': 'snapshot',
+            'hour': i % 24,
+            'minute': i % 60,
+            'schedule_metadata': meta,
+        })
+        schedule_ids.append(schedule['id'])
+        job = db_api.job_create({
+            'tenant': schedule['tenant'],
+            'action': 'snapshot',
+            'schedule_id': schedule['id'],
+            'status': 'QUEUED',
+            'retry_count': 0,
+            'timeout': now + datetime.timedelta(hours=1),
+            'hard_timeout': now + datetime.timedelta(hours=4),
+            'job_metadata': meta,
+        })
+        job_ids.append(job['id'])
+        worker = db_api.worker_create({'host': 'host%d' % i})
+        worker_ids.append(worker['id'])
+    return schedule_ids, job_ids, worker_ids
+
+
+def _uncached(func):
+    def wrapper(*args):
+        db_api._STATEMENTS.clear()
+        db_api._COMPILED.clear()
+        return func(*args)
+    return wrapper
+
+
+def _claim(action):
+    return db_api._job_get_next_by_action(db_api.get_session(),
+                                          timeutils.utcnow(), action)
+
+
+def _orm_job_get_by_id(job_id):
+    return db_api._job_get_by_id(job_id, db_api.get_session())
+
+
+def _time_calls(func, args, calls, repeat):
+    best = None
+    for _i in xrange(repeat):
+        start = time.time()
+        for i in xrange(calls):
+            func(args[i % len(args)])
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / calls
+
+
+def run(rows, metadata, calls, repeat):
+    schedule_ids, job_ids, worker_ids = seed(rows, metadata)
+    benchmarks = [
+        ('job_get_by_id', db_api.job_get_by_id, job_ids),
+        ('schedule_get_by_id', db_api.schedule_get_by_id, schedule_ids),
+        ('worker_get_by_id', db_api.worker_get_by_id, worker_ids),
+        ('_job_get_by_id', _orm_job_get_by_id, job_ids),
+        ('_job_get_next_by_action', _claim, ['snapshot']),
+    ]
+
+    results = []
+    for name, func, args in benchmarks:
+        uncached = _time_calls(_uncached(func), args, calls, repeat)
+        cached = _time_calls(func, args, calls, repeat)
+        results.append((name, uncached, cached))
+    return results
+
+
+def report(results):
+    print '%-26s %14s %14s %8s' % ('call', 'uncached us', 'cached us',
+                                   'speedup')
+    for name, before, after in results:
+        print '%-26s %14.1f %14.1f %7.1fx' % (name, before * 1e6,
+                                              after * 1e6, before / after)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Per-call overhead of the QonoS hot db api queries')
+    parser.add_argument('--rows', type=int, default=200,
+                        help='Number of schedules, jobs and workers')
+    parser.add_argument('--metadata', type=int, default=3,
+                        help='Metadata items per schedule and job')
+    parser.add_argument('--calls', type=int, default=2000,
+                        help='Calls timed per run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each call; the fastest is reported')
+    parser.add_argument('--max-us', type=float, default=None,
+                        help='Fail when a cached call takes longer than '
+                             'this many microseconds')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    CONF([], project='qonos')
+    CONF.set_override('sql_connection', 'sqlite://')
+    db_api.configure_db()
+    results = run(args.rows, args.metadata, args.calls, args.repeat)
+    report(results)
+
+    if args.max_us is not None:
+        slow = [name for name, _before, after in results
+                if after * 1e6 > args.max_us]
+        if slow:
+            print 'Slower than %.1fus per call: %s' % (
+                args.max_us, ', '.join(slow))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Local stand-in for the Keystone and Nova endpoints used by snapshot workers.
+
+Serves, on a single port:
+
+    POST   /v2.0/tokens
+    GET    /v2/{tenant}/servers/{server_id}
+    POST   /v2/{tenant}/servers/{server_id}/action         (createImage)
+    GET    /v2/{tenant}/servers/{server_id}/rax-si-image-schedule
+    GET    /v2/{tenant}/images/detail
+    GET    /v2/{tenant}/images/{image_id}
+    DELETE /v2/{tenant}/images/{image_id}
+    GET    /_stats
+
+Any server id exists. Its flavor is picked from the configured flavors by
+hashing the id, and the flavor decides how long an image upload takes. Each
+API family can be given a latency. /_stats returns the request counts.
+
+Run standalone with:
+
+    python -m qonos.tests.benchmark.fake_nova --port 5000
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+import eventlet
+import eventlet.wsgi
+import webob
+import webob.dec
+import webob.exc
+
+
+# NOTE: Families match the ones used by the Nova rate limiter.
+API_FAMILIES = ('auth', 'servers', 'image_create', 'images', 'retention')
+
+DEFAULT_FLAVORS = {'2': 5.0, '4': 10.0, '8': 20.0}
+
+_ROUTES = [
+    ('POST', r'^/v2\.0/tokens$', 'auth', '_auth'),
+    ('GET', r'^/v2/(?P<tenant>[^/]+)/servers/(?P<server_id>[^/]+)$',
+     'servers', '_get_server'),
+    ('POST', r'^/v2/(?P<tenant>[^/]+)/servers/(?P<server_id>[^/]+)/action$',
+     'image_create', '_server_action'),
+    ('GET', r'^/v2/(?P<tenant>[^/]+)/servers/(?P<server_id>[^/]+)'
+            r'/rax-si-image-schedule$',
+     'retention', '_get_retention'),
+    ('GET', r'^/v2/(?P<tenant>[^/]+)/images/detail$',
+     'images', '_list_images'),
+    ('GET', r'^/v2/(?P<tenant>[^/]+)/images/(?P<image_id>[^/]+)$',
+     'images', '_get_image'),
+    ('DELETE', r'^/v2/(?P<tenant>[^/]+)/images/(?P<image_id>[^/]+)$',
+     'images', '_delete_image'),
+]
+
+
+def _json_response(body, status=200, headers=None):
+    response = webob.Response(status=status, content_type='application/json')
+    response.body = json.dumps(body)
+    for name, value in (headers or {}).iteritems():
+        response.headers[name] = value
+    return response
+
+
+def _isotime(at):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(at))
+
+
+class FakeNova(object):
+    """WSGI application faking Keystone v2.0 and the Nova v2 API.
+
+    :param latencies: seconds to wait before answering, per API family
+    :param flavors: image upload duration in seconds, per flavor id
+    :param upload_jitter: fraction by which upload durations vary randomly
+    :param retention: retention returned by the scheduled images extension,
+                      None to answer 404 as if scheduled images is disabled
+    :param queued_sec: seconds an image spends QUEUED before SAVING
+    """
+
+    def __init__(self, latencies=None, flavors=None, upload_jitter=0.0,
+                 retention=7, queued_sec=0.0):
+        self.latencies = latencies or {}
+        self.flavors = flavors or DEFAULT_FLAVORS
+        self.upload_jitter = upload_jitter
+        self.retention = retention
+        self.queued_sec = queued_sec
+        self.endpoint = None
+
+        self._lock = threading.Lock()
+        self._images = {}
+        self._counts = dict((family, 0) for family in API_FAMILIES)
+        self._images_created = 0
+        self._images_deleted = 0
+        self._routes = [(method, re.compile(pattern), family, handler)
+                        for method, pattern, family, handler in _ROUTES]
+
+    @webob.dec.wsgify
+    def __call__(self, request):
+        if request.path == '/_stats':
+            return _json_response(self.get_stats())
+
+        for method, pattern, family, handler in self._routes:
+            match = pattern.match(request.path)
+            if match and request.method == method:
+                with self._lock:
+                    self._counts[family] += 1
+                latency = self.latencies.get(family, 0)
+                if latency > 0:
+                    eventlet.sleep(latency)
+                return getattr(self, handler)(request, **match.groupdict())
+
+        return webob.exc.HTTPNotFound()
+
+    def get_stats(self):
+        with self._lock:
+            return {'requests': dict(self._counts,
+                                     total=sum(self._counts.values())),
+                    'images_created': self._images_created,
+                    'images_deleted': self._images_deleted}
+
+    def _base_url(self, request):
+        return self.endpoint or request.host_url
+
+    def _flavor_for(self, server_id):
+        flavor_ids = sorted(self.flavors)
+        digest = int(hashlib.md5(server_id).hexdigest(), 16)
+        return flavor_ids[digest % len(flavor_ids)]
+
+    def _auth(self, request):
+        try:
+            tenant = json.loads(request.body)['auth']['tenantName']
+        except (ValueError, KeyError, TypeError):
+            return webob.exc.HTTPBadRequest()
+
+        compute_url = '%s/v2/%s' % (self._base_url(request), tenant)
+        return _json_response({'access': {
+            'token': {'id': uuid.uuid4().hex,
+                      'expires': _isotime(time.time() + 86400),
+                      'tenant': {'id': tenant, 'name': tenant}},
+            'user': {'id': 'fake-user', 'name': 'fake-user', 'roles': []},
+            'serviceCatalog': [{
+                'type': 'compute',
+                'name': 'nova',
+                'endpoints': [{'region': 'FAKE',
+                               'versionId': '2',
+                               'publicURL': compute_url,
+                               'internalURL': compute_url}],
+            }],
+        }})
+
+    def _get_server(self, request, tenant, server_id):
+        return _json_response({'server': {
+            'id': server_id,
+            'name': 'server-%s' % server_id[:8],
+            'status': 'ACTIVE',
+            'tenant_id': tenant,
+            'flavor': {'id': self._flavor_for(server_id), 'links': []},
+            'metadata': {},
+        }})
+
+    def _server_action(self, request, tenant, server_id):
+        try:
+            body = json.loads(request.body)['createImage']
+        except (ValueError, KeyError, TypeError):
+            return webob.exc.HTTPBadRequest()
+
+        upload_sec = self.flavors[self._flavor_for(server_id)]
+        if self.upload_jitter:
+            upload_sec *= random.uniform(1 - self.upload_jitter,
+                                         1 + self.upload_jitter)
+        now = time.time()
+        metadata = dict(body.get('metadata') or {})
+        metadata['instance_uuid'] = server_id
+        image = {'id': str(uuid.uuid4()),
+                 'name': body.get('name'),
+                 'tenant': tenant,
+                 'metadata': metadata,
+                 'created_at': now,
+                 'saving_at': now + self.queued_sec,
+                 'active_at': now + self.queued_sec + upload_sec}
+        with self._lock:
+            self._images[image['id']] = image
+            self._images_created += 1
+
+        location = '%s/v2/%s/images/%s' % (self._base_url(request), tenant,
+                                           image['id'])
+        return _json_response({}, status=202, headers={'Location': location})
+
+    def _get_retention(self, request, tenant, server_id):
+        if self.retention is None:
+            return webob.exc.HTTPNotFound()
+        return _json_response({'image_schedule': {
+            'retention': self.retention}})
+
+    def _image_view(self, image):
+        now = time.time()
+        if now >= image['active_at']:
+            status, progress = 'ACTIVE', 100
+        elif now >= image['saving_at']:
+            status = 'SAVING'
+            progress = int(100 * (now - image['saving_at']) /
+                           (image['active_at'] - image['saving_at']))
+        else:
+            status, progress = 'QUEUED', 0
+        return {'id': image['id'],
+                'name': image['name'],
+                'status': status,
+                'progress': progress,
+                'metadata': image['metadata'],
+                'created': _isotime(image['created_at']),
+                'updated': _isotime(now)}
+
+    def _get_image(self, request, tenant, image_id):
+        with self._lock:
+            image = self._images.get(image_id)
+        if image is None:
+            return webob.exc.HTTPNotFound()
+        return _json_response({'image': self._image_view(image)})
+
+    def _list_images(self, request, tenant):
+        with self._lock:
+            images = [image for image in self._images.values()
+                      if image['tenant'] == tenant]
+        return _json_response({'images': [self._image_view(image)
+                                          for image in images]})
+
+    def _delete_image(self, request, tenant, image_id):
+        with self._lock:
+            image = self._images.pop(image_id, None)
+            if image is not None:
+                self._images_deleted += 1
+        if image is None:
+            return webob.exc.HTTPNotFound()
+        return webob.Response(status=204)
+
+
+def parse_float_dict(value):
+    """Parse "key:float,key:float" into a dict."""
+    result = {}
+    for item in filter(None, value.split(',')):
+        key, _sep, number = item.partition(':')
+        result[key.strip()] = float(number)
+    return result
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Fake Keystone/Nova endpoints for QonoS benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=parse_float_dict, default={},
+                        help='Seconds of latency per API family, e.g. '
+                             '"servers:0.05,image_create:0.5,images:0.02"')
+    parser.add_argument('--flavors', type=parse_float_dict,
+                        default=DEFAULT_FLAVORS,
+                        help='Image upload seconds per flavor id, e.g. '
+                             '"2:5,8:20"')
+    parser.add_argument('--upload-jitter', type=float, default=0.1,
+                        help='Fraction by which upload durations vary')
+    parser.add_argument('--queued-sec', type=float, default=0.0,
+                        help='Seconds an image is QUEUED before SAVING')
+    parser.add_argument('--retention', type=int, default=7,
+                        help='Retention returned for every server; a '
+                             'negative value answers 404')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    app = FakeNova(latencies=args.latency,
+                   flavors=args.flavors,
+                   upload_jitter=args.upload_jitter,
+                   retention=args.retention if args.retention >= 0 else None,
+                   queued_sec=args.queued_sec)
+    app.endpoint = 'http://%s:%d' % (args.host, args.port)
+    sock = eventlet.listen((args.host, args.port), backlog=4096)
+    eventlet.wsgi.server(sock, app, log_output=False)
+
+
+if __name__ == '__main__':
+    main()
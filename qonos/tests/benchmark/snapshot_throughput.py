@@ -0,0 +1,467 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+End-to-end snapshot throughput benchmark.
+
+Starts the fake Nova service, the real QonoS API (simple or sqlite backend),
+the scheduler and N workers as separate processes, creates one snapshot
+schedule per job all due at the next minute boundary, and waits for the
+jobs to finish. Reports jobs/sec, p50/p99 latency from the due time to DONE,
+and the number of requests made to the API and to Nova.
+
+Run from the top of the source tree with:
+
+    python -m qonos.tests.benchmark.snapshot_throughput --jobs 200 \\
+        --workers 4 --child-processes 8 --db sqlite \\
+        --latency servers:0.05,image_create:0.5 --flavors 2:5,8:30
+
+Job timestamps come from the API, which stores them to the second, so
+latencies have a resolution of one second.
+"""
+
+import argparse
+import datetime
+import httplib
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from qonos.tests.benchmark import fake_nova
+
+
+TOPDIR = os.path.normpath(os.path.join(os.path.dirname(__file__),
+                                       os.pardir, os.pardir, os.pardir))
+
+FINISHED_STATUSES = ('DONE', 'CANCELLED', 'HARD_TIMED_OUT', 'MAX_RETRIED')
+
+_ID_SEGMENT = re.compile(r'/[0-9a-fA-F-]{32,36}(?=/|$)')
+
+API_CONF = """[DEFAULT]
+db_api = %(db_api)s
+db_auto_create = True
+sql_connection = %(sql_connection)s
+log_file = %(log_dir)s/api.log
+
+[api]
+port = %(api_port)d
+
+[action_default]
+timeout_seconds = %(hard_timeout)d
+
+[paste_deploy]
+config_file = %(topdir)s/etc/qonos/qonos-api-paste.ini
+"""
+
+SCHEDULER_CONF = """[DEFAULT]
+log_file = %(log_dir)s/scheduler.log
+
+[scheduler]
+api_endpoint = 127.0.0.1
+api_port = %(api_port)d
+job_schedule_interval = 1
+"""
+
+WORKER_CONF = """[DEFAULT]
+log_file = %(log_dir)s/worker-%(index)d.log
+
+[worker]
+action_type = snapshot
+processor_class = qonos.worker.snapshot.snapshot.SnapshotProcessor
+api_endpoint = 127.0.0.1
+api_port = %(api_port)d
+job_poll_interval = %(job_poll_interval)d
+max_child_processes = %(child_processes)d
+
+[snapshot_worker]
+image_poll_interval_sec = %(image_poll_interval)d
+
+[nova_client_factory]
+auth_host = 127.0.0.1
+auth_port = %(nova_port)d
+"""
+
+
+class RequestCounter(object):
+    """WSGI middleware counting requests by method and path.
+
+    Ids in the path are replaced with {id}. The counts are served from
+    /_benchmark/stats.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/_benchmark/stats':
+            with self._lock:
+                body = json.dumps({'requests': self.counts})
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [body]
+
+        key = '%s %s' % (environ.get('REQUEST_METHOD'),
+                         _ID_SEGMENT.sub('/{id}', path))
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+        return self.app(environ, start_response)
+
+
+def serve_api(argv):
+    """Run the QonoS API like bin/qonos-api, counting its requests."""
+    from qonos.api import api
+    from qonos.common import config
+    from qonos.openstack.common import log
+
+    config.parse_args(argv)
+    log.setup('qonos')
+    app = RequestCounter(config.load_paste_app('qonos-api'))
+    api.API(app).run()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values, None when there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def _parse_time(value):
+    value = value.rstrip('Z')
+    for time_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError('Unknown time format: %s' % value)
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def summarize(jobs, due):
+    """Compute throughput and latency figures for a list of jobs."""
+    done = [job for job in jobs if job['status'] == 'DONE']
+    latencies = [_seconds(_parse_time(job['updated_at']) - due)
+                 for job in done]
+    lags = [_seconds(_parse_time(job['created_at']) - due) for job in jobs]
+    statuses = {}
+    for job in jobs:
+        statuses[job['status']] = statuses.get(job['status'], 0) + 1
+
+    jobs_per_sec = None
+    if latencies and max(latencies) > 0:
+        jobs_per_sec = len(done) / max(latencies)
+
+    return {'jobs': len(jobs),
+            'statuses': statuses,
+            'jobs_per_sec': jobs_per_sec,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p99': percentile(latencies, 99),
+            'latency_max': max(latencies) if latencies else None,
+            'schedule_lag_p50': percentile(lags, 50),
+            'schedule_lag_p99': percentile(lags, 99)}
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _get_json(port, path):
+    conn = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request('GET', path)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def _wait_for(port, path, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return _get_json(port, path)
+        except (socket.error, httplib.HTTPException, ValueError):
+            if time.time() > deadline:
+                raise RuntimeError('Nothing answering on port %d' % port)
+            time.sleep(0.2)
+
+
+def _format(value, unit=''):
+    if value is None:
+        return 'n/a'
+    return '%.2f%s' % (value, unit)
+
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = tempfile.mkdtemp(prefix='qonos-benchmark-')
+        self.processes = []
+        self.harness_api_requests = 0
+        self.api_port = _free_port()
+        self.nova_port = _free_port()
+        self.client = None
+
+    def _spawn(self, name, argv):
+        out = open(os.path.join(self.work_dir, '%s.out' % name), 'w')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [TOPDIR, env.get('PYTHONPATH')]))
+        process = subprocess.Popen([sys.executable] + argv, cwd=TOPDIR,
+                                   env=env, stdout=out,
+                                   stderr=subprocess.STDOUT)
+        self.processes.append((name, process))
+        return process
+
+    def _write_conf(self, name, template, **values):
+        values.update(log_dir=self.work_dir, topdir=TOPDIR,
+                      api_port=self.api_port, nova_port=self.nova_port)
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'w') as f:
+            f.write(template % values)
+        return path
+
+    def _api_call(self, func, *args, **kwargs):
+        self.harness_api_requests += 1
+        return func(*args, **kwargs)
+
+    def start_services(self):
+        args = self.args
+        self._spawn('fake-nova', [
+            '-m', 'qonos.tests.benchmark.fake_nova',
+            '--port', str(self.nova_port),
+            '--latency', ','.join('%s:%s' % item
+                                  for item in args.latency.items()),
+            '--flavors', ','.join('%s:%s' % item
+                                  for item in args.flavors.items()),
+            '--upload-jitter', str(args.upload_jitter),
+            '--retention', str(args.retention)])
+
+        if args.db == 'sqlite':
+            db_api = 'qonos.db.sqlalchemy.api'
+            sql_connection = 'sqlite:///%s/qonos.sqlite' % self.work_dir
+        else:
+            db_api = 'qonos.db.simple.api'
+            sql_connection = 'sqlite://'
+        api_conf = self._write_conf('api.conf', API_CONF, db_api=db_api,
+                                    sql_connection=sql_connection,
+                                    hard_timeout=args.hard_timeout)
+        self._spawn('api', ['-m', 'qonos.tests.benchmark.snapshot_throughput',
+                            'serve-api', '--config-file', api_conf])
+
+        _wait_for(self.nova_port, '/_stats')
+        _wait_for(self.api_port, '/_benchmark/stats')
+
+        from qonos.qonosclient import client
+        self.client = client.Client('127.0.0.1', self.api_port)
+
+    def start_processors(self):
+        scheduler_conf = self._write_conf('scheduler.conf', SCHEDULER_CONF)
+        self._spawn('scheduler', [os.path.join(TOPDIR, 'bin',
+                                               'qonos-scheduler'),
+                                  '--config-file', scheduler_conf])
+        for index in range(self.args.workers):
+            worker_conf = self._write_conf(
+                'worker-%d.conf' % index, WORKER_CONF, index=index,
+                job_poll_interval=self.args.job_poll_interval,
+                child_processes=self.args.child_processes,
+                image_poll_interval=self.args.image_poll_interval)
+            self._spawn('worker-%d' % index,
+                        [os.path.join(TOPDIR, 'bin', 'qonos-worker'),
+                         '--config-file', worker_conf])
+
+    def create_schedules(self):
+        """Create the schedules, all due at the next minute boundary."""
+        now = datetime.datetime.utcnow()
+        due = (now + datetime.timedelta(seconds=self.args.setup_sec + 60))
+        due = due.replace(second=0, microsecond=0)
+        for index in range(self.args.jobs):
+            tenant = 'tenant-%d' % (index % self.args.tenants)
+            schedule = {'schedule': {
+                'tenant': tenant,
+                'action': 'snapshot',
+                'minute': due.minute,
+                'hour': due.hour,
+                'metadata': {'instance_id': str(uuid.uuid4())},
+            }}
+            self._api_call(self.client.create_schedule, schedule)
+        return due
+
+    def list_jobs(self):
+        jobs = []
+        params = {'limit': 1000}
+        while True:
+            page = self._api_call(self.client.list_jobs, params)
+            jobs.extend(page)
+            if len(page) < params['limit']:
+                return jobs
+            params = {'limit': 1000, 'marker': page[-1]['id']}
+
+    def wait_for_jobs(self, due):
+        deadline = time.time() + self.args.timeout + max(
+            0, _seconds(due - datetime.datetime.utcnow()))
+        while True:
+            jobs = self.list_jobs()
+            finished = [job for job in jobs
+                        if job['status'] in FINISHED_STATUSES]
+            if len(finished) >= self.args.jobs:
+                return jobs
+            if time.time() > deadline:
+                sys.stderr.write('Timed out with %d of %d jobs finished\n'
+                                 % (len(finished), self.args.jobs))
+                return jobs
+            time.sleep(1)
+
+    def stop_processes(self, names=None):
+        for name, process in self.processes:
+            if names is not None and not name.startswith(names):
+                continue
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        deadline = time.time() + 15
+        for name, process in self.processes:
+            if names is not None and not name.startswith(names):
+                continue
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    def run(self):
+        try:
+            self.start_services()
+            due = self.create_schedules()
+            self.start_processors()
+            jobs = self.wait_for_jobs(due)
+            self.stop_processes(('scheduler', 'worker'))
+
+            api_stats = _get_json(self.api_port, '/_benchmark/stats')
+            nova_stats = _get_json(self.nova_port, '/_stats')
+            return summarize(jobs, due), api_stats, nova_stats
+        finally:
+            self.stop_processes()
+            if self.args.keep_dir:
+                sys.stderr.write('Logs and configuration kept in %s\n'
+                                 % self.work_dir)
+            else:
+                shutil.rmtree(self.work_dir, True)
+
+    def report(self, summary, api_stats, nova_stats, out=sys.stdout):
+        args = self.args
+        out.write('Snapshot throughput: %d jobs, %d workers x %d children, '
+                  '%s backend\n' % (args.jobs, args.workers,
+                                    args.child_processes, args.db))
+        out.write('  statuses:          %s\n' % ', '.join(
+            '%s=%d' % item for item in sorted(summary['statuses'].items())))
+        out.write('  jobs/sec:          %s\n'
+                  % _format(summary['jobs_per_sec']))
+        out.write('  latency p50/p99:   %s / %s (max %s)\n'
+                  % (_format(summary['latency_p50'], 's'),
+                     _format(summary['latency_p99'], 's'),
+                     _format(summary['latency_max'], 's')))
+        out.write('  schedule lag p50/p99: %s / %s\n'
+                  % (_format(summary['schedule_lag_p50'], 's'),
+                     _format(summary['schedule_lag_p99'], 's')))
+
+        api_requests = api_stats['requests']
+        total = sum(api_requests.values()) - self.harness_api_requests
+        out.write('  API requests:      %d (excluding %d made by the '
+                  'benchmark)\n' % (total, self.harness_api_requests))
+        for key, count in sorted(api_requests.items()):
+            out.write('    %-40s %d\n' % (key, count))
+
+        nova_requests = nova_stats['requests']
+        out.write('  Nova requests:     %d\n' % nova_requests['total'])
+        for family in fake_nova.API_FAMILIES:
+            out.write('    %-40s %d\n' % (family, nova_requests[family]))
+        if summary['jobs']:
+            out.write('  Nova requests/job: %.2f\n'
+                      % (float(nova_requests['total']) / summary['jobs']))
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='End-to-end QonoS snapshot throughput benchmark')
+    parser.add_argument('--jobs', type=int, default=50,
+                        help='Number of snapshot schedules, one job each')
+    parser.add_argument('--tenants', type=int, default=10,
+                        help='Number of tenants the schedules are spread '
+                             'over')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of worker processes')
+    parser.add_argument('--child-processes', type=int, default=0,
+                        help='max_child_processes of each worker')
+    parser.add_argument('--db', choices=('simple', 'sqlite'),
+                        default='simple', help='API database backend')
+    parser.add_argument('--job-poll-interval', type=int, default=1)
+    parser.add_argument('--image-poll-interval', type=int, default=1)
+    parser.add_argument('--latency', type=fake_nova.parse_float_dict,
+                        default={},
+                        help='Fake Nova latency per API family, e.g. '
+                             '"servers:0.05,image_create:0.5"')
+    parser.add_argument('--flavors', type=fake_nova.parse_float_dict,
+                        default={'2': 2.0, '8': 8.0},
+                        help='Fake image upload seconds per flavor id')
+    parser.add_argument('--upload-jitter', type=float, default=0.1)
+    parser.add_argument('--retention', type=int, default=7)
+    parser.add_argument('--hard-timeout', type=int, default=3600,
+                        help='Seconds after creation at which jobs hard '
+                             'time out')
+    parser.add_argument('--setup-sec', type=int, default=10,
+                        help='Minimum seconds between start and the due time '
+                             'of the schedules')
+    parser.add_argument('--timeout', type=int, default=600,
+                        help='Seconds to wait for jobs after the due time')
+    parser.add_argument('--keep-dir', action='store_true',
+                        help='Keep logs and configuration files')
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'serve-api':
+        serve_api(argv[1:])
+        return
+
+    benchmark = Benchmark(build_arg_parser().parse_args(argv))
+    summary, api_stats, nova_stats = benchmark.run()
+    benchmark.report(summary, api_stats, nova_stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,7 @@ from oslo.config import cfg
 from qonos.common import exception
 from qonos.common import timeutils
 from qonos.common import utils as qonos_utils
+from qonos.db import db_utils
 from qonos.openstack.common import uuidutils
 from qonos.tests.unit import utils as unit_utils
 from qonos.tests import utils as test_utils
@@ -139,6 +140,20 @@ class TestSchedulesDBApi(test_utils.BaseTestCase):
         self.assertEqual(len(schedules), 1)
         self.assertEqual(schedules[0]['id'], self.schedule_1['id'])
 
+    def test_schedule_get_all_instance_id_filter_after_update(self):
+        self.db_api.schedule_metadata_update(
+            self.schedule_1['id'],
+            [{'key': 'instance_id', 'value': 'my_instance_2'}])
+
+        schedules = self.db_api.schedule_get_all(
+            filter_args={'instance_id': 'my_instance_1'})
+        self.assertEqual(schedules, [])
+
+        schedules = self.db_api.schedule_get_all(
+            filter_args={'instance_id': 'my_instance_2'})
+        self.assertEqual(len(schedules), 1)
+        self.assertEqual(schedules[0]['id'], self.schedule_1['id'])
+
     def test_schedule_get_next_run_filters(self):
         filters = {}
         filters['next_run_after'] = self.schedule_1['next_run']
@@ -178,6 +193,47 @@ class TestSchedulesDBApi(test_utils.BaseTestCase):
         expected = [self.schedule_2]
         self.assertEqual(expected, schedules)
 
+    def test_schedule_get_all_sorted_by_next_run_desc(self):
+        schedule_3 = self._create_basic_schedule()
+        filters = {'sort_key': 'next_run', 'sort_dir': 'desc'}
+        schedules = self.db_api.schedule_get_all(filter_args=filters)
+        self.assertEqual([self.schedule_2['id'], self.schedule_1['id'],
+                          schedule_3['id']],
+                         [schedule['id'] for schedule in schedules])
+
+    def test_schedule_get_all_with_cursor(self):
+        schedule_3 = self._create_basic_schedule()
+        sort_keys, sort_dirs = ['next_run', 'id'], ['asc', 'asc']
+        filters = {'sort_key': 'next_run', 'limit': 1}
+        schedule_ids = []
+        while True:
+            schedules = self.db_api.schedule_get_all(filter_args=filters)
+            if not schedules:
+                break
+            schedule_ids.extend(schedule['id'] for schedule in schedules)
+            filters = {'limit': 1,
+                       'cursor': db_utils.encode_cursor(
+                           schedules[-1], sort_keys, sort_dirs)}
+
+        # NOTE: The schedule with no next_run sorts first.
+        self.assertEqual([schedule_3['id'], self.schedule_1['id'],
+                          self.schedule_2['id']], schedule_ids)
+
+    def test_schedule_get_all_sort_key_not_a_filter(self):
+        filters = {'sort_key': 'created_at', 'sort_dir': 'asc'}
+        schedules = self.db_api.schedule_get_all(filter_args=filters)
+        self.assertEqual(2, len(schedules))
+
+    def test_schedule_get_all_invalid_sort_key(self):
+        filters = {'sort_key': 'tenant'}
+        self.assertRaises(exception.InvalidSortKey,
+                          self.db_api.schedule_get_all, filters)
+
+    def test_schedule_get_all_invalid_cursor(self):
+        filters = {'cursor': 'not-a-cursor'}
+        self.assertRaises(exception.Invalid,
+                          self.db_api.schedule_get_all, filters)
+
     def test_schedule_get_by_id(self):
         fixture = {
             'tenant': str(uuid.uuid4()),
@@ -401,6 +457,75 @@ class TestSchedulesDBApi(test_utils.BaseTestCase):
                           schedule['id'], bad_expected_next_run,
                           timeutils.utcnow())
 
+    def test_job_create_from_schedule(self):
+        now = timeutils.utcnow()
+        job = self.db_api.job_create_from_schedule(
+            self.schedule_1['id'], self.schedule_1['next_run'],
+            timeout_seconds={'default': 60})
+
+        self.assertEqual(job['schedule_id'], self.schedule_1['id'])
+        self.assertEqual(job['tenant'], self.schedule_1['tenant'])
+        self.assertEqual(job['action'], 'snapshot')
+        self.assertEqual(job['status'], 'QUEUED')
+        self.assertEqual(job['timeout'], now + datetime.timedelta(seconds=60))
+        self.assertEqual(job['hard_timeout'], job['timeout'])
+        self.assertEqual(len(job['job_metadata']), 1)
+        self.assertEqual(job['job_metadata'][0]['key'], 'instance_id')
+        self.assertEqual(job['job_metadata'][0]['value'], 'my_instance_1')
+        self.assertEqual(self.db_api.job_get_by_id(job['id'])['schedule_id'],
+                         self.schedule_1['id'])
+
+        schedule = self.db_api.schedule_get_by_id(self.schedule_1['id'])
+        self.assertEqual(schedule['next_run'],
+                         qonos_utils.cron_string_to_next_datetime(
+                             30, 2, start_time=now))
+        self.assertEqual(schedule['last_scheduled'], now)
+
+    def test_job_create_from_schedule_action_timeout(self):
+        now = timeutils.utcnow()
+        job = self.db_api.job_create_from_schedule(
+            self.schedule_2['id'],
+            timeout_seconds={'default': 60, 'snapshot': 120})
+        self.assertEqual(job['timeout'],
+                         now + datetime.timedelta(seconds=120))
+
+    def test_job_create_from_schedule_job_values(self):
+        timeout = timeutils.utcnow() + datetime.timedelta(hours=1)
+        job = self.db_api.job_create_from_schedule(
+            self.schedule_2['id'],
+            job_values={'timeout': timeout, 'hard_timeout': timeout,
+                        'tenant': 'other', 'retry_count': 1})
+        self.assertEqual(job['timeout'], timeout)
+        self.assertEqual(job['tenant'], self.schedule_2['tenant'])
+        self.assertEqual(job['retry_count'], 1)
+
+    def test_job_create_from_schedule_conflict(self):
+        expected_next_run = timeutils.utcnow()
+        self.assertRaises(exception.Conflict,
+                          self.db_api.job_create_from_schedule,
+                          self.schedule_1['id'], expected_next_run,
+                          timeout_seconds={'default': 60})
+
+        schedule = self.db_api.schedule_get_by_id(self.schedule_1['id'])
+        self.assertEqual(schedule['next_run'], self.schedule_1['next_run'])
+        self.assertEqual(schedule.get('last_scheduled'), None)
+        self.assertEqual(self.db_api.job_get_all(), [])
+
+    def test_job_create_from_schedule_not_found(self):
+        self.assertRaises(exception.NotFound,
+                          self.db_api.job_create_from_schedule,
+                          str(uuid.uuid4()),
+                          timeout_seconds={'default': 60})
+
+    def test_job_create_from_schedule_missing_timeout(self):
+        self.assertRaises(exception.MissingValue,
+                          self.db_api.job_create_from_schedule,
+                          self.schedule_1['id'])
+
+        schedule = self.db_api.schedule_get_by_id(self.schedule_1['id'])
+        self.assertEqual(schedule['next_run'], self.schedule_1['next_run'])
+        self.assertEqual(self.db_api.job_get_all(), [])
+
     def test_schedule_delete(self):
         schedules = self.db_api.schedule_get_all()
         self.assertEqual(len(schedules), 2)
@@ -605,6 +730,17 @@ class TestWorkersDBApi(test_utils.BaseTestCase):
         expected = [self.worker_2]
         self.assertEqual(expected, workers)
 
+    def test_worker_get_all_sorted_by_host(self):
+        params = {'sort_key': 'host', 'limit': 1}
+        workers = self.db_api.worker_get_all(params=params)
+        self.assertEqual([self.worker_2], workers)
+
+        params = {'cursor': db_utils.encode_cursor(workers[0],
+                                                   ['host', 'id'],
+                                                   ['asc', 'asc'])}
+        workers = self.db_api.worker_get_all(params=params)
+        self.assertEqual([self.worker_1], workers)
+
     def test_worker_get_by_id(self):
         actual = self.db_api.worker_get_by_id(self.worker_1['id'])
         self.assertEquals(actual['id'], self.worker_1['id'])
@@ -818,6 +954,43 @@ class TestJobsDBApi(test_utils.BaseTestCase):
         expected = [self.job_2]
         self.assertEqual(expected, jobs)
 
+    def test_job_get_all_sorted_by_created_at_with_cursor(self):
+        self.addCleanup(timeutils.clear_time_override)
+        now = timeutils.utcnow()
+        for minutes in (5, 5, 10, 1):
+            timeutils.set_time_override(
+                now + datetime.timedelta(minutes=minutes))
+            self._create_basic_job()
+        expected = sorted(self.db_api.job_get_all(),
+                          key=lambda job: (job['created_at'], job['id']),
+                          reverse=True)
+
+        sort_keys, sort_dirs = ['created_at', 'id'], ['desc', 'desc']
+        params = {'sort_key': 'created_at', 'sort_dir': 'desc', 'limit': 2}
+        jobs = []
+        while True:
+            page = self.db_api.job_get_all(params=params)
+            if not page:
+                break
+            jobs.extend(page)
+            params = {'limit': 2,
+                      'cursor': db_utils.encode_cursor(page[-1], sort_keys,
+                                                       sort_dirs)}
+
+        self.assertEqual(6, len(jobs))
+        self.assertEqual([job['id'] for job in expected],
+                         [job['id'] for job in jobs])
+
+    def test_job_get_all_with_marker_and_sort(self):
+        params = {'marker': self.job_2['id'], 'sort_dir': 'desc'}
+        jobs = self.db_api.job_get_all(params=params)
+        self.assertEqual([self.job_1], jobs)
+
+    def test_job_get_all_invalid_sort_dir(self):
+        params = {'sort_key': 'created_at', 'sort_dir': 'sideways'}
+        self.assertRaises(exception.Invalid,
+                          self.db_api.job_get_all, params)
+
     def test_job_get_all_with_schedule_id_filter(self):
         params = {}
         params['schedule_id'] = unit_utils.SCHEDULE_UUID2
@@ -1249,6 +1422,41 @@ class TestJobsDBGetNextJobApi(test_utils.BaseTestCase):
             timeutils.advance_time_seconds(gap)
         return now
 
+    def test_job_stats(self):
+        other_action = dict(self.job_fixture_1, action='test_action',
+                            tenant=unit_utils.TENANT2)
+        self._create_jobs(10, self.job_fixture_1, self.job_fixture_2,
+                          self.job_fixture_3, other_action)
+
+        stats = self.db_api.job_stats()
+
+        self.assertEqual(4, stats['total'])
+        self.assertEqual(2, stats['claimable'])
+        self.assertEqual({'statuses': {'QUEUED': 2, 'DONE': 1},
+                          'total': 3,
+                          'claimable': 1,
+                          'oldest_claimable': self.jobs[0]['updated_at']},
+                         stats['actions']['snapshot'])
+        self.assertEqual({'statuses': {'QUEUED': 1},
+                          'total': 1,
+                          'claimable': 1,
+                          'oldest_claimable': self.jobs[3]['updated_at']},
+                         stats['actions']['test_action'])
+
+    def test_job_stats_by_tenant(self):
+        other_action = dict(self.job_fixture_1, action='test_action',
+                            tenant=unit_utils.TENANT2)
+        self._create_jobs(10, self.job_fixture_1, other_action)
+
+        stats = self.db_api.job_stats(unit_utils.TENANT2)
+
+        self.assertEqual(['test_action'], stats['actions'].keys())
+        self.assertEqual(1, stats['total'])
+
+    def test_job_stats_no_jobs(self):
+        self.assertEqual({'actions': {}, 'total': 0, 'claimable': 0},
+                         self.db_api.job_stats())
+
     def test_get_next_job_unassigned(self):
         now = timeutils.utcnow()
         new_timeout = now + datetime.timedelta(hours=3)
@@ -1454,3 +1662,111 @@ class TestJobFaultDBApi(test_utils.BaseTestCase):
         self.assertEqual(job_fault['job_metadata'], fixture['job_metadata'])
         self.assertNotEqual(job_fault['created_at'], None)
         self.assertNotEqual(job_fault['updated_at'], None)
+
+
+class PurgeFixtureMixin(object):
+    """The db api and old and recent jobs and faults, without the purge
+    tests."""
+
+    def setUp(self):
+        super(PurgeFixtureMixin, self).setUp()
+        self.db_api = db_api
+        self.now = datetime.datetime(2013, 6, 1, 12, 0)
+        self.older_than = self.now - datetime.timedelta(days=30)
+
+    def tearDown(self):
+        super(PurgeFixtureMixin, self).tearDown()
+        timeutils.clear_time_override()
+        self.db_api.reset()
+
+    def _create_job(self, status, days_old, hard_timeout_days=1):
+        timeutils.set_time_override(
+            self.now - datetime.timedelta(days=days_old))
+        hard_timeout = timeutils.utcnow() + datetime.timedelta(
+            days=hard_timeout_days)
+        job = self.db_api.job_create({
+            'action': 'snapshot',
+            'tenant': unit_utils.TENANT1,
+            'schedule_id': str(uuid.uuid4()),
+            'status': status,
+            'timeout': hard_timeout,
+            'hard_timeout': hard_timeout,
+            'job_metadata': [{'key': 'instance_id', 'value': 'INSTANCE'}],
+        })
+        timeutils.clear_time_override()
+        return job['id']
+
+    def _create_fault(self, days_old):
+        timeutils.set_time_override(
+            self.now - datetime.timedelta(days=days_old))
+        fault = self.db_api.job_fault_create({
+            'schedule_id': str(uuid.uuid4()),
+            'tenant': unit_utils.TENANT1,
+            'worker_id': str(uuid.uuid4()),
+            'job_id': str(uuid.uuid4()),
+            'action': 'snapshot',
+        })
+        timeutils.clear_time_override()
+        return fault
+
+    def _job_ids(self):
+        return set(job['id'] for job in self.db_api.job_get_all())
+
+
+class TestPurgeDBApi(PurgeFixtureMixin, test_utils.BaseTestCase):
+
+    def test_job_purge_batch(self):
+        old_done = self._create_job('DONE', 40)
+        old_cancelled = self._create_job('CANCELLED', 40)
+        old_max_retried = self._create_job('MAX_RETRIED', 40)
+        old_queued = self._create_job('QUEUED', 40, hard_timeout_days=60)
+        abandoned = self._create_job('PROCESSING', 40)
+        recent_done = self._create_job('DONE', 5)
+
+        result = self.db_api.job_purge_batch(self.older_than, 10)
+
+        self.assertEqual({'jobs': 4, 'job_metadata': 4}, result)
+        self.assertEqual(set([old_queued, recent_done]), self._job_ids())
+        for job_id in (old_done, old_cancelled, old_max_retried, abandoned):
+            self.assertRaises(exception.NotFound,
+                              self.db_api.job_get_by_id, job_id)
+
+    def test_job_purge_batch_size(self):
+        for i in range(5):
+            self._create_job('DONE', 40)
+
+        result = self.db_api.job_purge_batch(self.older_than, 3)
+        self.assertEqual({'jobs': 3, 'job_metadata': 3}, result)
+        self.assertEqual(2, len(self._job_ids()))
+
+        result = self.db_api.job_purge_batch(self.older_than, 3)
+        self.assertEqual({'jobs': 2, 'job_metadata': 2}, result)
+        self.assertEqual(set(), self._job_ids())
+
+    def test_job_purge_batch_nothing_to_purge(self):
+        job_id = self._create_job('DONE', 5)
+
+        result = self.db_api.job_purge_batch(self.older_than, 10)
+
+        self.assertEqual({'jobs': 0, 'job_metadata': 0}, result)
+        self.assertEqual(set([job_id]), self._job_ids())
+
+    def test_job_fault_purge_batch(self):
+        old_faults = [self._create_fault(40), self._create_fault(40)]
+        recent_fault = self._create_fault(5)
+
+        result = self.db_api.job_fault_purge_batch(self.older_than, 1)
+        self.assertEqual({'job_faults': 1}, result)
+
+        result = self.db_api.job_fault_purge_batch(self.older_than, 10)
+        self.assertEqual({'job_faults': 1}, result)
+
+        result = self.db_api.job_fault_purge_batch(self.older_than, 10)
+        self.assertEqual({'job_faults': 0}, result)
+
+        for fault in old_faults:
+            self.assertEqual(None, self.db_api.job_fault_latest_for_job_id(
+                fault['job_id']))
+        self.assertEqual(recent_fault['id'],
+                         self.db_api.job_fault_latest_for_job_id(
+                             recent_fault['job_id'])['id'])
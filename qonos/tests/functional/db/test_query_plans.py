@@ -0,0 +1,256 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Query plan checks for the hot database queries.
+
+The db api calls are run against a small seeded database while the
+statements they send are captured, then each statement is EXPLAINed and
+the plan checked for full table scans and sorts. The checks run on SQLite
+and, when the qonos_citest database used by the migration tests is
+reachable, on MySQL.
+"""
+
+import datetime
+import re
+
+import sqlalchemy
+
+from qonos.common import timeutils
+from qonos.db import db_utils
+import qonos.db.sqlalchemy.api as db_api
+from qonos.db.sqlalchemy import models
+from qonos.openstack.common import uuidutils
+from qonos.tests.unit.db import test_migrations
+from qonos.tests import utils
+
+
+_CAPTURED = {}
+
+
+def _capture_statement(conn, cursor, statement, parameters, context,
+                       executemany):
+    statements = _CAPTURED.get(id(conn.engine))
+    if statements is not None and not executemany:
+        statements.append((statement, parameters))
+
+
+def explain(engine, statement, parameters):
+    """Return the plan of statement as a list of dicts, one per row."""
+    if engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(prefix + statement, parameters)
+        columns = [column[0].lower() for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def plan_problems(dialect_name, plan, allow_sort=False,
+                  allow_index_scan=True):
+    """Return descriptions of the full scans and sorts found in plan.
+
+    A scan of a whole index is only a problem when allow_index_scan is
+    False, for the statements whose filters an index should narrow down.
+    """
+    problems = []
+    for row in plan:
+        if dialect_name == 'sqlite':
+            detail = row['detail']
+            match = re.match(r'SCAN (TABLE )?(\w+)', detail)
+            if match and ('USING' not in detail or not allow_index_scan):
+                problems.append('full scan of %s' % match.group(2))
+            if 'USE TEMP B-TREE' in detail and not allow_sort:
+                problems.append('sort: %s' % detail)
+        else:
+            if row.get('type') == 'ALL':
+                problems.append('full scan of %s' % row['table'])
+            if row.get('type') == 'index' and not allow_index_scan:
+                problems.append('full index scan of %s' % row['table'])
+            if 'filesort' in (row.get('extra') or '') and not allow_sort:
+                problems.append('filesort on %s' % row['table'])
+    return problems
+
+
+class QueryPlanTestMixin(object):
+
+    def setUp(self):
+        super(QueryPlanTestMixin, self).setUp()
+        self.engine = self._create_engine()
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute',
+                                _capture_statement)
+        models.unregister_models(self.engine)
+        models.register_models(self.engine)
+        self.addCleanup(models.unregister_models, self.engine)
+
+        self.stubs.Set(db_api, '_ENGINE', self.engine)
+        self.stubs.Set(db_api, '_MAKERS', {})
+        self._seed()
+
+    def _seed(self):
+        now = timeutils.utcnow()
+        statuses = ['QUEUED', 'PROCESSING', 'DONE', 'ERROR', 'TIMED_OUT']
+        jobs = []
+        for i in range(500):
+            jobs.append({
+                'id': uuidutils.generate_uuid(),
+                'tenant': 'TENANT_%d' % (i % 20),
+                'action': 'snapshot' if i % 4 else 'other',
+                'status': statuses[i % len(statuses)],
+                'worker_id': None if i % 3 else uuidutils.generate_uuid(),
+                'retry_count': 0,
+                'timeout': now + datetime.timedelta(minutes=i % 60 - 30),
+                'hard_timeout': now + datetime.timedelta(hours=i % 8),
+                'created_at': now - datetime.timedelta(minutes=i),
+                'updated_at': now - datetime.timedelta(minutes=i),
+            })
+        self.engine.execute(models.Job.__table__.insert(), jobs)
+
+        schedules = []
+        for i in range(200):
+            schedules.append({
+                'id': uuidutils.generate_uuid(),
+                'tenant': 'TENANT_%d' % (i % 20),
+                'action': 'snapshot',
+                'hour': i % 24,
+                'minute': i % 60,
+                'next_run': now + datetime.timedelta(minutes=i),
+                'created_at': now,
+                'updated_at': now,
+            })
+        self.engine.execute(models.Schedule.__table__.insert(), schedules)
+
+        metadata = []
+        for schedule in schedules:
+            value = 'INSTANCE_%s' % schedule['id']
+            metadata.append({
+                'id': uuidutils.generate_uuid(),
+                'schedule_id': schedule['id'],
+                'key': 'instance_id',
+                'value': value,
+                'value_hash': models.metadata_value_hash(value),
+                'created_at': now,
+                'updated_at': now,
+            })
+        self.engine.execute(models.ScheduleMetadata.__table__.insert(),
+                            metadata)
+        self.instance_id = metadata[0]['value']
+        self.schedule_id = schedules[0]['id']
+
+    def _capture(self, func, *args, **kwargs):
+        statements = []
+        _CAPTURED[id(self.engine)] = statements
+        try:
+            func(*args, **kwargs)
+        finally:
+            del _CAPTURED[id(self.engine)]
+        return [(statement, parameters) for statement, parameters
+                in statements
+                if re.match(r'\s*(SELECT|DELETE)', statement, re.I)]
+
+    def _assert_plans_ok(self, statements, allow_sort=False,
+                         allow_index_scan=True):
+        self.assertTrue(statements)
+        for statement, parameters in statements:
+            plan = explain(self.engine, statement, parameters)
+            problems = plan_problems(self.engine.dialect.name, plan,
+                                     allow_sort, allow_index_scan)
+            self.assertEqual([], problems,
+                             '%s\n%s\n%s' % (statement, parameters, plan))
+
+    def test_job_get_next_by_action(self):
+        session = db_api.get_session()
+        statements = self._capture(db_api._job_get_next_by_action,
+                                   session, timeutils.utcnow(), 'snapshot')
+        self._assert_plans_ok(statements[:1])
+
+    def test_jobs_cleanup_hard_timed_out(self):
+        statements = self._capture(db_api._jobs_cleanup_hard_timed_out)
+        self._assert_plans_ok(statements)
+
+    def test_schedule_get_all_due(self):
+        now = timeutils.utcnow()
+        filter_args = {'next_run_after': now - datetime.timedelta(minutes=1),
+                       'next_run_before': now}
+        statements = self._capture(db_api.schedule_get_all, filter_args)
+        # NOTE: The due schedules are paginated by id, so a sort of the
+        # ones selected through next_run_idx is expected.
+        self._assert_plans_ok(statements, allow_sort=True)
+
+    def test_schedule_get_all_by_metadata(self):
+        filter_args = {'instance_id': self.instance_id}
+        statements = self._capture(db_api.schedule_get_all, filter_args)
+        self._assert_plans_ok(statements)
+
+    def test_job_get_all_by_tenant_and_status(self):
+        filter_args = {'tenant': 'TENANT_3', 'status': 'ERROR'}
+        statements = self._capture(db_api.job_get_all, filter_args)
+        self._assert_plans_ok(statements[:1], allow_sort=True,
+                              allow_index_scan=False)
+
+    def test_job_get_all_by_schedule(self):
+        filter_args = {'schedule_id': self.schedule_id}
+        statements = self._capture(db_api.job_get_all, filter_args)
+        self._assert_plans_ok(statements[:1], allow_sort=True,
+                              allow_index_scan=False)
+
+    def test_schedule_get_all_by_tenant(self):
+        filter_args = {'tenant': 'TENANT_3', 'action': 'snapshot'}
+        statements = self._capture(db_api.schedule_get_all, filter_args)
+        self._assert_plans_ok(statements[:1], allow_sort=True,
+                              allow_index_scan=False)
+
+    def test_job_get_all_after_cursor(self):
+        page = db_api.job_get_all({'sort_key': 'created_at',
+                                   'sort_dir': 'desc', 'limit': 400})
+        cursor = db_utils.encode_cursor(page[-1], ['created_at', 'id'],
+                                        ['desc', 'desc'])
+        statements = self._capture(db_api.job_get_all,
+                                   {'cursor': cursor, 'limit': 50})
+        self._assert_plans_ok(statements[:1])
+
+    def test_schedule_get_all_after_cursor(self):
+        page = db_api.schedule_get_all({'sort_key': 'next_run',
+                                        'limit': 150})
+        cursor = db_utils.encode_cursor(page[-1], ['next_run', 'id'],
+                                        ['asc', 'asc'])
+        statements = self._capture(db_api.schedule_get_all,
+                                   {'cursor': cursor, 'limit': 25})
+        self._assert_plans_ok(statements[:1])
+
+
+class TestSqliteQueryPlans(QueryPlanTestMixin, utils.BaseTestCase):
+
+    def _create_engine(self):
+        return sqlalchemy.create_engine('sqlite://')
+
+
+class TestMysqlQueryPlans(QueryPlanTestMixin, utils.BaseTestCase):
+
+    def setUp(self):
+        if not test_migrations._is_backend_avail('mysql'):
+            self.skipTest('mysql not available')
+        super(TestMysqlQueryPlans, self).setUp()
+
+    def _create_engine(self):
+        return sqlalchemy.create_engine(
+            test_migrations._get_connect_string('mysql'))
@@ -0,0 +1,254 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+from oslo.config import cfg
+
+from qonos.common import exception
+from qonos.common import timeutils
+import qonos.db.sharded.api
+from qonos.db.sqlalchemy import models
+from qonos.tests.functional.db import base
+from qonos.tests import utils
+
+
+CONF = cfg.CONF
+
+_SHARD_DIR = None
+
+
+def setUpModule():
+    """Run the cross driver db tests on three sqlite file shards, the
+    first being the sql_connection database."""
+    global _SHARD_DIR
+    _SHARD_DIR = tempfile.mkdtemp()
+    CONF.set_override('sql_shard_connections',
+                      ['sqlite:///%s' % os.path.join(_SHARD_DIR, name)
+                       for name in ('shard1.sqlite', 'shard2.sqlite')])
+    base.db_api = qonos.db.sharded.api
+    base.db_api.configure_db()
+
+
+def tearDownModule():
+    """Reset get_db and reset_db for cleanliness."""
+    for engine in qonos.db.sharded.api._SHARDS[1:]:
+        engine.dispose()
+    qonos.db.sharded.api._SHARDS = []
+    qonos.db.sharded.api._RING = None
+    CONF.clear_override('sql_shard_connections')
+    shutil.rmtree(_SHARD_DIR)
+    base.db_api = None
+
+
+# NOTE(ameade): Pull in cross driver db tests
+thismodule = sys.modules[__name__]
+utils.import_test_cases(thismodule, base, suffix="_Sharded_DB")
+
+
+class TestShardedDBApi(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestShardedDBApi, self).setUp()
+        self.db_api = qonos.db.sharded.api
+        self.addCleanup(self.db_api.reset)
+        self.now = timeutils.utcnow()
+
+    def _tenant_on(self, shard):
+        while True:
+            tenant = str(uuid.uuid4())
+            if self.db_api._tenant_shard(tenant) == shard:
+                return tenant
+
+    def _shard_rows(self, model):
+        return [engine.execute(model.__table__.select()).fetchall()
+                for engine in self.db_api._SHARDS]
+
+    def _create_schedule(self, tenant, **values):
+        fixture = {'tenant': tenant, 'action': 'snapshot', 'hour': 2,
+                   'minute': 30}
+        fixture.update(values)
+        return self.db_api.schedule_create(fixture)
+
+    def _create_job(self, tenant, **values):
+        fixture = {'tenant': tenant, 'action': 'snapshot',
+                   'status': 'QUEUED',
+                   'timeout': self.now - datetime.timedelta(hours=1),
+                   'hard_timeout': self.now + datetime.timedelta(hours=1)}
+        fixture.update(values)
+        return self.db_api.job_create(fixture)
+
+    def test_schedules_on_tenant_shard(self):
+        schedules = [self._create_schedule(self._tenant_on(shard))
+                     for shard in (0, 1, 2, 2)]
+
+        rows = self._shard_rows(models.Schedule)
+        self.assertEqual([1, 1, 2], [len(shard_rows) for shard_rows in rows])
+        for schedule in schedules:
+            shard = self.db_api._tenant_shard(schedule['tenant'])
+            self.assertEqual(shard, self.db_api._RING.get_node(
+                schedule['id']))
+            self.assertIn(schedule['id'], [row.id for row in rows[shard]])
+
+    def test_jobs_from_schedule_on_schedule_shard(self):
+        schedule = self._create_schedule(self._tenant_on(1))
+
+        job = self.db_api.job_create_from_schedule(
+            schedule['id'], timeout_seconds={'default': 60})
+
+        self.assertEqual(1, self.db_api._RING.get_node(job['id']))
+        self.assertEqual([[], [job['id']], []],
+                         [[row.id for row in shard_rows] for shard_rows
+                          in self._shard_rows(models.Job)])
+        self.assertEqual(job['id'],
+                         self.db_api.job_get_by_id(job['id'])['id'])
+
+    def test_get_by_given_id_on_other_shard(self):
+        tenant = self._tenant_on(2)
+        schedule_id = str(uuid.uuid4())
+        while self.db_api._RING.get_node(schedule_id) == 2:
+            schedule_id = str(uuid.uuid4())
+
+        self._create_schedule(tenant, id=schedule_id)
+
+        schedule = self.db_api.schedule_get_by_id(schedule_id)
+        self.assertEqual(tenant, schedule['tenant'])
+        self.assertRaises(exception.NotFound, self.db_api.schedule_get_by_id,
+                          str(uuid.uuid4()))
+
+    def test_workers_on_first_shard(self):
+        worker = self.db_api.worker_create({'host': 'worker1'})
+
+        self.assertEqual([[worker['id']], [], []],
+                         [[row.id for row in shard_rows] for shard_rows
+                          in self._shard_rows(models.Worker)])
+
+    def test_schedule_get_all_merges_shards(self):
+        for minute, shard in enumerate((2, 0, 1, 2, 1, 0)):
+            timeutils.set_time_override(self.now +
+                                        datetime.timedelta(minutes=minute))
+            self._create_schedule(self._tenant_on(shard))
+        timeutils.clear_time_override()
+
+        params = {'sort_key': 'created_at', 'sort_dir': 'desc', 'limit': 4}
+        page = self.db_api.schedule_get_all(dict(params))
+        next_page = self.db_api.schedule_get_all(
+            dict(params, marker=page[-1]['id']))
+
+        self.assertEqual(4, len(page))
+        self.assertEqual([0, 1, 2, 1, 0, 2],
+                         [self.db_api._tenant_shard(schedule['tenant'])
+                          for schedule in page + next_page])
+        created = [schedule['created_at'] for schedule in page + next_page]
+        self.assertEqual(sorted(created, reverse=True), created)
+
+    def test_schedule_get_all_by_tenant(self):
+        tenant = self._tenant_on(1)
+        schedule = self._create_schedule(tenant)
+        self._create_schedule(self._tenant_on(0))
+
+        schedules = self.db_api.schedule_get_all({'tenant': tenant})
+
+        self.assertEqual([schedule['id']], [s['id'] for s in schedules])
+
+    def test_tenant_lists_after_resharding(self):
+        tenant = self._tenant_on(1)
+        schedule = self._create_schedule(tenant)
+        job = self._create_job(tenant)
+        # NOTE: As if a shard added since placed the tenant on shard 2.
+        self.stubs.Set(self.db_api, '_tenant_shard', lambda tenant: 2)
+        new_schedule = self._create_schedule(tenant)
+        new_job = self._create_job(tenant, status='DONE')
+
+        schedules = self.db_api.schedule_get_all({'tenant': tenant})
+        jobs = self.db_api.job_get_all({'tenant': tenant})
+        stats = self.db_api.job_stats(tenant)
+
+        self.assertEqual(sorted([schedule['id'], new_schedule['id']]),
+                         sorted(s['id'] for s in schedules))
+        self.assertEqual(sorted([job['id'], new_job['id']]),
+                         sorted(j['id'] for j in jobs))
+        self.assertEqual(2, stats['total'])
+        self.assertEqual(1, stats['claimable'])
+
+    def test_schedule_update_tenant_on_other_shard(self):
+        schedule = self._create_schedule(self._tenant_on(0))
+
+        self.assertRaises(exception.Invalid, self.db_api.schedule_update,
+                          schedule['id'], {'tenant': self._tenant_on(1)})
+
+        tenant = self._tenant_on(0)
+        updated = self.db_api.schedule_update(schedule['id'],
+                                              {'tenant': tenant})
+        self.assertEqual(tenant, updated['tenant'])
+
+    def test_schedule_update_same_tenant_on_other_shard(self):
+        tenant = self._tenant_on(1)
+        schedule = self._create_schedule(tenant)
+        # NOTE: As if the tenant were placed on another shard since.
+        self.stubs.Set(self.db_api, '_tenant_shard', lambda tenant: 0)
+
+        updated = self.db_api.schedule_update(schedule['id'],
+                                              {'tenant': tenant, 'hour': 5})
+
+        self.assertEqual(5, updated['hour'])
+
+    def test_claims_rotate_over_shards(self):
+        for shard in (0, 1, 2):
+            self._create_job(self._tenant_on(shard))
+            self._create_job(self._tenant_on(shard))
+        self.stubs.Set(self.db_api, '_CLAIMS', iter(range(10)))
+        new_timeout = self.now + datetime.timedelta(hours=1)
+
+        jobs = [self.db_api.job_get_and_assign_next_by_action(
+                'snapshot', 'worker1', new_timeout) for _i in xrange(7)]
+
+        self.assertEqual([0, 1, 2, 0, 1, 2],
+                         [self.db_api._tenant_shard(job['tenant'])
+                          for job in jobs[:6]])
+        self.assertEqual(None, jobs[6])
+
+    def test_job_stats_merges_shards(self):
+        self._create_job(self._tenant_on(0))
+        self._create_job(self._tenant_on(1), status='DONE')
+        tenant = self._tenant_on(2)
+        self._create_job(tenant)
+
+        stats = self.db_api.job_stats()
+
+        self.assertEqual(3, stats['total'])
+        self.assertEqual(2, stats['claimable'])
+        self.assertEqual({'QUEUED': 2, 'DONE': 1},
+                         stats['actions']['snapshot']['statuses'])
+        self.assertEqual(1, self.db_api.job_stats(tenant)['total'])
+
+    def test_job_purge_batch_on_every_shard(self):
+        old = self.now - datetime.timedelta(days=30)
+        timeutils.set_time_override(old)
+        for shard in (0, 1, 2):
+            self._create_job(self._tenant_on(shard), status='DONE')
+        timeutils.clear_time_override()
+
+        counts = self.db_api.job_purge_batch(self.now, 10)
+
+        self.assertEqual(3, counts['jobs'])
+        self.assertEqual([0, 0, 0], [len(shard_rows) for shard_rows
+                                     in self._shard_rows(models.Job)])
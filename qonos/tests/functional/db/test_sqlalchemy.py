@@ -19,19 +19,38 @@ import logging
 import mock
 import StringIO
 import sys
+import time
+import uuid
 
+import sqlalchemy
 
+
+from qonos.common import exception
+from qonos.common import metrics
 from qonos.common import timeutils
 import qonos.db.sqlalchemy.api
+from qonos.db.sqlalchemy import models
 from qonos.openstack.common.gettextutils import _
 from qonos.tests.functional.db import base
+from qonos.tests.unit import utils as unit_utils
 from qonos.tests import utils
 
 
+_STATEMENTS = []
+
+
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if _STATEMENTS:
+        _STATEMENTS[-1].append(statement)
+
+
 def setUpModule():
     """Stub in get_db and reset_db for testing the simple db api."""
     base.db_api = qonos.db.sqlalchemy.api
     base.db_api.configure_db()
+    sqlalchemy.event.listen(base.db_api.get_engine(), 'before_cursor_execute',
+                            _count_statement)
 
 
 def tearDownModule():
@@ -44,6 +63,34 @@ thismodule = sys.modules[__name__]
 utils.import_test_cases(thismodule, base, suffix="_Sqlalchemy_DB")
 
 
+class JobFixtureMixin(object):
+    """The db api and a claimable job fixture, without the claim tests."""
+
+    def setUp(self):
+        super(JobFixtureMixin, self).setUp()
+        self.db_api = base.db_api
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        self.addCleanup(self.db_api.reset)
+        timeout = timeutils.utcnow() + datetime.timedelta(seconds=30)
+        self.job_fixture_1 = {
+            'action': 'snapshot',
+            'tenant': unit_utils.TENANT1,
+            'schedule_id': unit_utils.SCHEDULE_UUID1,
+            'worker_id': None,
+            'status': 'QUEUED',
+            'timeout': timeout,
+            'hard_timeout': timeout,
+            'retry_count': 0,
+        }
+
+    def _create_jobs(self, gap, *fixtures):
+        self.jobs = []
+        for fixture in fixtures:
+            self.jobs.append(self.db_api.job_create(fixture))
+            timeutils.advance_time_seconds(gap)
+
+
 class TestSQLAlchemyOptimisticLocking(base.TestJobsDBGetNextJobApi):
 
     def _setup_db_api_log_fixture(self, stream):
@@ -107,3 +154,614 @@ class TestSQLAlchemyOptimisticLocking(base.TestJobsDBGetNextJobApi):
                                            'job_id': same_job_ref_2['id']}
             self.assertEqual(stale_data_err_msg,
                              stream.getvalue().rstrip('\n'))
+
+
+class TestSQLAlchemySkipLockedClaims(JobFixtureMixin, utils.BaseTestCase):
+    """Claim jobs through the SKIP LOCKED path.
+
+    SQLite drops the locking clause, so this only covers the claim logic.
+    """
+
+    def setUp(self):
+        super(TestSQLAlchemySkipLockedClaims, self).setUp()
+        self.config(job_claim_strategy='skip_locked')
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.new_timeout = timeutils.utcnow() + datetime.timedelta(hours=3)
+
+    def _claim(self):
+        return self.db_api.job_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, self.new_timeout)
+
+    def test_claims_oldest_job(self):
+        self._create_jobs(10, self.job_fixture_1, self.job_fixture_1)
+
+        job = self._claim()
+
+        self.assertEqual(self.jobs[0]['id'], job['id'])
+        self.assertEqual(unit_utils.WORKER_UUID1, job['worker_id'])
+        self.assertEqual(self.new_timeout, job['timeout'])
+        self.assertEqual(1, job['retry_count'])
+        self.assertEqual({'db.job_claim.skip_locked.claimed': 1},
+                         metrics.get_stats()['counters'])
+
+    def test_claims_each_job_once(self):
+        self._create_jobs(10, self.job_fixture_1, self.job_fixture_1)
+
+        jobs = [self._claim() for _i in range(3)]
+
+        self.assertEqual([job['id'] for job in self.jobs],
+                         [job['id'] for job in jobs[:2]])
+        self.assertEqual(None, jobs[2])
+
+    def test_skips_job_of_other_worker(self):
+        self._create_jobs(10, dict(self.job_fixture_1,
+                                   worker_id=unit_utils.WORKER_UUID2))
+
+        self.assertEqual(None, self._claim())
+
+
+class TestSQLAlchemyProjections(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSQLAlchemyProjections, self).setUp()
+        self.db_api = base.db_api
+        self.addCleanup(self.db_api.reset)
+        self.schedule_1 = self.db_api.schedule_create({
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'minute': 30,
+            'hour': 2,
+            'schedule_metadata': [{'key': 'instance_id',
+                                   'value': 'my_instance_1'}],
+        })
+
+    def test_schedule_get_all_metadata_fetched_in_chunks(self):
+        self.stubs.Set(base.db_api, '_IN_CHUNK_SIZE', 1)
+        for i in range(3):
+            self.db_api.schedule_create({
+                'tenant': 'TENANT_CHUNK',
+                'action': 'snapshot',
+                'schedule_metadata': [{'key': 'instance_id',
+                                       'value': 'instance_%d' % i}],
+            })
+
+        schedules = self.db_api.schedule_get_all({'tenant': 'TENANT_CHUNK'})
+
+        self.assertEqual(3, len(schedules))
+        values = sorted(schedule['schedule_metadata'][0]['value']
+                        for schedule in schedules)
+        self.assertEqual(['instance_0', 'instance_1', 'instance_2'], values)
+        for schedule in schedules:
+            meta = schedule['schedule_metadata'][0]
+            self.assertEqual(schedule['id'], meta['schedule_id'])
+
+    def test_schedule_get_by_id_matches_orm_result(self):
+        expected = base.db_api.force_dict(base.db_api._schedule_get_by_id)(
+            self.schedule_1['id'])
+        # NOTE: metadata_json is how metadata is stored, never returned.
+        del expected['metadata_json']
+
+        schedule = self.db_api.schedule_get_by_id(self.schedule_1['id'])
+
+        self.assertEqual(expected, schedule)
+
+
+class TestSQLAlchemyArchive(base.PurgeFixtureMixin, utils.BaseTestCase):
+
+    def _shadow_ids(self, table_name, column='id'):
+        table = models.SHADOW_TABLES[table_name]
+        engine = self.db_api.get_engine()
+        return set(row[0] for row in
+                   engine.execute(sqlalchemy.select([table.c[column]])))
+
+    def test_job_purge_batch_archive(self):
+        old_done = self._create_job('DONE', 40)
+        recent_done = self._create_job('DONE', 5)
+
+        result = self.db_api.job_purge_batch(self.older_than, 10,
+                                             archive=True)
+
+        self.assertEqual({'jobs': 1, 'job_metadata': 1}, result)
+        self.assertEqual(set([recent_done]), self._job_ids())
+        self.assertEqual(set([old_done]), self._shadow_ids('jobs'))
+        self.assertEqual(set([old_done]),
+                         self._shadow_ids('job_metadata', 'job_id'))
+
+    def test_job_fault_purge_batch_archive(self):
+        old_fault = self._create_fault(40)
+        self._create_fault(5)
+
+        result = self.db_api.job_fault_purge_batch(self.older_than, 10,
+                                                   archive=True)
+
+        self.assertEqual({'job_faults': 1}, result)
+        self.assertEqual(set([old_fault['id']]),
+                         self._shadow_ids('job_faults'))
+
+
+class TestSQLAlchemySlaveReads(utils.BaseTestCase):
+    """Reads go to an empty replica, writes and claims to the primary."""
+
+    def setUp(self):
+        super(TestSQLAlchemySlaveReads, self).setUp()
+        self.db_api = base.db_api
+        slave = sqlalchemy.create_engine('sqlite://')
+        models.register_models(slave)
+        self.stubs.Set(self.db_api, '_SLAVE_ENGINE', slave)
+        self.stubs.Set(self.db_api, '_MAKERS', {})
+        self.stubs.Set(self.db_api, '_SLAVE_STATE',
+                       {'checked_at': None, 'usable': False})
+        self.config(slave_max_lag=-1)
+
+    def tearDown(self):
+        super(TestSQLAlchemySlaveReads, self).tearDown()
+        self.db_api.reset()
+
+    def test_reads_use_slave(self):
+        schedule = self.db_api.schedule_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'schedule_metadata': [{'key': 'instance_id', 'value': 'I1'}]})
+        worker = self.db_api.worker_create({'host': 'host1'})
+        now = timeutils.utcnow()
+        job = self.db_api.job_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'schedule_id': schedule['id'], 'status': 'QUEUED',
+             'timeout': now, 'hard_timeout': now + datetime.timedelta(1),
+             'job_metadata': [{'key': 'instance_id', 'value': 'I1'}]})
+
+        self.assertEqual([], self.db_api.schedule_get_all())
+        self.assertEqual([], self.db_api.worker_get_all())
+        self.assertEqual([], self.db_api.job_get_all())
+        self.assertEqual([], self.db_api.job_meta_get_all_by_job_id(
+            job['id']))
+        self.assertRaises(exception.NotFound,
+                          self.db_api.schedule_get_by_id, schedule['id'])
+        self.assertRaises(exception.NotFound,
+                          self.db_api.schedule_meta_get_all, schedule['id'])
+        self.assertRaises(exception.NotFound,
+                          self.db_api.worker_get_by_id, worker['id'])
+        self.assertRaises(exception.NotFound,
+                          self.db_api.job_get_by_id, job['id'])
+
+    def test_writes_and_claims_use_primary(self):
+        schedule = self.db_api.schedule_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot'})
+        schedule = self.db_api.schedule_update(schedule['id'], {'hour': 5})
+        self.assertEqual(5, schedule['hour'])
+
+        metadata = self.db_api.schedule_metadata_update(
+            schedule['id'], [{'key': 'instance_id', 'value': 'I1'}])
+        self.assertEqual(['I1'], [meta['value'] for meta in metadata])
+
+        job = self.db_api.job_create_from_schedule(
+            schedule['id'], timeout_seconds={'default': 60})
+        claimed = self.db_api.job_get_and_assign_next_by_action(
+            'snapshot', 'WORKER_1',
+            timeutils.utcnow() + datetime.timedelta(hours=1))
+        self.assertEqual(job['id'], claimed['id'])
+
+
+class StatementCountMixin(object):
+
+    def _statements(self, func, *args, **kwargs):
+        _STATEMENTS.append([])
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            statements = _STATEMENTS.pop()
+        return result, statements
+
+    def _metadata(self, count):
+        return [{'key': 'key%d' % i, 'value': 'value%d' % i}
+                for i in range(count)]
+
+
+class TestSQLAlchemyStatementCounts(StatementCountMixin, JobFixtureMixin,
+                                    utils.BaseTestCase):
+    """Writes return the state in the session instead of reading it back."""
+
+    def test_schedule_create(self):
+        schedule, statements = self._statements(
+            self.db_api.schedule_create,
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'schedule_metadata': self._metadata(3)})
+
+        self.assertEqual(2, len(statements))
+        self.assertEqual(3, len(schedule['schedule_metadata']))
+        self.assertEqual(self.db_api.schedule_get_by_id(schedule['id']),
+                         schedule)
+
+    def test_schedule_update(self):
+        schedule = self.db_api.schedule_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'schedule_metadata': self._metadata(1)})
+
+        schedule, statements = self._statements(
+            self.db_api.schedule_update, schedule['id'],
+            {'hour': 5, 'schedule_metadata': self._metadata(1)})
+
+        self.assertEqual(3, len(statements))
+        self.assertEqual(5, schedule['hour'])
+        self.assertEqual(self.db_api.schedule_get_by_id(schedule['id']),
+                         schedule)
+
+    def test_schedule_metadata_update(self):
+        schedule = self.db_api.schedule_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'schedule_metadata': self._metadata(3)})
+        metadata = self._metadata(2) + [{'key': 'key3', 'value': 'value3'}]
+        metadata[1]['value'] = 'changed'
+
+        result, statements = self._statements(
+            self.db_api.schedule_metadata_update, schedule['id'], metadata)
+
+        # The lock of the schedule, the read of the current metadata, the
+        # delete of key2 and one upsert of key1 and key3.
+        self.assertEqual(4, len(statements))
+        self.assertEqual(['key0', 'key1', 'key3'],
+                         [meta['key'] for meta in result])
+        self.assertEqual(
+            sorted(result, key=lambda meta: meta['key']),
+            sorted(self.db_api.schedule_meta_get_all(schedule['id']),
+                   key=lambda meta: meta['key']))
+
+    def test_schedule_metadata_update_unchanged(self):
+        schedule = self.db_api.schedule_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'schedule_metadata': self._metadata(3)})
+
+        result, statements = self._statements(
+            self.db_api.schedule_metadata_update, schedule['id'],
+            self._metadata(3))
+
+        self.assertEqual(2, len(statements))
+        self.assertEqual(schedule['schedule_metadata'], result)
+
+    def test_job_metadata_update(self):
+        job = self.db_api.job_create(
+            dict(self.job_fixture_1, job_metadata=self._metadata(2)))
+        metadata = [{'key': 'key1', 'value': 'changed'},
+                    {'key': 'key2', 'value': 'value2'}]
+
+        result, statements = self._statements(
+            self.db_api.job_metadata_update, job['id'], metadata)
+
+        self.assertEqual(4, len(statements))
+        self.assertEqual(
+            sorted(result, key=lambda meta: meta['key']),
+            sorted(self.db_api.job_meta_get_all_by_job_id(job['id']),
+                   key=lambda meta: meta['key']))
+
+    def test_worker_create(self):
+        worker, statements = self._statements(self.db_api.worker_create,
+                                              {'host': 'host1'})
+
+        self.assertEqual(1, len(statements))
+        self.assertEqual(self.db_api.worker_get_by_id(worker['id']), worker)
+
+    def test_job_create(self):
+        job_values = dict(self.job_fixture_1, job_metadata=self._metadata(3))
+        job, statements = self._statements(self.db_api.job_create,
+                                           job_values)
+
+        self.assertEqual(2, len(statements))
+        self.assertEqual(3, len(job['job_metadata']))
+        self.assertEqual(self.db_api.job_get_by_id(job['id']), job)
+
+    def test_job_update(self):
+        job = self.db_api.job_create(
+            dict(self.job_fixture_1, job_metadata=self._metadata(1)))
+
+        job, statements = self._statements(self.db_api.job_update,
+                                           job['id'], {'status': 'DONE'})
+
+        self.assertEqual(2, len(statements))
+        self.assertEqual('DONE', job['status'])
+        self.assertEqual(self.db_api.job_get_by_id(job['id']), job)
+
+    def test_job_get_by_id(self):
+        job = self.db_api.job_create(
+            dict(self.job_fixture_1, job_metadata=self._metadata(2)))
+
+        result, statements = self._statements(self.db_api.job_get_by_id,
+                                              job['id'])
+
+        self.assertEqual(1, len(statements))
+        self.assertEqual(job, result)
+
+    def test_schedule_get_by_id(self):
+        schedule = self.db_api.schedule_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'schedule_metadata': self._metadata(2)})
+
+        result, statements = self._statements(
+            self.db_api.schedule_get_by_id, schedule['id'])
+
+        self.assertEqual(1, len(statements))
+        self.assertEqual(schedule, result)
+
+    def _assert_assign_statements(self):
+        self._create_jobs(10, self.job_fixture_1)
+        new_timeout = timeutils.utcnow() + datetime.timedelta(hours=3)
+
+        job, statements = self._statements(
+            self.db_api.job_get_and_assign_next_by_action,
+            'snapshot', 'WORKER_1', new_timeout)
+
+        self.assertEqual(3, len(statements))
+        self.assertEqual('WORKER_1', job['worker_id'])
+        self.assertEqual(self.db_api.job_get_by_id(job['id']), job)
+
+    def test_job_get_and_assign_next_by_action_optimistic(self):
+        self.config(job_claim_strategy='optimistic')
+        self._assert_assign_statements()
+
+    def test_job_get_and_assign_next_by_action_skip_locked(self):
+        self.config(job_claim_strategy='skip_locked')
+        self._assert_assign_statements()
+
+    def test_job_create_from_schedule(self):
+        schedule = self.db_api.schedule_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'hour': 2, 'minute': 30,
+             'schedule_metadata': self._metadata(3)})
+
+        job, statements = self._statements(
+            self.db_api.job_create_from_schedule, schedule['id'],
+            schedule['next_run'], timeout_seconds={'default': 60})
+
+        # The locking read of the schedule, the lazy load of its metadata,
+        # the schedule update and the job and job metadata inserts.
+        self.assertEqual(5, len(statements))
+        self.assertEqual(3, len(job['job_metadata']))
+        self.assertEqual(self.db_api.job_get_by_id(job['id']), job)
+
+
+class TestSQLAlchemyCachedStatements(JobFixtureMixin, utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSQLAlchemyCachedStatements, self).setUp()
+        self.stubs.Set(self.db_api, '_COMPILED', {})
+        self.compiled = []
+        compile = sqlalchemy.sql.expression.ClauseElement.compile
+
+        def _compile(statement, *args, **kwargs):
+            self.compiled.append(statement)
+            return compile(statement, *args, **kwargs)
+
+        self.stubs.Set(sqlalchemy.sql.expression.ClauseElement, 'compile',
+                       _compile)
+
+    def test_get_by_id_compiled_once(self):
+        job = self.db_api.job_create(self.job_fixture_1)
+        worker = self.db_api.worker_create({'host': 'host1'})
+        del self.compiled[:]
+
+        for i in range(3):
+            self.db_api.job_get_by_id(job['id'])
+            self.db_api.worker_get_by_id(worker['id'])
+            self.db_api.job_updated_at_get_by_id(job['id'])
+
+        self.assertEqual(3, len(self.compiled))
+
+    def test_claim_compiled_once(self):
+        self._create_jobs(10, self.job_fixture_1, self.job_fixture_1)
+        session = self.db_api.get_session()
+        del self.compiled[:]
+
+        for i in range(3):
+            self.db_api._job_get_next_by_action(session, timeutils.utcnow(),
+                                                'snapshot')
+
+        self.assertEqual(1, len([statement for statement in self.compiled
+                                 if isinstance(statement,
+                                               sqlalchemy.sql.Select)
+                                 and 'jobs' in statement.froms[0].name]))
+
+    def test_not_found(self):
+        self.assertRaises(exception.NotFound, self.db_api.job_get_by_id,
+                          str(uuid.uuid4()))
+        self.assertRaises(exception.NotFound, self.db_api._worker_get_by_id,
+                          str(uuid.uuid4()))
+
+
+class TestSQLAlchemyBinaryUUIDs(utils.BaseTestCase):
+    """Keys stored as BINARY(16) are strings to the db api callers."""
+
+    def setUp(self):
+        super(TestSQLAlchemyBinaryUUIDs, self).setUp()
+        self.db_api = base.db_api
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        self.engine.dialect.binary_uuids = True
+        models.register_models(self.engine)
+        self.stubs.Set(self.db_api, '_ENGINE', self.engine)
+        self.stubs.Set(self.db_api, '_MAKERS', {})
+
+    def test_keys_round_trip(self):
+        schedule = self.db_api.schedule_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'hour': 2, 'minute': 30,
+             'schedule_metadata': [{'key': 'instance_id', 'value': 'I1'}]})
+        job = self.db_api.job_create_from_schedule(
+            schedule['id'], timeout_seconds={'default': 60})
+        worker = self.db_api.worker_create({'host': 'host1'})
+        self.db_api.job_update(job['id'], {'worker_id': worker['id']})
+
+        stored_id = self.engine.execute('SELECT id FROM jobs').scalar()
+        self.assertEqual(uuid.UUID(job['id']).bytes, str(stored_id))
+
+        self.assertEqual(schedule['id'],
+                         self.db_api.schedule_get_by_id(schedule['id'])['id'])
+        self.assertEqual([schedule['id']],
+                         [s['id'] for s in self.db_api.schedule_get_all(
+                             {'instance_id': 'I1'})])
+        jobs = self.db_api.job_get_all({'marker': job['id']})
+        self.assertEqual([], jobs)
+        job = self.db_api.job_get_by_id(job['id'])
+        self.assertEqual(schedule['id'], job['schedule_id'])
+        self.assertEqual(worker['id'], job['worker_id'])
+        self.assertEqual(['instance_id'],
+                         [meta['key'] for meta in job['job_metadata']])
+
+    def test_not_a_uuid_not_found(self):
+        self.assertRaises(exception.NotFound,
+                          self.db_api.job_get_by_id, 'not-a-uuid')
+
+
+class JSONMetadataMixin(object):
+
+    def setUp(self):
+        # NOTE: Set before the fixtures of the base test case are created.
+        self.config(metadata_storage='json')
+        super(JSONMetadataMixin, self).setUp()
+
+
+class TestSQLAlchemyJSONMetadataSchedules(JSONMetadataMixin,
+                                          base.TestSchedulesDBApi):
+    pass
+
+
+class TestSQLAlchemyJSONMetadataJobs(JSONMetadataMixin, base.TestJobsDBApi):
+    pass
+
+
+class TestSQLAlchemyJSONMetadataClaims(JSONMetadataMixin,
+                                       base.TestJobsDBGetNextJobApi):
+    pass
+
+
+class TestSQLAlchemyJSONMetadata(JSONMetadataMixin, StatementCountMixin,
+                                 JobFixtureMixin, utils.BaseTestCase):
+    """Metadata stored in the metadata_json column of its job or
+    schedule."""
+
+    def _stored(self, model, row_id):
+        table = model.__table__
+        engine = self.db_api.get_engine()
+        return engine.execute(sqlalchemy.select([table.c.metadata_json])
+                              .where(table.c.id == row_id)).scalar()
+
+    def _meta_rows(self, meta_model, column, row_id):
+        table = meta_model.__table__
+        engine = self.db_api.get_engine()
+        return sorted(row.key for row in engine.execute(
+            sqlalchemy.select([table.c.key])
+            .where(table.c[column] == row_id)))
+
+    def _without_hashes(self, schedule):
+        for meta in schedule['schedule_metadata']:
+            meta.pop('value_hash', None)
+        return schedule
+
+    def _schedule(self, metadata):
+        return self.db_api.schedule_create(
+            {'tenant': unit_utils.TENANT1, 'action': 'snapshot',
+             'schedule_metadata': metadata})
+
+    def test_job_get_by_id_one_plain_statement(self):
+        job = self.db_api.job_create(dict(self.job_fixture_1,
+                                          job_metadata=self._metadata(3)))
+
+        result, statements = self._statements(self.db_api.job_get_by_id,
+                                              job['id'])
+
+        self.assertEqual(1, len(statements))
+        self.assertNotIn('job_metadata', statements[0])
+        self.assertEqual(job, result)
+        self.assertEqual(self._metadata(3),
+                         [{'key': meta['key'], 'value': meta['value']}
+                          for meta in result['job_metadata']])
+
+    def test_only_indexed_keys_in_rows(self):
+        schedule = self._schedule([{'key': 'instance_id', 'value': 'I1'},
+                                   {'key': 'other', 'value': 'O1'}])
+        job = self.db_api.job_create(dict(self.job_fixture_1,
+                                          job_metadata=self._metadata(2)))
+
+        self.assertEqual(['instance_id'],
+                         self._meta_rows(models.ScheduleMetadata,
+                                         'schedule_id', schedule['id']))
+        self.assertEqual([], self._meta_rows(models.JobMetadata, 'job_id',
+                                             job['id']))
+        self.assertIn('"other", "O1"',
+                      self._stored(models.Schedule, schedule['id']))
+
+        self.db_api.schedule_metadata_update(
+            schedule['id'], [{'key': 'instance_id', 'value': 'I2'}])
+        self.assertEqual([schedule['id']],
+                         [s['id'] for s in self.db_api.schedule_get_all(
+                             {'instance_id': 'I2'})])
+        self.assertEqual([], self.db_api.schedule_get_all({'other': 'O1'}))
+
+    def test_schedule_get_all_by_key_not_indexed(self):
+        schedule = self._schedule([{'key': 'other', 'value': 'a_b%'}])
+        self._schedule([{'key': 'other', 'value': 'aXb%'}])
+        self._schedule([{'key': 'other_key', 'value': 'a_b%'}])
+
+        schedules = self.db_api.schedule_get_all({'other': 'a_b%'})
+
+        self.assertEqual([schedule['id']], [s['id'] for s in schedules])
+
+    def test_metadata_backfill_round_trip(self):
+        schedule = self._schedule([{'key': 'instance_id', 'value': 'I1'},
+                                   {'key': 'other', 'value': 'O1'}])
+        job = self.db_api.job_create(dict(self.job_fixture_1,
+                                          job_metadata=self._metadata(2)))
+
+        self.config(metadata_storage='table')
+        self.assertEqual({'schedules': 1, 'jobs': 1},
+                         self.db_api.metadata_backfill(batch_size=1))
+        self.assertIsNone(self._stored(models.Schedule, schedule['id']))
+        self.assertEqual(['instance_id', 'other'],
+                         self._meta_rows(models.ScheduleMetadata,
+                                         'schedule_id', schedule['id']))
+        self.assertEqual(schedule, self._without_hashes(
+            self.db_api.schedule_get_by_id(schedule['id'])))
+        self.assertEqual(job, self.db_api.job_get_by_id(job['id']))
+
+        self.config(metadata_storage='json')
+        self.assertEqual({'schedules': 1, 'jobs': 1},
+                         self.db_api.metadata_backfill(batch_size=1))
+        self.assertEqual(['instance_id'],
+                         self._meta_rows(models.ScheduleMetadata,
+                                         'schedule_id', schedule['id']))
+        self.assertEqual(schedule, self._without_hashes(
+            self.db_api.schedule_get_by_id(schedule['id'])))
+        self.assertEqual(job, self.db_api.job_get_by_id(job['id']))
+
+    def test_invalid_storage(self):
+        self.config(metadata_storage='bogus')
+        self.assertRaises(exception.QonosException,
+                          self.db_api.job_get_by_id, str(uuid.uuid4()))
+
+
+class TestSQLAlchemyTransactionRetries(JobFixtureMixin,
+                                       utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSQLAlchemyTransactionRetries, self).setUp()
+        self.stubs.Set(time, 'sleep', lambda seconds: None)
+
+    def test_job_update_retried_after_deadlock(self):
+        job = self.db_api.job_create(self.job_fixture_1)
+        job_get_by_id = self.db_api._job_get_by_id
+        deadlock = sqlalchemy.exc.OperationalError(
+            'SELECT', {}, Exception(1213, 'Deadlock found'))
+
+        errors = [deadlock]
+
+        def _get(*args, **kwargs):
+            if errors:
+                raise errors.pop()
+            return job_get_by_id(*args, **kwargs)
+
+        with mock.patch.object(self.db_api, '_job_get_by_id') as get:
+            get.side_effect = _get
+            updated = self.db_api.job_update(
+                job['id'], {'status': 'DONE',
+                            'job_metadata': [{'key': 'k', 'value': 'v'}]})
+
+        self.assertEqual(2, get.call_count)
+        self.assertEqual('DONE', updated['status'])
+        self.assertEqual(updated, self.db_api.job_get_by_id(job['id']))
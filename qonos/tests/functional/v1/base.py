@@ -449,6 +449,14 @@ class TestApi(utils.BaseTestCase):
         self.assertEqual(jobs[0]['status'], new_job['status'])
         self.assertEqual(jobs[0]['retry_count'], new_job['retry_count'])
 
+        # job stats
+        stats = self.client.get_job_stats()
+        self.assertEqual(1, stats['total'])
+        self.assertEqual(1, stats['claimable'])
+        self.assertEqual({'QUEUED': 1},
+                         stats['actions']['snapshot']['statuses'])
+        self.assertEqual(0, self.client.get_job_stats(TENANT2)['total'])
+
         # get job
         job = self.client.get_job(new_job['id'])
         self.assertEqual(job['id'], new_job['id'])
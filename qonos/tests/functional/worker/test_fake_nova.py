@@ -0,0 +1,87 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+from novaclient import exceptions
+
+from qonos.openstack.common import wsgi
+from qonos.tests.benchmark import fake_nova
+from qonos.tests import utils
+from qonos.worker.snapshot import simple_nova_client_factory
+
+
+INSTANCE_ID = '00000000-0000-0000-0000-000000000001'
+
+
+class TestFakeNova(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestFakeNova, self).setUp()
+        self.app = fake_nova.FakeNova(flavors={'2': 0.2}, retention=3)
+        self.service = wsgi.Service(self.app, 0, host='127.0.0.1')
+        self.service.start()
+        self.port = self.service._socket.getsockname()[1]
+        self.config(auth_host='127.0.0.1', auth_port=self.port,
+                    group='nova_client_factory')
+
+        job = {'id': 'JOB_1', 'tenant': 'TENANT_1'}
+        factory = simple_nova_client_factory.NovaClientFactory()
+        self.nova_client = factory.get_nova_client(job)
+
+    def tearDown(self):
+        self.service.stop()
+        super(TestFakeNova, self).tearDown()
+
+    def test_snapshot_calls(self):
+        server = self.nova_client.servers.get(INSTANCE_ID)
+        self.assertEqual(INSTANCE_ID, server.id)
+        self.assertEqual('2', server.flavor['id'])
+
+        image_id = self.nova_client.servers.create_image(
+            INSTANCE_ID, 'Daily-test',
+            {'org.openstack__1__created_by': 'scheduled_images_service'})
+        self.assertEqual('SAVING',
+                         self.nova_client.images.get(image_id).status)
+        time.sleep(0.3)
+        image = self.nova_client.images.get(image_id)
+        self.assertEqual('ACTIVE', image.status)
+        self.assertEqual(INSTANCE_ID, image.metadata['instance_uuid'])
+
+        images = self.nova_client.images.list(detailed=True)
+        self.assertEqual([image_id], [i.id for i in images])
+
+        retention = self.nova_client.\
+            rax_scheduled_images_python_novaclient_ext.get(INSTANCE_ID)
+        self.assertEqual(3, retention.retention)
+
+        self.nova_client.images.delete(image_id)
+        self.assertRaises(exceptions.NotFound,
+                          self.nova_client.images.get, image_id)
+
+        stats = self.app.get_stats()
+        self.assertEqual({'auth': 1, 'servers': 1, 'image_create': 1,
+                          'images': 5, 'retention': 1, 'total': 9},
+                         stats['requests'])
+        self.assertEqual(1, stats['images_created'])
+        self.assertEqual(1, stats['images_deleted'])
+
+    def test_retention_disabled(self):
+        self.app.retention = None
+        self.assertRaises(
+            exceptions.NotFound,
+            self.nova_client.rax_scheduled_images_python_novaclient_ext.get,
+            INSTANCE_ID)
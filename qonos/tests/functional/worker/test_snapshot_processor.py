@@ -671,6 +671,124 @@ class TestSnapshotProcessorPolling(BaseTestSnapshotProcessor):
                                             (['PROCESSING'] * 3 + ['DONE']))
             self.assertEqual('DONE', job['status'])
 
+    def test_polling_job_records_snapshot_duration(self):
+        server = self.server_instance_fixture("INSTANCE_ID", "test")
+        server.flavor = {'id': 'FLAVOR_ID'}
+        job = self.job_fixture(server.id)
+        images = [self.image_fixture('IMAGE_ID', 'SAVING', server.id),
+                  self.image_fixture('IMAGE_ID', 'ACTIVE', server.id)]
+
+        with TestableSnapshotProcessor(job, server, images) as processor:
+            processor.process_job(job)
+
+            history = processor.duration_history
+            self.assertIsNotNone(history.expected_duration(server.id))
+            self.assertIsNotNone(history.expected_duration('OTHER_INSTANCE',
+                                                           'FLAVOR_ID'))
+
+    def test_polling_job_does_not_record_resumed_image(self):
+        server = self.server_instance_fixture("INSTANCE_ID", "test")
+        job = self.job_fixture(server.id)
+        job['metadata']['image_id'] = 'IMAGE_ID'
+        images = [self.image_fixture('IMAGE_ID', 'SAVING', server.id),
+                  self.image_fixture('IMAGE_ID', 'ACTIVE', server.id)]
+
+        with TestableSnapshotProcessor(job, server, images) as processor:
+            processor.process_job(job)
+
+            self.assertEqual('DONE', job['status'])
+            self.assertIsNone(
+                processor.duration_history.expected_duration(server.id))
+
+    def test_poll_interval_uses_snapshot_history(self):
+        self.config(image_poll_interval_sec=30, group='snapshot_worker')
+        server = self.server_instance_fixture("INSTANCE_ID", "test")
+        job = self.job_fixture(server.id)
+
+        with TestableSnapshotProcessor(job, server, []) as processor:
+            self.assertEqual(
+                30, processor._get_image_poll_interval(server.id, 0))
+            processor.duration_history.record(200, server.id)
+            self.assertEqual(
+                100, processor._get_image_poll_interval(server.id, 0))
+            self.assertEqual(
+                10, processor._get_image_poll_interval(server.id, 199))
+
+    def test_poll_interval_without_adaptive_polling(self):
+        self.config(image_poll_interval_sec=30, adaptive_image_poll=False,
+                    group='snapshot_worker')
+        server = self.server_instance_fixture("INSTANCE_ID", "test")
+        job = self.job_fixture(server.id)
+
+        with TestableSnapshotProcessor(job, server, []) as processor:
+            self.assertIsNone(processor.duration_history)
+            self.assertEqual(
+                30, processor._get_image_poll_interval(server.id, 0))
+
+    def test_nova_lookups_are_cached_between_jobs(self):
+        server = self.server_instance_fixture("INSTANCE_ID", "test")
+        images = [self.image_fixture('IMAGE_ID', 'ACTIVE', server.id)]
+        job = self.job_fixture(server.id)
+
+        with TestableSnapshotProcessor(job, server, images) as processor:
+            processor.process_job(job)
+            next_job = self.job_fixture(server.id)
+            processor.process_job(next_job)
+
+            self.assertEqual('DONE', job['status'])
+            self.assertEqual('DONE', next_job['status'])
+            nova_client = processor.nova_client
+            self.assertEqual(2, nova_client.servers.create_image.call_count)
+            self.assertEqual(1, nova_client.servers.get.call_count)
+            self.assertEqual(1, nova_client.
+                             rax_scheduled_images_python_novaclient_ext.
+                             get.call_count)
+
+    def test_missing_server_lookup_is_cached(self):
+        job = self.job_fixture('INSTANCE_ID')
+
+        with TestableSnapshotProcessor(job, None, []) as processor:
+            processor.nova_client.servers.get = mock.Mock(
+                mock.ANY, side_effect=exceptions.NotFound(404))
+            processor.process_job(job)
+            processor.process_job(self.job_fixture('INSTANCE_ID'))
+
+            self.assertEqual(1, processor.nova_client.servers.get.call_count)
+            self.assertFalse(processor.nova_client.servers.create_image.called)
+
+    def test_cached_server_gone_is_looked_up_again(self):
+        server = self.server_instance_fixture("INSTANCE_ID", "test")
+        images = [self.image_fixture('IMAGE_ID', 'ACTIVE', server.id)]
+        job = self.job_fixture(server.id)
+
+        with TestableSnapshotProcessor(job, server, images) as processor:
+            processor.process_job(job)
+            nova_client = processor.nova_client
+            nova_client.servers.create_image.side_effect = \
+                exceptions.NotFound(404)
+            processor.process_job(self.job_fixture(server.id))
+            processor.process_job(self.job_fixture(server.id))
+
+            # NOTE: The second job is served by the cache, the third looks
+            # the server up again.
+            self.assertEqual(2, nova_client.servers.get.call_count)
+
+    def test_nova_lookups_without_cache(self):
+        self.config(enabled=False, group='nova_cache')
+        server = self.server_instance_fixture("INSTANCE_ID", "test")
+        images = [self.image_fixture('IMAGE_ID', 'ACTIVE', server.id)]
+        job = self.job_fixture(server.id)
+
+        with TestableSnapshotProcessor(job, server, images) as processor:
+            processor.process_job(job)
+            processor.process_job(self.job_fixture(server.id))
+
+            nova_client = processor.nova_client
+            self.assertEqual(2, nova_client.servers.get.call_count)
+            self.assertEqual(2, nova_client.
+                             rax_scheduled_images_python_novaclient_ext.
+                             get.call_count)
+
 
 class TestSnapshotProcessorRetentionProcessing(BaseTestSnapshotProcessor):
 
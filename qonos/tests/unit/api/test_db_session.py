@@ -0,0 +1,71 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+
+import webob
+import webob.dec
+
+from qonos.api.middleware import db_session
+from qonos.tests import utils
+
+
+class FakeDBApi(object):
+
+    def __init__(self):
+        self.events = []
+
+    @contextlib.contextmanager
+    def request_scope(self):
+        self.events.append('enter')
+        try:
+            yield
+        except Exception:
+            self.events.append('error')
+            raise
+        finally:
+            self.events.append('exit')
+
+
+class TestDBSessionScope(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestDBSessionScope, self).setUp()
+        self.db_api = FakeDBApi()
+
+    def test_request_runs_in_scope(self):
+        @webob.dec.wsgify
+        def app(req):
+            self.db_api.events.append('app')
+            return webob.Response(body='ok')
+
+        middleware = db_session.DBSessionScope(app, db_api=self.db_api)
+        response = webob.Request.blank('/v1/schedules').get_response(
+            middleware)
+
+        self.assertEqual('ok', response.body)
+        self.assertEqual(['enter', 'app', 'exit'], self.db_api.events)
+
+    def test_error_leaves_scope(self):
+        @webob.dec.wsgify
+        def app(req):
+            raise ValueError()
+
+        middleware = db_session.DBSessionScope(app, db_api=self.db_api)
+        self.assertRaises(ValueError,
+                          webob.Request.blank('/v1/schedules').get_response,
+                          middleware)
+        self.assertEqual(['enter', 'error', 'exit'], self.db_api.events)
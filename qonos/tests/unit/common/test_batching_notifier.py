@@ -0,0 +1,130 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+from qonos.openstack.common.notifier import api as notifier_api
+from qonos.openstack.common.notifier import batching_notifier
+from qonos.tests import utils as test_utils
+
+
+class FakeDriver(object):
+
+    def __init__(self):
+        self.messages = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def notify(self, context, message):
+        self.gate.wait()
+        self.messages.append((context, message))
+
+
+class BrokenDriver(object):
+
+    def notify(self, context, message):
+        raise Exception('broken')
+
+
+class TestBatchingNotifier(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestBatchingNotifier, self).setUp()
+        batching_notifier._reset()
+        self.driver = FakeDriver()
+        self.stubs.Set(batching_notifier, '_drivers', [self.driver])
+
+    def tearDown(self):
+        self.driver.gate.set()
+        batching_notifier._reset()
+        super(TestBatchingNotifier, self).tearDown()
+
+    def _message(self, i):
+        return {'message_id': str(i), 'priority': 'INFO'}
+
+    def test_notify_sends_in_background(self):
+        for i in range(5):
+            batching_notifier.notify('ctxt', self._message(i))
+        self.assertTrue(batching_notifier.flush(timeout=5))
+        self.assertEqual([('ctxt', self._message(i)) for i in range(5)],
+                         self.driver.messages)
+
+    def test_notify_does_not_wait_for_driver(self):
+        self.driver.gate.clear()
+        batching_notifier.notify(None, self._message(1))
+        self.assertEqual([], self.driver.messages)
+        self.assertFalse(batching_notifier.flush(timeout=0.01))
+        self.driver.gate.set()
+        self.assertTrue(batching_notifier.flush(timeout=5))
+        self.assertEqual(1, len(self.driver.messages))
+
+    def test_full_queue_drops_notifications(self):
+        self.config(batching_notification_queue_size=2)
+        self.driver.gate.clear()
+        for i in range(10):
+            batching_notifier.notify(None, self._message(i))
+        self.driver.gate.set()
+        self.assertTrue(batching_notifier.flush(timeout=5))
+        self.assertTrue(len(self.driver.messages) < 10)
+        self.assertEqual(10 - len(self.driver.messages),
+                         batching_notifier._dropped)
+
+    def test_full_queue_blocks_notifications(self):
+        self.config(batching_notification_queue_size=1,
+                    batching_notification_overflow_policy='block')
+        self.driver.gate.clear()
+        releaser = threading.Timer(0.05, self.driver.gate.set)
+        releaser.start()
+        for i in range(5):
+            batching_notifier.notify(None, self._message(i))
+        self.assertTrue(batching_notifier.flush(timeout=5))
+        self.assertEqual(5, len(self.driver.messages))
+        self.assertEqual(0, batching_notifier._dropped)
+
+    def test_unknown_overflow_policy(self):
+        self.config(batching_notification_overflow_policy='bogus')
+        self.assertRaises(ValueError, batching_notifier.notify, None,
+                          self._message(1))
+        self.assertEqual(None, batching_notifier._queue)
+
+    def test_driver_error_does_not_stop_sender(self):
+        self.stubs.Set(batching_notifier, '_drivers',
+                       [BrokenDriver(), self.driver])
+        batching_notifier.notify(None, self._message(1))
+        batching_notifier.notify(None, self._message(2))
+        self.assertTrue(batching_notifier.flush(timeout=5))
+        self.assertEqual(2, len(self.driver.messages))
+
+    def test_take_batch_limits_batch_size(self):
+        queue = batching_notifier.Queue.Queue()
+        for i in range(5):
+            queue.put(i)
+        self.assertEqual([0, 1, 2],
+                         batching_notifier._take_batch(queue, 3))
+        self.assertEqual([3, 4], batching_notifier._take_batch(queue, 3))
+
+    def test_flush_without_notifications(self):
+        self.assertTrue(batching_notifier.flush(timeout=0))
+
+    def test_notifier_api_flush(self):
+        notifier_api._reset_drivers()
+        self.addCleanup(notifier_api._reset_drivers)
+        notifier_api.add_driver(batching_notifier)
+        self.driver.gate.clear()
+        notifier_api.notify(None, 'publisher', 'event', 'INFO', {})
+        self.driver.gate.set()
+        notifier_api.flush()
+        self.assertEqual(1, len(self.driver.messages))
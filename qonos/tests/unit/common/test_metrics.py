@@ -0,0 +1,81 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import mock
+
+from qonos.common import metrics
+from qonos.tests import utils as test_utils
+
+
+class TestMetrics(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+        super(TestMetrics, self).tearDown()
+
+    def test_incr(self):
+        metrics.incr('foo')
+        metrics.incr('foo', 2)
+        self.assertEqual({'foo': 3}, metrics.get_stats()['counters'])
+
+    def test_timing(self):
+        metrics.timing('bar', 0.5)
+        metrics.timing('bar', 1.5)
+        timer = metrics.get_stats()['timers']['bar']
+        self.assertEqual(2, timer['count'])
+        self.assertEqual(2.0, timer['total'])
+        self.assertEqual(1.5, timer['max'])
+
+    def test_gauge(self):
+        metrics.gauge('baz', 3)
+        metrics.gauge('baz', 1)
+        self.assertEqual({'baz': 1}, metrics.get_stats()['gauges'])
+
+    def test_get_stats_returns_copy(self):
+        metrics.timing('bar', 1)
+        metrics.get_stats()['timers']['bar']['count'] = 10
+        self.assertEqual(1, metrics.get_stats()['timers']['bar']['count'])
+
+    def test_reset(self):
+        metrics.incr('foo')
+        metrics.timing('bar', 1)
+        metrics.gauge('baz', 1)
+        metrics.reset()
+        self.assertEqual({'counters': {}, 'timers': {}, 'gauges': {}},
+                         metrics.get_stats())
+
+    def test_log_stats(self):
+        metrics.incr('foo')
+        metrics.timing('bar', 1)
+        metrics.gauge('baz', 1)
+        logger = mock.Mock()
+        metrics.log_stats(logger)
+        self.assertEqual(3, logger.info.call_count)
+
+    def test_start_periodic_log_disabled(self):
+        with mock.patch.object(eventlet, 'spawn_n') as spawn_n:
+            metrics.start_periodic_log(0)
+        self.assertFalse(spawn_n.called)
+
+    def test_start_periodic_log(self):
+        with mock.patch.object(eventlet, 'spawn_n') as spawn_n:
+            metrics.start_periodic_log(300)
+        spawn_n.assert_called_once_with(metrics._log_periodically, 300)
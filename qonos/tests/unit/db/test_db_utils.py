@@ -0,0 +1,96 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import base64
+import datetime
+
+from qonos.common import exception
+from qonos.db import db_utils
+from qonos.tests import utils
+
+
+class TestSortParams(utils.BaseTestCase):
+
+    def test_defaults(self):
+        self.assertEqual((['id'], ['asc'], None),
+                         db_utils.get_sort_params('jobs', {}))
+
+    def test_id_added_in_direction_of_last_key(self):
+        params = {'sort_key': 'next_run,created_at', 'sort_dir': 'desc,asc'}
+        self.assertEqual((['next_run', 'created_at', 'id'],
+                          ['desc', 'asc', 'asc'], None),
+                         db_utils.get_sort_params('schedules', params))
+
+    def test_single_dir_applies_to_all_keys(self):
+        params = {'sort_key': 'host', 'sort_dir': 'desc'}
+        self.assertEqual((['host', 'id'], ['desc', 'desc'], None),
+                         db_utils.get_sort_params('workers', params))
+
+    def test_invalid_sort_key(self):
+        self.assertRaises(exception.InvalidSortKey,
+                          db_utils.get_sort_params, 'jobs',
+                          {'sort_key': 'tenant'})
+
+    def test_invalid_sort_dir(self):
+        self.assertRaises(exception.Invalid, db_utils.get_sort_params,
+                          'jobs', {'sort_dir': 'up'})
+
+    def test_dir_count_mismatch(self):
+        params = {'sort_key': 'created_at', 'sort_dir': 'asc,asc,desc'}
+        self.assertRaises(exception.Invalid, db_utils.get_sort_params,
+                          'jobs', params)
+
+    def test_cursor_overrides_sort(self):
+        created_at = datetime.datetime(2013, 6, 1, 12, 0, 0, 123456)
+        item = {'id': 'JOB-1', 'created_at': created_at}
+        cursor = db_utils.encode_cursor(item, ['created_at', 'id'],
+                                        ['desc', 'desc'])
+        params = {'cursor': cursor, 'sort_key': 'updated_at'}
+        self.assertEqual((['created_at', 'id'], ['desc', 'desc'],
+                          [created_at, 'JOB-1']),
+                         db_utils.get_sort_params('jobs', params))
+
+    def test_cursor_sort_key_checked(self):
+        cursor = db_utils.encode_cursor({'tenant': 'T', 'id': 'JOB-1'},
+                                        ['tenant', 'id'], ['asc', 'asc'])
+        self.assertRaises(exception.InvalidSortKey,
+                          db_utils.get_sort_params, 'jobs',
+                          {'cursor': cursor})
+
+
+class TestCursors(utils.BaseTestCase):
+
+    def test_round_trip(self):
+        next_run = datetime.datetime(2013, 6, 1, 12, 0, 0, 5)
+        item = {'id': 'SCHD-1', 'next_run': next_run, 'hour': 2}
+        cursor = db_utils.encode_cursor(item, ['next_run', 'id'],
+                                        ['asc', 'asc'])
+        self.assertFalse('=' in cursor)
+        self.assertEqual((['next_run', 'id'], ['asc', 'asc'],
+                          [next_run, 'SCHD-1']),
+                         db_utils.decode_cursor(cursor))
+
+    def test_null_value(self):
+        cursor = db_utils.encode_cursor({'id': 'SCHD-1', 'next_run': None},
+                                        ['next_run', 'id'], ['asc', 'asc'])
+        self.assertEqual([None, 'SCHD-1'], db_utils.decode_cursor(cursor)[2])
+
+    def test_decode_garbage(self):
+        self.assertRaises(exception.Invalid, db_utils.decode_cursor, '!!!')
+
+    def test_decode_wrong_shape(self):
+        cursor = base64.urlsafe_b64encode('[["id"], ["asc"], []]')
+        self.assertRaises(exception.Invalid, db_utils.decode_cursor, cursor)
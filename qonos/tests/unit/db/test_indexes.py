@@ -0,0 +1,115 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import sqlalchemy
+
+from qonos.db.sqlalchemy import indexes
+from qonos.db.sqlalchemy import models
+from qonos.tests import utils
+
+
+class TestIndexReport(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestIndexReport, self).setUp()
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        models.register_models(self.engine)
+
+    def _index(self, report, table_name, name):
+        for index in report['indexes']:
+            if index['table'] == table_name and index['name'] == name:
+                return index
+
+    def test_expected_indexes(self):
+        expected = indexes.expected_indexes()
+        self.assertIn(('jobs', 'jobs_tenant_idx', ('tenant', 'status')),
+                      expected)
+        self.assertIn(('schedules', 'schedules_tenant_idx',
+                       ('tenant', 'action')), expected)
+        self.assertIn(('job_faults', 'job_faults_job_id_idx',
+                       ('job_id', 'created_at')), expected)
+
+    def test_report_nothing_missing(self):
+        report = indexes.report(self.engine)
+
+        self.assertEqual([], report['missing'])
+        index = self._index(report, 'jobs', 'jobs_tenant_idx')
+        self.assertEqual(('tenant', 'status'), index['columns'])
+        # NOTE: SQLite keeps no statistics of index reads.
+        self.assertEqual(None, index['reads'])
+
+    def test_report_missing_index(self):
+        self.engine.execute('DROP INDEX jobs_tenant_idx')
+
+        report = indexes.report(self.engine)
+
+        self.assertEqual([{'table': 'jobs', 'name': 'jobs_tenant_idx',
+                           'columns': ('tenant', 'status')}],
+                         report['missing'])
+        self.assertEqual(None, self._index(report, 'jobs', 'jobs_tenant_idx'))
+
+    def test_report_covered_by_other_index(self):
+        self.engine.execute('DROP INDEX jobs_schedule_id_idx')
+        self.engine.execute('CREATE INDEX jobs_schedule_idx '
+                            'ON jobs (schedule_id, status)')
+
+        report = indexes.report(self.engine)
+
+        self.assertEqual([], report['missing'])
+
+    def test_report_missing_table(self):
+        self.engine.execute('DROP TABLE job_faults')
+
+        report = indexes.report(self.engine)
+
+        self.assertEqual(['job_faults'] * 2,
+                         [index['table'] for index in report['missing']])
+
+    def test_report_with_usage(self):
+        usage = {('jobs', 'jobs_tenant_idx'): 12}
+        with mock.patch.object(indexes, 'index_usage', return_value=usage):
+            report = indexes.report(self.engine)
+
+        self.assertEqual(12, self._index(report, 'jobs',
+                                         'jobs_tenant_idx')['reads'])
+        self.assertEqual(0, self._index(report, 'jobs',
+                                        'jobs_schedule_id_idx')['reads'])
+
+    def test_index_usage_unknown_dialect(self):
+        self.assertEqual(None, indexes.index_usage(self.engine))
+
+    def test_index_usage_mysql(self):
+        engine = mock.Mock()
+        engine.dialect.name = 'mysql'
+        engine.execute.return_value.fetchall.return_value = [
+            ('jobs', 'jobs_tenant_idx', 7),
+            ('jobs', 'status_idx', None),
+        ]
+
+        usage = indexes.index_usage(engine)
+
+        self.assertEqual({('jobs', 'jobs_tenant_idx'): 7,
+                          ('jobs', 'status_idx'): 0}, usage)
+        engine.execute.assert_called_once_with(indexes.USAGE_QUERIES['mysql'])
+
+    def test_index_usage_statistics_unavailable(self):
+        engine = mock.Mock()
+        engine.dialect.name = 'mysql'
+        engine.execute.side_effect = sqlalchemy.exc.DBAPIError(
+            'SELECT', {}, Exception('no performance_schema'))
+
+        self.assertEqual(None, indexes.index_usage(engine))
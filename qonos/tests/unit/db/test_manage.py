@@ -0,0 +1,72 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import imp
+import os
+import shutil
+import tempfile
+
+import mock
+
+import qonos.db.sqlalchemy.api as db_api
+from qonos.db.sqlalchemy import models
+from qonos.tests import utils
+
+
+MANAGE = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                      os.pardir, os.pardir, 'bin', 'qonos-manage')
+
+
+class TestManageMetadataBackfill(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestManageMetadataBackfill, self).setUp()
+        self.manage = imp.load_source('qonos_manage', MANAGE)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.config(sql_connection='sqlite:///%s'
+                    % os.path.join(self.tmp_dir, 'qonos.sqlite'))
+        # NOTE: As in a fresh qonos-manage process, no engine exists yet.
+        self.stubs.Set(db_api, '_ENGINE', None)
+        self.stubs.Set(db_api, '_MAKERS', {})
+        self.stubs.Set(db_api, '_STATEMENTS', {})
+        self.stubs.Set(db_api, '_COMPILED', {})
+        self.addCleanup(lambda: db_api._ENGINE and db_api._ENGINE.dispose())
+
+    def test_metadata_backfill(self):
+        conf = mock.Mock(metadata_storage='json')
+        conf.command.batch_size = 10
+        self.stubs.Set(self.manage, 'CONF', conf)
+        self.config(metadata_storage='table')
+        models.register_models(db_api.get_engine())
+        schedule = db_api.schedule_create({
+            'tenant': 'TENANT_1', 'action': 'snapshot',
+            'schedule_metadata': [{'key': 'instance_id',
+                                   'value': 'INSTANCE_1'}]})
+        db_api.get_engine().dispose()
+        self.stubs.Set(db_api, '_ENGINE', None)
+        self.stubs.Set(db_api, '_MAKERS', {})
+        self.config(metadata_storage='json')
+
+        with mock.patch('sys.stdout') as stdout:
+            self.manage.do_metadata_backfill()
+
+        stdout.write.assert_any_call('Moved the metadata of 1 schedules '
+                                     'and 0 jobs to json storage')
+        self.assertEqual([{'key': 'instance_id', 'value': 'INSTANCE_1'}],
+                         [dict(key=meta['key'], value=meta['value'])
+                          for meta in db_api.schedule_get_by_id(
+                              schedule['id'])['schedule_metadata']])
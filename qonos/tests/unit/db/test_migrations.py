@@ -38,6 +38,7 @@ import sqlalchemy
 
 import qonos.db.migration as migration
 import qonos.db.sqlalchemy.migrate_repo
+from qonos.db.sqlalchemy import models
 from qonos.db.sqlalchemy.migration import versioning_api as migration_api
 from qonos.openstack.common import log as logging
 from qonos.openstack.common import uuidutils
@@ -969,3 +970,155 @@ class TestMigrations(utils.BaseTestCase):
 
         self.assertNotIn((index_status, columns_status), index_data)
         self.assertNotIn((index_timeout, columns_timeout), index_data)
+
+    def _check_015(self, engine, data):
+        jobs = get_table(engine, 'jobs')
+
+        index_data = [(idx.name, idx.columns.keys())
+                      for idx in jobs.indexes]
+
+        self.assertIn(('job_claim_idx', ['action', 'updated_at', 'status',
+                                         'worker_id', 'timeout']),
+                      index_data)
+
+    def _post_downgrade_015(self, engine):
+        jobs = get_table(engine, 'jobs')
+
+        index_names = [idx.name for idx in jobs.indexes]
+
+        self.assertNotIn('job_claim_idx', index_names)
+
+    def _pre_upgrade_016(self, engine):
+        now = datetime.datetime.now()
+        schedules = get_table(engine, 'schedules')
+        schedules.insert().values(id='SCHD-16', tenant='OWNER-1',
+                                  action='snapshot', created_at=now,
+                                  updated_at=now).execute()
+
+        data = [('META-16-1', 'instance_id', 'INSTANCE-1'),
+                ('META-16-2', 'name', u'caf\xe9')]
+        schedule_metadata = get_table(engine, 'schedule_metadata')
+        for meta_id, key, value in data:
+            schedule_metadata.insert().values(id=meta_id,
+                                              schedule_id='SCHD-16',
+                                              key=key, value=value,
+                                              created_at=now,
+                                              updated_at=now).execute()
+        return data
+
+    def _check_016(self, engine, data):
+        schedule_metadata = get_table(engine, 'schedule_metadata')
+
+        index_data = [(idx.name, idx.columns.keys())
+                      for idx in schedule_metadata.indexes]
+        self.assertIn(('schedule_metadata_value_idx',
+                       ['key', 'value_hash', 'schedule_id']),
+                      index_data)
+
+        hashes = dict((row['id'], row['value_hash'])
+                      for row in schedule_metadata.select().execute())
+        for meta_id, key, value in data:
+            self.assertEqual(models.metadata_value_hash(value),
+                             hashes[meta_id])
+
+    def _post_downgrade_016(self, engine):
+        schedule_metadata = get_table(engine, 'schedule_metadata')
+
+        index_names = [idx.name for idx in schedule_metadata.indexes]
+        self.assertNotIn('schedule_metadata_value_idx', index_names)
+        self.assertNotIn('value_hash', schedule_metadata.c)
+
+    def _check_017(self, engine, data):
+        for table_name, index in (('jobs', ('job_purge_idx',
+                                            ['status', 'updated_at'])),
+                                  ('job_faults', ('job_faults_created_at_idx',
+                                                  ['created_at']))):
+            table = get_table(engine, table_name)
+            index_data = [(idx.name, idx.columns.keys())
+                          for idx in table.indexes]
+            self.assertIn(index, index_data)
+
+            shadow_table = get_table(engine, 'shadow_' + table_name)
+            self.assertEqual(sorted(table.c.keys()),
+                             sorted(shadow_table.c.keys()))
+
+    def _post_downgrade_017(self, engine):
+        jobs = get_table(engine, 'jobs')
+        self.assertNotIn('job_purge_idx', [idx.name for idx in jobs.indexes])
+
+        for table_name in ('shadow_jobs', 'shadow_job_metadata',
+                           'shadow_job_faults'):
+            self.assertRaises(sqlalchemy.exc.NoSuchTableError,
+                              get_table, engine, table_name)
+
+    def _check_018(self, engine, data):
+        for table_name in ('jobs', 'schedules'):
+            table = get_table(engine, table_name)
+            index_data = [(idx.name, idx.columns.keys())
+                          for idx in table.indexes]
+            for column in ('created_at', 'updated_at'):
+                index_name = '%s_%s_idx' % (table_name, column)
+                self.assertIn((index_name, [column, 'id']), index_data)
+
+        jobs = get_table(engine, 'jobs')
+        self.assertIn(('hard_timeout_idx', ['hard_timeout', 'id']),
+                      [(idx.name, idx.columns.keys()) for idx in jobs.indexes])
+        schedules = get_table(engine, 'schedules')
+        self.assertIn(('next_run_idx', ['next_run', 'id']),
+                      [(idx.name, idx.columns.keys())
+                       for idx in schedules.indexes])
+
+    def _post_downgrade_018(self, engine):
+        for table_name in ('jobs', 'schedules'):
+            table = get_table(engine, table_name)
+            index_names = [idx.name for idx in table.indexes]
+            self.assertNotIn('%s_created_at_idx' % table_name, index_names)
+            self.assertNotIn('%s_updated_at_idx' % table_name, index_names)
+
+        jobs = get_table(engine, 'jobs')
+        self.assertIn(('hard_timeout_idx', ['hard_timeout']),
+                      [(idx.name, idx.columns.keys()) for idx in jobs.indexes])
+
+    def _check_019(self, engine, data):
+        # NOTE: The keys are only converted when sql_binary_uuids is set.
+        for table_name in ('jobs', 'schedules'):
+            table = get_table(engine, table_name)
+            self.assertTrue(isinstance(table.c.id.type, sqlalchemy.String))
+
+    def _check_020(self, engine, data):
+        for table_name in ('schedules', 'jobs', 'shadow_jobs'):
+            table = get_table(engine, table_name)
+            self.assertIn('metadata_json', table.c)
+            self.assertTrue(table.c.metadata_json.nullable)
+
+    def _post_downgrade_020(self, engine):
+        for table_name in ('schedules', 'jobs', 'shadow_jobs'):
+            table = get_table(engine, table_name)
+            self.assertNotIn('metadata_json', table.c)
+
+    def _check_021(self, engine, data):
+        expected = {
+            'schedules': [('schedules_tenant_idx', ['tenant', 'action']),
+                          ('schedules_action_idx', ['action'])],
+            'jobs': [('jobs_tenant_idx', ['tenant', 'status']),
+                     ('jobs_schedule_id_idx', ['schedule_id'])],
+            'job_faults': [('job_faults_job_id_idx', ['job_id',
+                                                      'created_at'])],
+        }
+        for table_name, indexes in expected.iteritems():
+            table = get_table(engine, table_name)
+            index_data = [(idx.name, idx.columns.keys())
+                          for idx in table.indexes]
+            for index in indexes:
+                self.assertIn(index, index_data)
+
+    def _post_downgrade_021(self, engine):
+        for table_name, index_name in (
+                ('schedules', 'schedules_tenant_idx'),
+                ('schedules', 'schedules_action_idx'),
+                ('jobs', 'jobs_tenant_idx'),
+                ('jobs', 'jobs_schedule_id_idx'),
+                ('job_faults', 'job_faults_job_id_idx')):
+            table = get_table(engine, table_name)
+            self.assertNotIn(index_name,
+                             [idx.name for idx in table.indexes])
@@ -0,0 +1,107 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import signal
+
+import mock
+import sqlalchemy
+
+from qonos.db.sqlalchemy import profiler
+from qonos.tests import utils
+
+
+class TestProfiler(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestProfiler, self).setUp()
+        profiler.reset()
+        self.addCleanup(profiler.reset)
+        self.signals = []
+        self.stubs.Set(signal, 'signal',
+                       lambda *args: self.signals.append(args))
+
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE things (id INTEGER)')
+        profiler.install(self.engine)
+
+    def test_install_registers_signal_handler(self):
+        self.assertEqual([(signal.SIGUSR2, profiler._dump_stats)],
+                         self.signals)
+
+    def test_statements_charged_to_outermost_function(self):
+        @profiler.profiled
+        def inner():
+            self.engine.execute('INSERT INTO things VALUES (1)')
+
+        @profiler.profiled
+        def outer():
+            self.engine.execute('INSERT INTO things VALUES (2)')
+            inner()
+            self.assertEqual('outer', profiler.current_function())
+
+        outer()
+        inner()
+        self.engine.execute('SELECT * FROM things').fetchall()
+
+        stats = profiler.get_stats()
+        self.assertEqual(['inner', 'outer', 'unknown'], sorted(stats))
+        self.assertEqual(2, stats['outer']['count'])
+        self.assertEqual(2, stats['outer']['rows'])
+        self.assertEqual(1, stats['inner']['count'])
+        self.assertEqual(1, stats['inner']['rows'])
+        self.assertEqual(1, stats['unknown']['count'])
+        self.assertEqual('unknown', profiler.current_function())
+
+    def test_caller_cleared_on_error(self):
+        @profiler.profiled
+        def failing():
+            raise ValueError()
+
+        self.assertRaises(ValueError, failing)
+        self.assertEqual('unknown', profiler.current_function())
+
+    def test_histogram(self):
+        for elapsed in (0.0005, 0.003, 0.003, 0.2, 12):
+            profiler.record('job_update', elapsed)
+
+        stats = profiler.get_stats()['job_update']
+        self.assertEqual(5, stats['count'])
+        self.assertEqual(12, stats['max'])
+        self.assertEqual([('<=1ms', 1), ('<=5ms', 2), ('<=10ms', 0),
+                          ('<=50ms', 0), ('<=100ms', 0), ('<=500ms', 1),
+                          ('<=1000ms', 0), ('<=5000ms', 0), ('>5000ms', 1)],
+                         stats['histogram'])
+
+    def test_slow_query_log(self):
+        self.config(slow_query_seconds=0)
+        with mock.patch.object(profiler.SLOW_LOG, 'warning') as warning:
+            self.engine.execute('SELECT * FROM things')
+        self.assertEqual(1, warning.call_count)
+        self.assertTrue('SELECT * FROM things' in warning.call_args[0][0])
+
+    def test_no_slow_query_log_below_threshold(self):
+        self.config(slow_query_seconds=60)
+        with mock.patch.object(profiler.SLOW_LOG, 'warning') as warning:
+            self.engine.execute('SELECT * FROM things')
+        self.assertFalse(warning.called)
+
+    def test_log_stats(self):
+        profiler.record('job_update', 0.002, 1)
+        logger = mock.Mock()
+        profiler.log_stats(logger)
+        message = logger.info.call_args[0][0]
+        self.assertTrue(message.startswith('[QUERIES] job_update: count=1 '))
+        self.assertTrue(message.endswith('rows=1 <=5ms:1'))
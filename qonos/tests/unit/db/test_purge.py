@@ -0,0 +1,90 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+import time
+
+import eventlet
+import mock
+
+from qonos.common import metrics
+from qonos.common import timeutils
+from qonos.db import purge
+from qonos.tests import utils
+
+
+class TestPurge(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPurge, self).setUp()
+        self.now = datetime.datetime(2013, 6, 1, 12, 0)
+        timeutils.set_time_override(self.now)
+        self.addCleanup(timeutils.clear_time_override)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+        self.sleeps = []
+        self.stubs.Set(time, 'sleep', self.sleeps.append)
+
+        self.db_api = mock.Mock()
+        self.db_api.job_purge_batch.side_effect = [
+            {'jobs': 2, 'job_metadata': 4},
+            {'jobs': 2, 'job_metadata': 2},
+            {'jobs': 1, 'job_metadata': 0},
+        ]
+        self.db_api.job_fault_purge_batch.side_effect = [
+            {'job_faults': 0},
+        ]
+
+    def test_purge_in_batches(self):
+        stats = purge.purge(self.db_api, retention_days=10, batch_size=2,
+                            batch_sleep=0.5, archive=True)
+
+        older_than = self.now - datetime.timedelta(days=10)
+        self.assertEqual([mock.call(older_than, 2, True)] * 3,
+                         self.db_api.job_purge_batch.call_args_list)
+        self.assertEqual([mock.call(older_than, 2, True)],
+                         self.db_api.job_fault_purge_batch.call_args_list)
+        self.assertEqual([0.5, 0.5], self.sleeps)
+        self.assertEqual({'jobs': 5, 'job_metadata': 6, 'job_faults': 0},
+                         stats['rows'])
+        self.assertTrue(stats['seconds'] >= 0)
+
+        counters = metrics.get_stats()['counters']
+        self.assertEqual(5, counters['db.purge.jobs'])
+        self.assertEqual(6, counters['db.purge.job_metadata'])
+
+    def test_purge_defaults_from_config(self):
+        self.config(retention_days=7, batch_size=2, batch_sleep=1.5,
+                    archive=False, group='purge')
+
+        purge.purge(self.db_api)
+
+        older_than = self.now - datetime.timedelta(days=7)
+        self.db_api.job_purge_batch.assert_called_with(older_than, 2, False)
+        self.assertEqual([1.5, 1.5], self.sleeps)
+
+    def test_start_periodic_purge_disabled(self):
+        self.config(interval=0, group='purge')
+        with mock.patch.object(eventlet, 'spawn_n') as spawn_n:
+            purge.start_periodic_purge(self.db_api)
+        self.assertFalse(spawn_n.called)
+
+    def test_start_periodic_purge(self):
+        self.config(interval=3600, group='purge')
+        with mock.patch.object(eventlet, 'spawn_n') as spawn_n:
+            purge.start_periodic_purge(self.db_api)
+        spawn_n.assert_called_once_with(purge._run_periodic, self.db_api)
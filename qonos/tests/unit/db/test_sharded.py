@@ -0,0 +1,105 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2014 Rackspace Hosting
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import datetime
+import uuid
+
+from qonos.db.sharded import api as sharded_api
+from qonos.db.sharded import hash_ring
+from qonos.tests import utils
+
+
+class TestHashRing(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestHashRing, self).setUp()
+        self.keys = ['TENANT_%d' % i for i in xrange(3000)]
+
+    def test_keys_spread_over_nodes(self):
+        ring = hash_ring.HashRing(3)
+        counts = collections.Counter(ring.get_node(key) for key in self.keys)
+
+        self.assertEqual([0, 1, 2], sorted(counts))
+        for count in counts.values():
+            self.assertTrue(700 < count < 1300, counts)
+
+    def test_adding_node_moves_keys_to_it_only(self):
+        before = hash_ring.HashRing(3)
+        after = hash_ring.HashRing(4)
+
+        moved = [key for key in self.keys
+                 if before.get_node(key) != after.get_node(key)]
+
+        self.assertEqual(set([3]), set(after.get_node(key) for key in moved))
+        self.assertTrue(450 < len(moved) < 1050, len(moved))
+
+    def test_unicode_and_uuid_keys(self):
+        ring = hash_ring.HashRing(3)
+        self.assertEqual(ring.get_node('tenant'), ring.get_node(u'tenant'))
+        self.assertTrue(ring.get_node(u'\xe9t\xe9') in (0, 1, 2))
+        key = uuid.uuid4()
+        self.assertEqual(ring.get_node(str(key)), ring.get_node(key))
+
+
+class TestMerging(utils.BaseTestCase):
+
+    def test_sort_puts_nulls_like_the_database(self):
+        items = [{'next_run': 2, 'id': 'b'}, {'next_run': None, 'id': 'a'},
+                 {'next_run': 2, 'id': 'a'}, {'next_run': 1, 'id': 'c'}]
+
+        ascending = sharded_api._sort(list(items), ['next_run', 'id'],
+                                      ['asc', 'asc'])
+        descending = sharded_api._sort(list(items), ['next_run', 'id'],
+                                       ['desc', 'asc'])
+
+        self.assertEqual([(None, 'a'), (1, 'c'), (2, 'a'), (2, 'b')],
+                         [(i['next_run'], i['id']) for i in ascending])
+        self.assertEqual([(2, 'a'), (2, 'b'), (1, 'c'), (None, 'a')],
+                         [(i['next_run'], i['id']) for i in descending])
+
+    def test_summed(self):
+        self.assertEqual({'jobs': 5, 'job_metadata': 3},
+                         sharded_api._summed([{'jobs': 2, 'job_metadata': 3},
+                                              {'jobs': 3, 'job_metadata': 0}]))
+
+    def test_merge_job_stats(self):
+        older = datetime.datetime(2014, 1, 1, 10, 0)
+        newer = datetime.datetime(2014, 1, 1, 11, 0)
+        shard_stats = [
+            {'actions': {'snapshot': {'statuses': {'QUEUED': 2, 'DONE': 1},
+                                      'total': 3, 'claimable': 2,
+                                      'oldest_claimable': newer}},
+             'total': 3, 'claimable': 2},
+            {'actions': {'snapshot': {'statuses': {'QUEUED': 1},
+                                      'total': 1, 'claimable': 1,
+                                      'oldest_claimable': older},
+                         'other': {'statuses': {'DONE': 4},
+                                   'total': 4, 'claimable': 0,
+                                   'oldest_claimable': None}},
+             'total': 5, 'claimable': 1},
+        ]
+
+        stats = sharded_api._merge_job_stats(shard_stats)
+
+        self.assertEqual(8, stats['total'])
+        self.assertEqual(3, stats['claimable'])
+        self.assertEqual({'statuses': {'QUEUED': 3, 'DONE': 1}, 'total': 4,
+                          'claimable': 3, 'oldest_claimable': older},
+                         stats['actions']['snapshot'])
+        self.assertEqual({'statuses': {'DONE': 4}, 'total': 4,
+                          'claimable': 0, 'oldest_claimable': None},
+                         stats['actions']['other'])
@@ -14,7 +14,25 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import mock
+import sqlalchemy
+from sqlalchemy.dialects import mysql
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
+import sqlalchemy.exc
+
+from qonos.common import exception
+from qonos.common import metrics
+from qonos.common import timeutils
 import qonos.db.sqlalchemy.api as db_api
+from qonos.db.sqlalchemy import models
 from qonos.tests import utils as utils
 
 
@@ -53,3 +71,855 @@ class TestSqlalchemySpecificApi(utils.BaseTestCase):
         self.assertTrue(isinstance(value[0], dict))
         self.assertEqual(value[0].get('foo'), 'bar')
         self.assertFalse('_sa_instance_state' in value[1])
+
+
+class TestSkipLockedClaims(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSkipLockedClaims, self).setUp()
+        self.addCleanup(setattr, db_api, '_SKIP_LOCKED_SUPPORTED', None)
+        db_api._SKIP_LOCKED_SUPPORTED = None
+
+    def _claim_sql(self, dialect):
+        statement = db_api._job_next_by_action_statement(skip_locked=True)
+        return str(statement.compile(dialect=dialect))
+
+    def _dialect(self, name, version):
+        dialect = mock.Mock(server_version_info=version)
+        dialect.name = name
+        return dialect
+
+    def test_claim_sql_mysql(self):
+        sql = self._claim_sql(mysql.dialect())
+        self.assertTrue(sql.endswith('LIMIT %s FOR UPDATE SKIP LOCKED'))
+
+    def test_claim_sql_postgresql(self):
+        sql = self._claim_sql(postgresql.dialect())
+        self.assertTrue(sql.endswith('FOR UPDATE SKIP LOCKED'))
+
+    def test_claim_sql_sqlite_has_no_lock_clause(self):
+        sql = self._claim_sql(sqlite.dialect())
+        self.assertFalse('FOR UPDATE' in sql)
+
+    def test_plain_for_update_unchanged(self):
+        statement = db_api._job_next_by_action_statement()
+        statement.for_update = True
+        sql = str(statement.compile(dialect=mysql.dialect()))
+        self.assertTrue(sql.endswith('FOR UPDATE'))
+
+    def test_skip_locked_supported(self):
+        supported = [('postgresql', (9, 5)),
+                     ('postgresql', (12, 3)),
+                     ('mysql', (8, 0, 1)),
+                     ('mysql', (8, 0, 30)),
+                     ('mysql', (10, 6, 5, 'MariaDB'))]
+        unsupported = [('postgresql', (9, 4, 26)),
+                       ('mysql', (5, 7, 40)),
+                       ('mysql', (8, 0, 0)),
+                       ('mysql', (10, 5, 9, 'MariaDB')),
+                       ('sqlite', (3, 7, 17)),
+                       ('mysql', None)]
+        for name, version in supported:
+            self.assertTrue(db_api._skip_locked_supported(
+                self._dialect(name, version)), (name, version))
+        for name, version in unsupported:
+            self.assertFalse(db_api._skip_locked_supported(
+                self._dialect(name, version)), (name, version))
+
+    def test_use_skip_locked_forced(self):
+        self.config(job_claim_strategy='skip_locked')
+        self.assertTrue(db_api._use_skip_locked())
+        self.config(job_claim_strategy='optimistic')
+        self.assertFalse(db_api._use_skip_locked())
+
+    def test_use_skip_locked_invalid_strategy(self):
+        self.config(job_claim_strategy='pessimistic')
+        self.assertRaises(exception.QonosException, db_api._use_skip_locked)
+
+    def test_use_skip_locked_auto_detects_once(self):
+        engine = mock.Mock()
+        engine.dialect = self._dialect('postgresql', (9, 6))
+        with mock.patch.object(db_api, 'get_engine',
+                               return_value=engine) as get_engine:
+            self.assertTrue(db_api._use_skip_locked())
+            self.assertTrue(db_api._use_skip_locked())
+        self.assertEqual(1, get_engine.call_count)
+
+    def _syntax_error(self):
+        orig = Exception(1064, 'You have an error in your SQL syntax')
+        return sqlalchemy.exc.ProgrammingError('SELECT', {}, orig)
+
+    def test_auto_falls_back_on_syntax_error(self):
+        db_api._SKIP_LOCKED_SUPPORTED = True
+        with mock.patch.object(db_api, '_job_assign_next_skip_locked',
+                               side_effect=self._syntax_error()):
+            with mock.patch.object(db_api, '_job_assign_next_optimistic',
+                                   return_value={'id': 'JOB_1'}) as optimistic:
+                job = db_api.job_get_and_assign_next_by_action(
+                    'snapshot', 'WORKER_1', timeutils.utcnow())
+        self.assertEqual({'id': 'JOB_1'}, job)
+        self.assertEqual(1, optimistic.call_count)
+        self.assertFalse(db_api._SKIP_LOCKED_SUPPORTED)
+
+    def test_forced_skip_locked_raises_syntax_error(self):
+        self.config(job_claim_strategy='skip_locked')
+        with mock.patch.object(db_api, '_job_assign_next_skip_locked',
+                               side_effect=self._syntax_error()):
+            self.assertRaises(sqlalchemy.exc.ProgrammingError,
+                              db_api.job_get_and_assign_next_by_action,
+                              'snapshot', 'WORKER_1', timeutils.utcnow())
+
+    def test_auto_does_not_fall_back_on_other_errors(self):
+        db_api._SKIP_LOCKED_SUPPORTED = True
+        orig = Exception(1213, 'Deadlock found when trying to get lock')
+        error = sqlalchemy.exc.OperationalError('SELECT', {}, orig)
+        with mock.patch.object(db_api, '_job_assign_next_skip_locked',
+                               side_effect=error):
+            self.assertRaises(sqlalchemy.exc.OperationalError,
+                              db_api.job_get_and_assign_next_by_action,
+                              'snapshot', 'WORKER_1', timeutils.utcnow())
+        self.assertTrue(db_api._SKIP_LOCKED_SUPPORTED)
+
+
+class TestLockedReads(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestLockedReads, self).setUp()
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        models.register_models(self.engine)
+        self.stubs.Set(db_api, '_ENGINE', self.engine)
+        self.stubs.Set(db_api, '_MAKERS', {})
+        self.stubs.Set(db_api, '_STATEMENTS', {})
+        self.stubs.Set(db_api, '_COMPILED', {})
+
+    def _postgresql_sql(self, statement):
+        return ' '.join(str(statement.compile(
+            dialect=postgresql.dialect())).split())
+
+    def test_locked_statement_postgresql(self):
+        sql = self._postgresql_sql(db_api._by_id_statement(models.Job,
+                                                           lock=True))
+        self.assertTrue(sql.endswith('WHERE jobs.id = %(id)s FOR UPDATE'),
+                        sql)
+        self.assertFalse('JOIN' in sql, sql)
+
+    def test_locked_read_with_metadata_locks_parent_only(self):
+        now = timeutils.utcnow()
+        job = db_api.job_create({
+            'tenant': 'TENANT_1', 'action': 'snapshot', 'status': 'QUEUED',
+            'timeout': now, 'hard_timeout': now,
+            'job_metadata': [{'key': 'instance_id', 'value': 'INSTANCE_1'}]})
+        built = []
+        execute_cached = db_api._execute_cached
+
+        def record(session, name, build, params):
+            built.append(build())
+            return execute_cached(session, name, build, params)
+
+        self.stubs.Set(db_api, '_execute_cached', record)
+        session = db_api.get_session()
+        with session.begin():
+            job_ref = db_api._instance_by_id(session, models.Job, job['id'],
+                                             'job_metadata', lock=True)
+            item = db_api._project_by_id(session, models.Job, job['id'],
+                                         'job_metadata', lock=True)
+
+        self.assertEqual(['instance_id'],
+                         [meta.key for meta in job_ref.job_metadata])
+        self.assertEqual(['INSTANCE_1'],
+                         [meta['value'] for meta in item['job_metadata']])
+        self.assertEqual(4, len(built))
+        for statement in built:
+            sql = self._postgresql_sql(statement)
+            self.assertFalse('JOIN' in sql and 'FOR UPDATE' in sql, sql)
+        self.assertTrue(self._postgresql_sql(built[0]).endswith(
+            'FOR UPDATE'))
+
+
+class TestSessions(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSessions, self).setUp()
+        self.stubs.Set(db_api, '_ENGINE',
+                       sqlalchemy.create_engine('sqlite://'))
+        self.stubs.Set(db_api, '_MAKERS', {})
+
+    def test_get_session_honours_arguments(self):
+        self.assertTrue(db_api.get_session().autocommit)
+        session = db_api.get_session(autocommit=False, expire_on_commit=True)
+        self.assertFalse(session.autocommit)
+        self.assertTrue(session.expire_on_commit)
+        self.assertEqual(2, len(db_api._MAKERS))
+
+    def test_get_session_outside_scope_returns_new_sessions(self):
+        self.assertFalse(db_api.get_session() is db_api.get_session())
+
+    def test_request_scope_shares_session(self):
+        with db_api.request_scope():
+            session = db_api.get_session()
+            self.assertTrue(session is db_api.get_session())
+            self.assertFalse(session is db_api.get_session(autocommit=False))
+
+        self.assertFalse(session is db_api.get_session())
+
+    def test_nested_request_scope_uses_outer_session(self):
+        with db_api.request_scope():
+            session = db_api.get_session()
+            with mock.patch.object(session, 'close') as close:
+                with db_api.request_scope():
+                    self.assertTrue(session is db_api.get_session())
+            self.assertFalse(close.called)
+            self.assertTrue(session is db_api.get_session())
+
+    def test_request_scope_closes_session(self):
+        with mock.patch.object(sqlalchemy.orm.Session, 'close') as close:
+            with db_api.request_scope():
+                pass
+        close.assert_called_once_with()
+
+    def test_request_scope_rolls_back_on_error(self):
+        with mock.patch.object(sqlalchemy.orm.Session, 'rollback') as rollback:
+            with mock.patch.object(sqlalchemy.orm.Session, 'close') as close:
+                try:
+                    with db_api.request_scope():
+                        raise ValueError()
+                except ValueError:
+                    pass
+        rollback.assert_called_once_with()
+        close.assert_called_once_with()
+        self.assertEqual(None, db_api._REQUEST.session)
+
+    def test_engine_scope_binds_sessions(self):
+        shard = sqlalchemy.create_engine('sqlite://')
+        with db_api.request_scope():
+            with db_api.engine_scope(shard):
+                session = db_api.get_session()
+                self.assertTrue(session.bind is shard)
+                self.assertFalse(session is db_api.get_session())
+                self.assertTrue(db_api.get_session(use_slave=True).bind
+                                is shard)
+            self.assertTrue(db_api.get_session().bind is db_api._ENGINE)
+        self.assertEqual(None, db_api._REQUEST.engine)
+
+
+class TestSlaveSessions(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSlaveSessions, self).setUp()
+        self.primary = sqlalchemy.create_engine('sqlite://')
+        self.slave = sqlalchemy.create_engine('sqlite://')
+        self.stubs.Set(db_api, '_ENGINE', self.primary)
+        self.stubs.Set(db_api, '_SLAVE_ENGINE', self.slave)
+        self.stubs.Set(db_api, '_MAKERS', {})
+        self.stubs.Set(db_api, '_SLAVE_STATE',
+                       {'checked_at': None, 'usable': False})
+        self.lag = mock.Mock(return_value=0)
+        self.stubs.Set(db_api, '_replication_lag', self.lag)
+        self.now = 1000.0
+        self.stubs.Set(db_api.time, 'time', lambda: self.now)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_reads_use_slave(self):
+        self.assertTrue(db_api.get_session(use_slave=True).bind is self.slave)
+        self.assertTrue(db_api.get_session().bind is self.primary)
+        self.assertEqual(0.0, metrics.get_stats()['gauges']['db.slave.lag'])
+
+    def test_no_slave_configured(self):
+        self.stubs.Set(db_api, '_SLAVE_ENGINE', None)
+        session = db_api.get_session(use_slave=True)
+        self.assertTrue(session.bind is self.primary)
+        self.assertFalse(self.lag.called)
+
+    def test_lagging_slave_not_used(self):
+        self.config(slave_max_lag=10)
+        self.lag.return_value = 30
+        session = db_api.get_session(use_slave=True)
+        self.assertTrue(session.bind is self.primary)
+
+    def test_broken_replication_not_used(self):
+        self.lag.return_value = None
+        session = db_api.get_session(use_slave=True)
+        self.assertTrue(session.bind is self.primary)
+
+    def test_lag_check_error_not_used(self):
+        self.lag.side_effect = sqlalchemy.exc.OperationalError('', '', '')
+        session = db_api.get_session(use_slave=True)
+        self.assertTrue(session.bind is self.primary)
+
+    def test_lag_checked_once_per_interval(self):
+        self.lag.return_value = 30
+        db_api.get_session(use_slave=True)
+        self.lag.return_value = 0
+        self.now += db_api._SLAVE_LAG_CHECK_INTERVAL - 1
+        session = db_api.get_session(use_slave=True)
+        self.assertTrue(session.bind is self.primary)
+        self.assertEqual(1, self.lag.call_count)
+
+        self.now += 1
+        session = db_api.get_session(use_slave=True)
+        self.assertTrue(session.bind is self.slave)
+        self.assertEqual(2, self.lag.call_count)
+
+    def test_lag_check_disabled(self):
+        self.config(slave_max_lag=-1)
+        self.lag.return_value = None
+        session = db_api.get_session(use_slave=True)
+        self.assertTrue(session.bind is self.slave)
+        self.assertFalse(self.lag.called)
+
+    def test_request_scope_shares_slave_session(self):
+        with mock.patch.object(sqlalchemy.orm.Session, 'close') as close:
+            with db_api.request_scope():
+                session = db_api.get_session(use_slave=True)
+                self.assertTrue(session.bind is self.slave)
+                self.assertTrue(session is
+                                db_api.get_session(use_slave=True))
+                self.assertFalse(session is db_api.get_session())
+        self.assertEqual(2, close.call_count)
+        self.assertEqual(None, db_api._REQUEST.slave_session)
+
+
+class TestReplicationLag(utils.BaseTestCase):
+
+    def _engine(self, dialect_name, result):
+        engine = mock.Mock()
+        engine.dialect.name = dialect_name
+        engine.execute.return_value.first.return_value = result
+        engine.execute.return_value.scalar.return_value = result
+        return engine
+
+    def test_mysql(self):
+        engine = self._engine('mysql', {'Seconds_Behind_Master': 3})
+        self.assertEqual(3, db_api._replication_lag(engine))
+        engine.execute.assert_called_once_with('SHOW SLAVE STATUS')
+
+    def test_mysql_broken_replication(self):
+        engine = self._engine('mysql', {'Seconds_Behind_Master': None})
+        self.assertEqual(None, db_api._replication_lag(engine))
+
+    def test_mysql_not_replicating(self):
+        engine = self._engine('mysql', None)
+        self.assertEqual(0, db_api._replication_lag(engine))
+
+    def test_postgresql(self):
+        engine = self._engine('postgresql', 2.5)
+        self.assertEqual(2.5, db_api._replication_lag(engine))
+
+    def test_other_databases(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        self.assertEqual(0, db_api._replication_lag(engine))
+
+
+class TestBinaryUUIDs(utils.BaseTestCase):
+
+    UUID = '0f2b1e5c-4a4e-4c5e-9a2b-6c1d2e3f4a5b'
+
+    def setUp(self):
+        super(TestBinaryUUIDs, self).setUp()
+        self.dialect = mysql.dialect()
+        self.dialect.binary_uuids = True
+        self.uuid_type = models.UUID()
+
+    def test_ddl(self):
+        ddl = str(sqlalchemy.schema.CreateTable(
+            models.Job.__table__).compile(dialect=self.dialect))
+        self.assertTrue('id BINARY(16) NOT NULL' in ddl)
+        self.assertTrue('version_id VARCHAR(36)' in ddl)
+
+    def test_ddl_not_converted(self):
+        ddl = str(sqlalchemy.schema.CreateTable(
+            models.Job.__table__).compile(dialect=mysql.dialect()))
+        self.assertTrue('id VARCHAR(36) NOT NULL' in ddl)
+
+    def test_round_trip(self):
+        stored = self.uuid_type.process_bind_param(self.UUID, self.dialect)
+        self.assertEqual(16, len(stored))
+        self.assertEqual(self.UUID, self.uuid_type.process_result_value(
+            stored, self.dialect))
+
+    def test_ddl_fault_worker_id_not_converted(self):
+        ddl = str(sqlalchemy.schema.CreateTable(
+            models.JobFault.__table__).compile(dialect=self.dialect))
+        self.assertTrue('job_id BINARY(16) NOT NULL' in ddl)
+        self.assertTrue('worker_id VARCHAR(36) NOT NULL' in ddl)
+
+    def test_strings_elsewhere(self):
+        dialect = sqlite.dialect()
+        self.assertEqual(self.UUID, self.uuid_type.process_bind_param(
+            self.UUID, dialect))
+        self.assertEqual(self.UUID, self.uuid_type.process_result_value(
+            self.UUID, dialect))
+
+    def _listen(self, data_type):
+        dialect = mysql.dialect()
+        dbapi_conn = mock.Mock()
+        cursor = dbapi_conn.cursor.return_value
+        cursor.fetchone.return_value = data_type and (data_type,)
+        db_api.binary_uuids_listener(dialect, dbapi_conn, None)
+        return models.uses_binary_uuids(dialect)
+
+    def test_listener_binary(self):
+        self.assertTrue(self._listen('binary'))
+
+    def test_listener_varchar(self):
+        self.assertFalse(self._listen('varchar'))
+
+    def test_listener_no_tables(self):
+        self.assertFalse(self._listen(None))
+
+
+class TestUpsert(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestUpsert, self).setUp()
+        table = models.JobMetadata.__table__
+        rows = [{'id': 'ID_%d' % i, 'job_id': 'JOB_1', 'key': 'key%d' % i,
+                 'value': 'value%d' % i} for i in range(2)]
+        self.upsert = db_api.Upsert(table, rows, ('job_id', 'key'),
+                                    ['value'])
+
+    def _compile(self, dialect, version=None):
+        dialect.server_version_info = version
+        return ' '.join(str(self.upsert.compile(dialect=dialect)).split())
+
+    def _dialect(self, name, version):
+        dialect = mock.Mock(server_version_info=version)
+        dialect.name = name
+        return dialect
+
+    def test_upsert_supported(self):
+        supported = [('mysql', (5, 5, 40)),
+                     ('sqlite', (3, 24, 0)),
+                     ('sqlite', (3, 40, 1)),
+                     ('postgresql', (9, 5)),
+                     ('postgresql', (12, 3))]
+        unsupported = [('sqlite', (3, 23, 1)),
+                       ('sqlite', None),
+                       ('postgresql', (9, 4, 26)),
+                       ('postgresql', None),
+                       ('oracle', (11, 2))]
+        for name, version in supported:
+            self.assertTrue(db_api._upsert_supported(
+                self._dialect(name, version)), (name, version))
+        for name, version in unsupported:
+            self.assertFalse(db_api._upsert_supported(
+                self._dialect(name, version)), (name, version))
+
+    def test_unsupported_does_not_compile(self):
+        self.assertRaises(sqlalchemy.exc.CompileError, self._compile,
+                          postgresql.dialect(), (9, 4, 26))
+
+    def test_mysql(self):
+        sql = self._compile(mysql.dialect())
+        self.assertTrue(sql.startswith(
+            'INSERT INTO job_metadata (`id`, `job_id`, `key`, `value`) '
+            'VALUES (%s, %s, %s, %s), (%s, %s, %s, %s)'), sql)
+        self.assertTrue(sql.endswith(
+            'ON DUPLICATE KEY UPDATE `value` = VALUES(`value`)'), sql)
+
+    def test_sqlite(self):
+        sql = self._compile(sqlite.dialect(), (3, 24, 0))
+        self.assertTrue('VALUES (?, ?, ?, ?), (?, ?, ?, ?)' in sql, sql)
+        self.assertTrue(sql.endswith(
+            'ON CONFLICT ("job_id", "key") DO UPDATE '
+            'SET "value" = excluded."value"'), sql)
+
+    def test_postgresql(self):
+        sql = self._compile(postgresql.dialect(), (9, 5))
+        self.assertTrue('VALUES (%(id_0)s, %(job_id_0)s' in sql, sql)
+        self.assertTrue('ON CONFLICT ("job_id", "key") DO UPDATE' in sql,
+                        sql)
+
+
+class TestUpsertFallback(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestUpsertFallback, self).setUp()
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        models.register_models(self.engine)
+        self.stubs.Set(db_api, '_ENGINE', self.engine)
+        self.stubs.Set(db_api, '_MAKERS', {})
+        self.stubs.Set(db_api, '_STATEMENTS', {})
+        self.stubs.Set(db_api, '_COMPILED', {})
+        self.engine.connect().close()
+        self.stubs.Set(self.engine.dialect, 'server_version_info', (3, 23, 1))
+
+    def test_metadata_update_without_upsert(self):
+        schedule = db_api.schedule_create({
+            'tenant': 'TENANT_1', 'action': 'snapshot',
+            'schedule_metadata': [{'key': 'key1', 'value': 'value1'},
+                                  {'key': 'key2', 'value': 'value2'}]})
+        metadata = [{'key': 'key1', 'value': 'changed'},
+                    {'key': 'key3', 'value': 'value3'}]
+
+        result = db_api.schedule_metadata_update(schedule['id'], metadata)
+
+        stored = db_api.schedule_meta_get_all(schedule['id'])
+        self.assertEqual([('key1', 'changed'), ('key3', 'value3')],
+                         sorted((meta['key'], meta['value'])
+                                for meta in stored))
+        self.assertEqual(sorted(stored, key=lambda meta: meta['key']),
+                         sorted(result, key=lambda meta: meta['key']))
+
+
+class TestMetadataJSON(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestMetadataJSON, self).setUp()
+        created = datetime.datetime(2014, 9, 1, 12, 0, 0, 123)
+        self.metadata = [
+            {'id': 'META_1', 'job_id': 'JOB_1', 'key': 'instance_id',
+             'value': u'INSTANCE_\u00e9', 'created_at': created,
+             'updated_at': created},
+            {'id': 'META_2', 'job_id': 'JOB_1', 'key': 'retention',
+             'value': '2', 'created_at': created,
+             'updated_at': created + datetime.timedelta(hours=1)},
+        ]
+
+    def test_round_trip(self):
+        text = models.metadata_to_json(self.metadata)
+        self.assertEqual(self.metadata,
+                         models.metadata_from_json(text, 'job_id', 'JOB_1'))
+
+    def test_empty(self):
+        self.assertEqual('[]', models.metadata_to_json([]))
+        self.assertEqual([], models.metadata_from_json(None, 'job_id',
+                                                       'JOB_1'))
+
+    def test_pattern_found_only_for_key_and_value(self):
+        text = models.metadata_to_json(self.metadata)
+        self.assertIn(models.metadata_json_pattern('retention', '2'), text)
+        self.assertIn(models.metadata_json_pattern('instance_id',
+                                                   u'INSTANCE_\u00e9'), text)
+        self.assertNotIn(models.metadata_json_pattern('instance_id', '2'),
+                         text)
+        self.assertNotIn(models.metadata_json_pattern('retention', '22'),
+                         text)
+
+
+class TestTimedQueuePool(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestTimedQueuePool, self).setUp()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.pool = db_api.TimedQueuePool(
+            lambda: sqlite.dialect.dbapi().connect(':memory:'),
+            pool_size=1, max_overflow=1, timeout=0)
+
+    def test_checkout_metrics(self):
+        first = self.pool.connect()
+        stats = metrics.get_stats()
+        self.assertEqual(1, stats['timers']['db.pool.checkout_wait']['count'])
+        self.assertEqual(1, stats['gauges']['db.pool.checked_out'])
+        self.assertEqual(0.5, stats['gauges']['db.pool.saturation'])
+
+        second = self.pool.connect()
+        self.assertEqual(1.0, metrics.get_stats()['gauges']
+                         ['db.pool.saturation'])
+
+        self.assertRaises(sqlalchemy.exc.TimeoutError, self.pool.connect)
+        self.assertEqual(1, metrics.get_stats()['counters']
+                         ['db.pool.timeouts'])
+
+        first.close()
+        second.close()
+        self.assertEqual(0, metrics.get_stats()['gauges']
+                         ['db.pool.checked_out'])
+
+
+class FakeDBError(Exception):
+
+    def __init__(self, *args, **kwargs):
+        super(FakeDBError, self).__init__(*args)
+        self.pgcode = kwargs.get('pgcode')
+
+
+def _db_error(*args, **kwargs):
+    return sqlalchemy.exc.OperationalError('UPDATE jobs', {},
+                                           FakeDBError(*args, **kwargs))
+
+
+class TestRetryOnDeadlock(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRetryOnDeadlock, self).setUp()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.sleeps = []
+        self.stubs.Set(time, 'sleep', self.sleeps.append)
+        self.config(sql_transaction_retries=3,
+                    sql_transaction_retry_interval=0.1,
+                    sql_transaction_retry_max_interval=0.3)
+
+    def _retried(self, *side_effect):
+        func = mock.Mock(side_effect=side_effect, __name__='job_update')
+        return func, db_api.retry_on_deadlock(func)
+
+    def test_is_transient_error(self):
+        self.assertTrue(db_api.is_transient_error(
+            _db_error(1213, 'Deadlock found when trying to get lock')))
+        self.assertTrue(db_api.is_transient_error(
+            _db_error(1205, 'Lock wait timeout exceeded')))
+        self.assertTrue(db_api.is_transient_error(
+            _db_error('could not serialize access', pgcode='40001')))
+        self.assertTrue(db_api.is_transient_error(
+            _db_error('database is locked')))
+        self.assertFalse(db_api.is_transient_error(
+            _db_error(1062, 'Duplicate entry')))
+        self.assertFalse(db_api.is_transient_error(
+            _db_error('duplicate key value', pgcode='23505')))
+
+    def test_retries_transient_errors(self):
+        func, retried = self._retried(_db_error(1213, 'Deadlock'),
+                                      _db_error(1205, 'Lock wait timeout'),
+                                      'JOB')
+
+        self.assertEqual('JOB', retried('JOB_ID', status='DONE'))
+
+        self.assertEqual([mock.call('JOB_ID', status='DONE')] * 3,
+                         func.call_args_list)
+        self.assertEqual(2, len(self.sleeps))
+        self.assertTrue(0 <= self.sleeps[0] <= 0.1)
+        self.assertTrue(0 <= self.sleeps[1] <= 0.2)
+        self.assertEqual(2, metrics.get_stats()['counters']
+                         ['db.transaction_retries'])
+
+    def test_backoff_capped(self):
+        self.config(sql_transaction_retries=5)
+        errors = [_db_error(1213, 'Deadlock')] * 5
+        func, retried = self._retried(*(errors + ['JOB']))
+
+        retried()
+
+        self.assertTrue(all(sleep <= 0.3 for sleep in self.sleeps))
+
+    def test_gives_up_after_retries(self):
+        error = _db_error(1213, 'Deadlock')
+        func, retried = self._retried(*[error] * 4)
+
+        self.assertRaises(sqlalchemy.exc.OperationalError, retried)
+        self.assertEqual(4, func.call_count)
+        self.assertEqual(3, metrics.get_stats()['counters']
+                         ['db.transaction_retries'])
+
+    def test_other_errors_not_retried(self):
+        func, retried = self._retried(_db_error(1062, 'Duplicate entry'))
+
+        self.assertRaises(sqlalchemy.exc.OperationalError, retried)
+        self.assertEqual(1, func.call_count)
+        self.assertEqual([], self.sleeps)
+
+    def test_disabled(self):
+        self.config(sql_transaction_retries=0)
+        func, retried = self._retried(_db_error(1213, 'Deadlock'))
+
+        self.assertRaises(sqlalchemy.exc.OperationalError, retried)
+        self.assertEqual(1, func.call_count)
+
+    def test_not_retried_inside_callers_transaction(self):
+        self.stubs.Set(db_api, '_ENGINE',
+                       sqlalchemy.create_engine('sqlite://'))
+        self.stubs.Set(db_api, '_MAKERS', {})
+        func, retried = self._retried(_db_error(1213, 'Deadlock'))
+
+        with db_api.request_scope():
+            with db_api.get_session().begin():
+                self.assertRaises(sqlalchemy.exc.OperationalError, retried)
+        self.assertEqual(1, func.call_count)
+
+    def test_isolation_level(self):
+        self.config(sql_isolation_level='READ UNCOMMITTED')
+        engine = db_api._create_engine('sqlite://')
+        connection = engine.connect()
+        self.assertEqual('READ UNCOMMITTED',
+                         engine.dialect.get_isolation_level(
+                             connection.connection))
+        connection.close()
+
+
+class TestLivenessChecker(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestLivenessChecker, self).setUp()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.now = 1000.0
+        self.stubs.Set(time, 'time', lambda: self.now)
+        self.ping = mock.Mock()
+        self.checker = db_api.LivenessChecker(self.ping, 30)
+        self.record = mock.Mock(info={})
+
+    def _checkout(self):
+        self.checker.checkout('DBAPI_CONN', self.record, 'PROXY')
+
+    def _counters(self):
+        return metrics.get_stats()['counters']
+
+    def test_new_connection_not_pinged(self):
+        self.checker.connect('DBAPI_CONN', self.record)
+        self._checkout()
+
+        self.assertFalse(self.ping.called)
+        self.assertEqual(1, self._counters()['db.pool.pings_avoided'])
+
+    def test_recently_used_connection_not_pinged(self):
+        self.checker.checkin('DBAPI_CONN', self.record)
+        self.now += 29
+        self._checkout()
+
+        self.assertFalse(self.ping.called)
+        self.assertEqual(1, self._counters()['db.pool.pings_avoided'])
+
+    def test_idle_connection_pinged(self):
+        self.checker.checkin('DBAPI_CONN', self.record)
+        self.now += 30
+        self._checkout()
+
+        self.ping.assert_called_once_with('DBAPI_CONN', self.record, 'PROXY')
+        self.assertEqual(1, self._counters()['db.pool.pings'])
+        self.assertNotIn('db.pool.pings_avoided', self._counters())
+
+    def test_never_ping(self):
+        checker = db_api.LivenessChecker(self.ping, None)
+        checker.checkin('DBAPI_CONN', self.record)
+        self.now += 3600
+        checker.checkout('DBAPI_CONN', self.record, 'PROXY')
+
+        self.assertFalse(self.ping.called)
+        self.assertEqual({}, self._counters())
+
+    def test_first_use_errors_flagged(self):
+        self._checkout()
+        conn = mock.Mock(info=self.record.info)
+        error = Exception('Cannot operate on a closed database.')
+
+        self.checker.dbapi_error(conn, None, 'SELECT 1', (), None, error)
+        self.assertTrue(error.first_use)
+
+        self.checker.after_cursor_execute(conn, None, 'SELECT 1', (), None,
+                                          False)
+        error = Exception('Cannot operate on a closed database.')
+        self.checker.dbapi_error(conn, None, 'SELECT 1', (), None, error)
+        self.assertFalse(hasattr(error, 'first_use'))
+
+    def test_strategies(self):
+        for pre_ping, idle_time in (('auto', None), ('idle', 30),
+                                    ('always', 0), ('never', None)):
+            self.config(sql_pool_pre_ping=pre_ping)
+            with mock.patch.object(db_api, 'LivenessChecker') as checker:
+                db_api._create_engine('sqlite://')
+            checker.assert_called_once_with(db_api.generic_ping_listener,
+                                            idle_time)
+
+    def test_invalid_strategy(self):
+        self.config(sql_pool_pre_ping='sometimes')
+        self.assertRaises(exception.QonosException, db_api._create_engine,
+                          'sqlite://')
+
+
+class DroppableConnection(object):
+    """A sqlite connection whose statements fail as on a dead connection
+    once it is dropped."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.dropped = False
+
+    def cursor(self):
+        return DroppableCursor(self, self.connection.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class DroppableCursor(object):
+
+    def __init__(self, connection, cursor):
+        self._connection = connection
+        self.cursor = cursor
+
+    def execute(self, *args):
+        if self._connection.dropped:
+            raise sqlite3.ProgrammingError(
+                'Cannot operate on a closed database.')
+        return self.cursor.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class TestRetryOnDisconnect(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRetryOnDisconnect, self).setUp()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.connections = []
+
+        def connect():
+            connection = DroppableConnection(
+                sqlite3.connect(os.path.join(path, 'qonos.sqlite')))
+            self.connections.append(connection)
+            return connection
+
+        # NOTE: File databases are not pooled by default, connections must
+        # be reused for one to go stale.
+        self.engine = sqlalchemy.create_engine(
+            'sqlite://', creator=connect,
+            poolclass=sqlalchemy.pool.QueuePool, pool_size=1)
+        db_api.LivenessChecker(db_api.generic_ping_listener, 30).listen(
+            self.engine)
+        models.register_models(self.engine)
+        self.stubs.Set(db_api, '_ENGINE', self.engine)
+        self.stubs.Set(db_api, '_MAKERS', {})
+        self.worker = db_api.worker_create({'host': 'host1'})
+
+    def _kill_pooled_connection(self):
+        self.assertEqual(1, len(self.connections))
+        self.connections[0].dropped = True
+
+    def test_read_retried_on_new_connection(self):
+        self._kill_pooled_connection()
+
+        worker = db_api.worker_get_by_id(self.worker['id'])
+
+        self.assertEqual(self.worker['id'], worker['id'])
+        self.assertEqual(1, metrics.get_stats()['counters']
+                         ['db.disconnect_retries'])
+
+    def test_write_retried_on_new_connection(self):
+        self._kill_pooled_connection()
+
+        db_api.worker_delete(self.worker['id'])
+
+        self.assertRaises(exception.NotFound, db_api.worker_get_by_id,
+                          self.worker['id'])
+        self.assertEqual(1, metrics.get_stats()['counters']
+                         ['db.disconnect_retries'])
+
+    def test_not_retried_after_first_use(self):
+        error = sqlalchemy.exc.OperationalError(
+            'SELECT', {}, Exception('server has gone away'),
+            connection_invalidated=True)
+        func = mock.Mock(side_effect=[error, 'WORKER'],
+                         __name__='worker_get_by_id')
+
+        self.assertRaises(sqlalchemy.exc.OperationalError,
+                          db_api.retry_on_disconnect(func))
+        self.assertEqual(1, func.call_count)
+
+    def test_retried_once(self):
+        orig = Exception('server has gone away')
+        orig.first_use = True
+        error = sqlalchemy.exc.OperationalError(
+            'SELECT', {}, orig, connection_invalidated=True)
+        func = mock.Mock(side_effect=[error, error],
+                         __name__='worker_get_by_id')
+
+        self.assertRaises(sqlalchemy.exc.OperationalError,
+                          db_api.retry_on_disconnect(func))
+        self.assertEqual(2, func.call_count)
@@ -18,11 +18,11 @@ import datetime
 import uuid
 import webob.exc
 
-from qonos.api.v1 import api_utils
 from qonos.api.v1 import jobs
 from qonos.common import exception
 from qonos.common import timeutils
 from qonos.common import utils
+from qonos.db import db_utils
 import qonos.db.simple.api as db_api
 from qonos.tests.unit import utils as unit_utils
 from qonos.tests import utils as test_utils
@@ -153,9 +153,38 @@ class TestJobsApi(test_utils.BaseTestCase):
         self.assertTrue(links)
         for item in links:
             if item.get('rel') == 'next':
-                marker = self.job_2['id']
+                cursor = db_utils.encode_cursor(self.job_2, ['id'], ['asc'])
                 self.assertEqual(item.get('href'),
-                                 '/v1/jobs?marker=%s' % marker)
+                                 '/v1/jobs?cursor=%s' % cursor)
+
+    def test_stats(self):
+        db_api.job_create(dict(self.job_1, id=None, worker_id=None,
+                               action='test_action'))
+        timeutils.advance_time_seconds(90)
+
+        request = unit_utils.get_fake_request(method='GET')
+        stats = self.controller.stats(request)['stats']
+
+        self.assertEqual(5, stats['total'])
+        self.assertEqual(1, stats['claimable'])
+        snapshot = stats['actions']['snapshot']
+        self.assertEqual({'QUEUED': 2, 'ERROR': 1}, snapshot['statuses'])
+        self.assertEqual(0, snapshot['claimable'])
+        self.assertEqual(None, snapshot['oldest_claimable'])
+        self.assertEqual(None, snapshot['oldest_claimable_age'])
+        test_action = stats['actions']['test_action']
+        self.assertEqual(1, test_action['claimable'])
+        self.assertEqual(90, test_action['oldest_claimable_age'])
+        self.assertTrue(isinstance(test_action['oldest_claimable'],
+                                   basestring))
+
+    def test_stats_by_tenant(self):
+        request = unit_utils.get_fake_request(
+            path='?tenant=%s' % unit_utils.TENANT2, method='GET')
+        stats = self.controller.stats(request)['stats']
+        self.assertEqual(1, stats['total'])
+        self.assertEqual({'ERROR': 1},
+                         stats['actions']['snapshot']['statuses'])
 
     def test_list_limit(self):
         path = '?limit=2'
@@ -230,9 +259,43 @@ class TestJobsApi(test_utils.BaseTestCase):
                              set([self.job_2[k], self.job_3[k]]))
         for item in links:
             if item.get('rel') == 'next':
-                marker = unit_utils.JOB_UUID3
-                self.assertEqual(item.get('href'), '/v1/jobs?marker=%s' %
-                                 marker)
+                cursor = db_utils.encode_cursor(self.job_3, ['id'], ['asc'])
+                self.assertEqual(item.get('href'), '/v1/jobs?cursor=%s' %
+                                 cursor)
+
+    def test_list_sorted_with_cursor(self):
+        self.config(limit_param_default=2, api_limit_max=4)
+        ids = sorted([self.job_1['id'], self.job_2['id'], self.job_3['id'],
+                      self.job_4['id']], reverse=True)
+        path = '?sort_key=id&sort_dir=desc'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        response = self.controller.list(request)
+        self.assertEqual(ids[:2], [job['id'] for job in response['jobs']])
+
+        next_page = response['jobs_links'][0]['href']
+        self.assertTrue(next_page.startswith('/v1/jobs?cursor='))
+        request = unit_utils.get_fake_request(
+            path=next_page[len('/v1/jobs'):], method='GET')
+        response = self.controller.list(request)
+        self.assertEqual(ids[2:], [job['id'] for job in response['jobs']])
+
+    def test_list_invalid_sort_key(self):
+        path = '?sort_key=status'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.list, request)
+
+    def test_list_invalid_sort_dir(self):
+        path = '?sort_key=created_at&sort_dir=up'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.list, request)
+
+    def test_list_invalid_cursor(self):
+        path = '?cursor=not-a-cursor'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.list, request)
 
     def test_list_with_schedule_id_filter(self):
         path = '?schedule_id=%s' % unit_utils.SCHEDULE_UUID1
@@ -308,7 +371,7 @@ class TestJobsApi(test_utils.BaseTestCase):
             self.assertEqual(timeutils.utcnow(), start_time)
             return expected_next_run
 
-        self.stubs.Set(api_utils, 'schedule_to_next_run',
+        self.stubs.Set(utils, 'schedule_to_next_run',
                        fake_schedule_to_next_run)
 
         request = unit_utils.get_fake_request(method='POST')
@@ -338,7 +401,7 @@ class TestJobsApi(test_utils.BaseTestCase):
             self.assertEqual(timeutils.utcnow(), start_time)
             return expected_next_run
 
-        self.stubs.Set(api_utils, 'schedule_to_next_run',
+        self.stubs.Set(utils, 'schedule_to_next_run',
                        fake_schedule_to_next_run)
 
         self._stub_notifications(None, 'qonos.job.create', 'fake-payload',
@@ -25,6 +25,7 @@ from qonos.api.v1 import schedules
 from qonos.common import exception
 from qonos.common import timeutils
 from qonos.common import utils as qonos_utils
+from qonos.db import db_utils
 from qonos.db.simple import api as db_api
 from qonos.tests.unit import utils as unit_utils
 from qonos.tests import utils as test_utils
@@ -212,9 +213,34 @@ class TestSchedulesApi(test_utils.BaseTestCase):
                              set([self.schedule_2[k], self.schedule_3[k]]))
         for item in links:
             if item.get('rel') == 'next':
-                marker = unit_utils.SCHEDULE_UUID3
-                self.assertEqual(item.get('href'), '/v1/schedules?marker=%s' %
-                                 marker)
+                cursor = db_utils.encode_cursor(self.schedule_3, ['id'],
+                                                ['asc'])
+                self.assertEqual(item.get('href'), '/v1/schedules?cursor=%s' %
+                                 cursor)
+
+    def test_list_sorted_by_next_run(self):
+        schedules = sorted([self.schedule_1, self.schedule_2,
+                            self.schedule_3, self.schedule_4],
+                           key=lambda s: (s['next_run'], s['id']),
+                           reverse=True)
+        path = '?sort_key=next_run&sort_dir=desc&limit=3'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        response = self.controller.list(request)
+        self.assertEqual([s['id'] for s in schedules[:3]],
+                         [s['id'] for s in response['schedules']])
+
+        next_page = response['schedules_links'][0]['href']
+        request = unit_utils.get_fake_request(
+            path=next_page[len('/v1/schedules'):], method='GET')
+        response = self.controller.list(request)
+        self.assertEqual([schedules[3]['id']],
+                         [s['id'] for s in response['schedules']])
+
+    def test_list_invalid_sort_key(self):
+        path = '?sort_key=tenant'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.list, request)
 
     def test_get(self):
         request = unit_utils.get_fake_request(method='GET')
@@ -616,6 +642,17 @@ class TestSchedulesApi(test_utils.BaseTestCase):
         self.assertRaises(webob.exc.HTTPNotFound, self.controller.update,
                           request, schedule_id, {'schedule': {}})
 
+    def test_update_invalid(self):
+        def fake_schedule_update(schedule_id, values):
+            raise exception.Invalid()
+
+        self.stubs.Set(db_api, 'schedule_update', fake_schedule_update)
+        request = unit_utils.get_fake_request(method='PUT')
+        update_fixture = {'schedule': {'tenant': 'new-tenant-name'}}
+
+        self.assertRaises(webob.exc.HTTPBadRequest, self.controller.update,
+                          request, self.schedule_1['id'], update_fixture)
+
     def test_update_no_body_bad_request(self):
         request = unit_utils.get_fake_request(method='PUT')
         schedule_id = str(uuid.uuid4())
@@ -23,6 +23,7 @@ from oslo.config import cfg
 from qonos.api.v1 import workers
 from qonos.common import exception
 from qonos.common import timeutils
+from qonos.db import db_utils
 import qonos.db.simple.api as db_api
 from qonos.tests.unit import utils as unit_utils
 from qonos.tests import utils as test_utils
@@ -241,6 +242,34 @@ class TestWorkersApi(test_utils.BaseTestCase):
             self.assertEqual(set([s[k] for s in workers]),
                              set([self.worker_2[k]]))
 
+    def test_list_workers_links(self):
+        self.config(limit_param_default=2, api_limit_max=4)
+        request = unit_utils.get_fake_request(method='GET')
+        links = self.controller.list(request).get('workers_links')
+        cursor = db_utils.encode_cursor(self.worker_2, ['id'], ['asc'])
+        self.assertEqual([{'rel': 'next',
+                           'href': '/v1/workers?cursor=%s' % cursor}], links)
+
+    def test_list_sorted_by_host(self):
+        path = '?sort_key=host&limit=3'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        response = self.controller.list(request)
+        self.assertEqual(['bar.bar', 'baz.cow', 'foo.cow'],
+                         [w['host'] for w in response['workers']])
+
+        next_page = response['workers_links'][0]['href']
+        request = unit_utils.get_fake_request(
+            path=next_page[len('/v1/workers'):], method='GET')
+        response = self.controller.list(request)
+        self.assertEqual(['qux.bar'],
+                         [w['host'] for w in response['workers']])
+
+    def test_list_invalid_sort_key(self):
+        path = '?sort_key=process_id'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.list, request)
+
     def test_get(self):
         request = unit_utils.get_fake_request(method='GET')
         actual = self.controller.get(request,
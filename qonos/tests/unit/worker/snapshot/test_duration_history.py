@@ -0,0 +1,70 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from qonos.common import state_store
+from qonos.tests import utils as test_utils
+from qonos.worker.snapshot import duration_history
+
+
+class TestDurationHistory(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestDurationHistory, self).setUp()
+        self.history = duration_history.DurationHistory(
+            state_store.MemoryStateStore(), smoothing=0.5)
+
+    def test_no_history(self):
+        self.assertIsNone(self.history.expected_duration('instance', 'flv'))
+
+    def test_first_duration_is_expected(self):
+        self.history.record(100, 'instance')
+        self.assertEqual(100, self.history.expected_duration('instance'))
+
+    def test_durations_are_averaged(self):
+        self.history.record(100, 'instance')
+        self.history.record(200, 'instance')
+        self.assertEqual(150, self.history.expected_duration('instance'))
+
+    def test_flavor_is_fallback(self):
+        self.history.record(100, 'instance', 'flv')
+        self.history.record(300, 'other-instance', 'flv')
+        self.assertEqual(100, self.history.expected_duration('instance',
+                                                             'flv'))
+        self.assertEqual(200, self.history.expected_duration('new-instance',
+                                                             'flv'))
+        self.assertIsNone(self.history.expected_duration('new-instance'))
+
+
+class TestNextPollInterval(test_utils.BaseTestCase):
+
+    def _interval(self, elapsed, expected):
+        return duration_history.next_poll_interval(
+            elapsed, expected, base_interval=30, min_interval=10,
+            max_interval=150)
+
+    def test_no_history_uses_base_interval(self):
+        self.assertEqual(30, self._interval(0, None))
+
+    def test_sparse_at_start(self):
+        self.assertEqual(150, self._interval(0, 1000))
+        self.assertEqual(100, self._interval(0, 200))
+
+    def test_denser_near_completion(self):
+        self.assertEqual(40, self._interval(920, 1000))
+        self.assertEqual(10, self._interval(995, 1000))
+
+    def test_overdue_uses_base_interval(self):
+        self.assertEqual(30, self._interval(1100, 1000))
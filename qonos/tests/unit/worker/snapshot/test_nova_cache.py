@@ -0,0 +1,111 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import shutil
+
+import mock
+from novaclient import exceptions
+
+from qonos.common import state_store
+from qonos.tests import utils as test_utils
+from qonos.worker.snapshot import nova_cache
+
+
+class TestNovaCache(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestNovaCache, self).setUp()
+        self.now = 1000.0
+        time_patcher = mock.patch.object(nova_cache, 'time')
+        mock_time = time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        mock_time.time.side_effect = lambda: self.now
+        self.cache = nova_cache.NovaCache(state_store.MemoryStateStore(),
+                                          ttls={'server': 100,
+                                                'retention': 10},
+                                          not_found_ttl=5)
+        self.loader = mock.Mock(return_value='value')
+
+    def test_miss_loads_value(self):
+        self.assertEqual('value',
+                         self.cache.get('server', 'instance', self.loader))
+        self.assertEqual(1, self.loader.call_count)
+
+    def test_hit_does_not_load(self):
+        self.cache.get('server', 'instance', self.loader)
+        self.now += 99
+        self.assertEqual('value',
+                         self.cache.get('server', 'instance', self.loader))
+        self.assertEqual(1, self.loader.call_count)
+
+    def test_expired_entry_is_reloaded(self):
+        self.cache.get('retention', 'instance', self.loader)
+        self.now += 10
+        self.cache.get('retention', 'instance', self.loader)
+        self.assertEqual(2, self.loader.call_count)
+
+    def test_kinds_are_cached_separately(self):
+        self.cache.get('server', 'instance', self.loader)
+        self.cache.get('retention', 'instance', self.loader)
+        self.assertEqual(2, self.loader.call_count)
+
+    def test_not_found_is_cached(self):
+        self.loader.side_effect = exceptions.NotFound(404, 'gone')
+        self.assertRaises(exceptions.NotFound, self.cache.get,
+                          'server', 'instance', self.loader)
+        self.assertRaises(exceptions.NotFound, self.cache.get,
+                          'server', 'instance', self.loader)
+        self.assertEqual(1, self.loader.call_count)
+
+    def test_not_found_expires(self):
+        self.loader.side_effect = [exceptions.NotFound(404), 'value']
+        self.assertRaises(exceptions.NotFound, self.cache.get,
+                          'server', 'instance', self.loader)
+        self.now += 5
+        self.assertEqual('value',
+                         self.cache.get('server', 'instance', self.loader))
+
+    def test_other_errors_are_not_cached(self):
+        self.loader.side_effect = [Exception('boom'), 'value']
+        self.assertRaises(Exception, self.cache.get,
+                          'server', 'instance', self.loader)
+        self.assertEqual('value',
+                         self.cache.get('server', 'instance', self.loader))
+
+    def test_invalidate(self):
+        self.cache.get('server', 'instance', self.loader)
+        self.cache.invalidate('server', 'instance')
+        self.cache.get('server', 'instance', self.loader)
+        self.assertEqual(2, self.loader.call_count)
+
+
+class TestCreateNovaCache(test_utils.BaseTestCase):
+
+    def test_enabled_by_default(self):
+        cache = nova_cache.create_nova_cache()
+        self.assertTrue(isinstance(cache.store, state_store.MemoryStateStore))
+        self.assertEqual({'server': 86400, 'retention': 3600}, cache.ttls)
+        self.assertEqual(300, cache.not_found_ttl)
+
+    def test_disabled(self):
+        self.config(enabled=False, group='nova_cache')
+        self.assertIsNone(nova_cache.create_nova_cache())
+
+    def test_forking_worker_shares_cache(self):
+        self.config(max_child_processes=2, group='worker')
+        cache = nova_cache.create_nova_cache()
+        self.addCleanup(shutil.rmtree, cache.store.path, True)
+        self.assertTrue(isinstance(cache.store, state_store.FileStateStore))
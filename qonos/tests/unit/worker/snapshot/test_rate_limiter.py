@@ -0,0 +1,172 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import shutil
+import tempfile
+
+import mock
+
+from qonos.common import metrics
+from qonos.common import state_store
+from qonos.tests import utils as test_utils
+from qonos.worker.snapshot import rate_limiter
+
+
+TENANT = '44444444-4444-4444-4444-44444444'
+
+
+class TestRateLimiter(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRateLimiter, self).setUp()
+        metrics.reset()
+        self.now = 1000.0
+        self.sleeps = []
+        time_patcher = mock.patch.object(rate_limiter, 'time')
+        self.mock_time = time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        self.mock_time.time.side_effect = lambda: self.now
+        self.mock_time.sleep.side_effect = self.sleeps.append
+
+    def _limiter(self, store=None, **kwargs):
+        store = store or state_store.MemoryStateStore()
+        return rate_limiter.RateLimiter(store, **kwargs)
+
+    def test_no_limits_never_waits(self):
+        limiter = self._limiter()
+        for i in range(10):
+            self.assertEqual(0, limiter.acquire(TENANT, 'servers'))
+        self.assertEqual([], self.sleeps)
+
+    def test_tenant_burst_then_wait(self):
+        limiter = self._limiter(tenant_rate=2, tenant_burst=2)
+        self.assertEqual(0, limiter.acquire(TENANT, 'servers'))
+        self.assertEqual(0, limiter.acquire(TENANT, 'images'))
+        self.assertAlmostEqual(0.5, limiter.acquire(TENANT, 'images'))
+        self.assertAlmostEqual(1.0, limiter.acquire(TENANT, 'images'))
+        self.assertEqual(2, len(self.sleeps))
+
+    def test_tenants_have_separate_buckets(self):
+        limiter = self._limiter(tenant_rate=1, tenant_burst=1)
+        self.assertEqual(0, limiter.acquire(TENANT, 'servers'))
+        self.assertEqual(0, limiter.acquire('other-tenant', 'servers'))
+        self.assertAlmostEqual(1.0, limiter.acquire(TENANT, 'servers'))
+
+    def test_bucket_refills_over_time(self):
+        limiter = self._limiter(tenant_rate=1, tenant_burst=1)
+        self.assertEqual(0, limiter.acquire(TENANT, 'servers'))
+        self.now += 1
+        self.assertEqual(0, limiter.acquire(TENANT, 'servers'))
+
+    def test_family_limit_only_applies_to_family(self):
+        limiter = self._limiter(family_rates={'image_create': 0.5},
+                                family_burst=1)
+        self.assertEqual(0, limiter.acquire(TENANT, 'image_create'))
+        self.assertAlmostEqual(2.0, limiter.acquire('t2', 'image_create'))
+        self.assertEqual(0, limiter.acquire(TENANT, 'images'))
+
+    def test_wait_is_max_of_tenant_and_family(self):
+        limiter = self._limiter(tenant_rate=1, tenant_burst=1,
+                                family_rates={'images': 0.25},
+                                family_burst=1)
+        limiter.acquire(TENANT, 'images')
+        self.assertAlmostEqual(4.0, limiter.acquire(TENANT, 'images'))
+
+    def test_wait_time_recorded_as_metric(self):
+        limiter = self._limiter(tenant_rate=1, tenant_burst=1)
+        limiter.acquire(TENANT, 'servers')
+        limiter.acquire(TENANT, 'servers')
+        timers = metrics.get_stats()['timers']
+        self.assertEqual(2, timers['nova.rate_limit.wait']['count'])
+        self.assertAlmostEqual(1.0, timers['nova.rate_limit.wait']['total'])
+        self.assertEqual(2, timers['nova.rate_limit.wait.servers']['count'])
+
+    def test_file_store_shares_buckets(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        limiter_1 = self._limiter(state_store.FileStateStore(path),
+                                  tenant_rate=1, tenant_burst=1)
+        limiter_2 = self._limiter(state_store.FileStateStore(path),
+                                  tenant_rate=1, tenant_burst=1)
+        self.assertEqual(0, limiter_1.acquire(TENANT, 'servers'))
+        self.assertAlmostEqual(1.0, limiter_2.acquire(TENANT, 'servers'))
+
+
+class TestRateLimitedNovaClient(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRateLimitedNovaClient, self).setUp()
+        self.nova_client = mock.MagicMock()
+        self.limiter = mock.Mock()
+        self.client = rate_limiter.RateLimitedNovaClient(
+            self.nova_client, self.limiter, TENANT)
+
+    def test_server_get(self):
+        self.nova_client.servers.get.return_value = 'server'
+        self.assertEqual('server', self.client.servers.get('instance'))
+        self.limiter.acquire.assert_called_once_with(TENANT, 'servers')
+        self.nova_client.servers.get.assert_called_once_with('instance')
+
+    def test_create_image(self):
+        self.client.servers.create_image('instance', 'name', {})
+        self.limiter.acquire.assert_called_once_with(TENANT, 'image_create')
+
+    def test_images(self):
+        self.client.images.get('image')
+        self.client.images.list(detailed=True)
+        self.client.images.delete('image')
+        self.assertEqual([mock.call(TENANT, 'images')] * 3,
+                         self.limiter.acquire.call_args_list)
+
+    def test_retention(self):
+        self.client.rax_scheduled_images_python_novaclient_ext.get('i')
+        self.limiter.acquire.assert_called_once_with(TENANT, 'retention')
+
+    def test_other_attributes_not_limited(self):
+        self.client.client.authenticate()
+        self.assertFalse(self.limiter.acquire.called)
+
+
+class TestCreateRateLimiter(test_utils.BaseTestCase):
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(rate_limiter.create_rate_limiter())
+
+    def test_enabled_single_process(self):
+        self.config(enabled=True, tenant_requests_per_sec=2.0,
+                    api_family_requests_per_sec={'images': '10'},
+                    group='nova_rate_limit')
+        limiter = rate_limiter.create_rate_limiter()
+        self.assertEqual(2.0, limiter.tenant_rate)
+        self.assertEqual({'images': 10.0}, limiter.family_rates)
+        self.assertTrue(isinstance(limiter.store,
+                                   state_store.MemoryStateStore))
+
+    def test_enabled_forking_worker_shares_state(self):
+        self.config(enabled=True, group='nova_rate_limit')
+        self.config(max_child_processes=2, group='worker')
+        limiter = rate_limiter.create_rate_limiter()
+        self.addCleanup(shutil.rmtree, limiter.store.path, True)
+        self.assertTrue(isinstance(limiter.store,
+                                   state_store.FileStateStore))
+
+    def test_shared_state_dir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.config(enabled=True, shared_state_dir=path,
+                    group='nova_rate_limit')
+        limiter = rate_limiter.create_rate_limiter()
+        self.assertEqual(path, limiter.store.path)
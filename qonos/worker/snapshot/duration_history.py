@@ -0,0 +1,70 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+History of how long snapshots take, used to pace image status polling.
+
+Durations are kept as an exponentially weighted moving average per instance
+and per flavor. The flavor average is the fallback for instances that have
+not been snapshotted by this worker yet.
+"""
+
+
+class DurationHistory(object):
+
+    def __init__(self, store, smoothing=0.3):
+        self.store = store
+        self.smoothing = smoothing
+
+    def _average(self, old, duration):
+        if old is None:
+            return duration
+        return self.smoothing * duration + (1 - self.smoothing) * old
+
+    def record(self, duration, instance_id, flavor_id=None):
+        """Record the duration, in seconds, of a completed snapshot."""
+        keys = ['instance:%s' % instance_id]
+        if flavor_id is not None:
+            keys.append('flavor:%s' % flavor_id)
+        for key in keys:
+            self.store.update(key, lambda old: self._average(old, duration))
+
+    def expected_duration(self, instance_id, flavor_id=None):
+        """Return the expected snapshot duration in seconds, or None."""
+        expected = self.store.get('instance:%s' % instance_id)
+        if expected is None and flavor_id is not None:
+            expected = self.store.get('flavor:%s' % flavor_id)
+        return expected
+
+
+def next_poll_interval(elapsed, expected, base_interval, min_interval,
+                       max_interval):
+    """Return how long to wait before polling a snapshot's status again.
+
+    With no history the base interval is used. Otherwise the wait is half of
+    the time remaining until the expected completion, so polls are sparse
+    at the start and get denser as completion nears. Once the expected
+    completion has passed polling falls back to the base interval.
+    """
+    if expected is None:
+        return base_interval
+
+    remaining = expected - elapsed
+    if remaining <= 0:
+        interval = base_interval
+    else:
+        interval = remaining / 2.0
+    return max(min_interval, min(max_interval, interval))
@@ -0,0 +1,114 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+TTL cache for Nova lookups that rarely change between a server's runs.
+
+Each entry is kept in a state store together with its expiry time. A
+NotFound from Nova is cached as well, for its own, usually shorter, TTL.
+"""
+
+import time
+
+from novaclient import exceptions
+from oslo.config import cfg
+
+from qonos.common import metrics
+from qonos.common import state_store
+from qonos.openstack.common.gettextutils import _
+
+
+nova_cache_opts = [
+    cfg.BoolOpt('enabled', default=True,
+                help=_('Cache server details and retention values looked up '
+                       'in Nova')),
+    cfg.IntOpt('server_ttl_sec', default=86400,
+               help=_('How long to cache server details, in seconds')),
+    cfg.IntOpt('retention_ttl_sec', default=3600,
+               help=_('How long to cache retention values, in seconds')),
+    cfg.IntOpt('not_found_ttl_sec', default=300,
+               help=_('How long to remember that Nova answered NotFound, in '
+                      'seconds')),
+    cfg.StrOpt('shared_state_dir', default=None,
+               help=_('Directory holding the cache so that it is shared '
+                      'between processes and survives restarts. When unset '
+                      'and the worker forks children, a temporary directory '
+                      'is used')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(nova_cache_opts, group='nova_cache')
+CONF.import_opt('max_child_processes', 'qonos.worker.worker', group='worker')
+
+
+class NovaCache(object):
+
+    def __init__(self, store, ttls, not_found_ttl):
+        self.store = store
+        self.ttls = ttls
+        self.not_found_ttl = not_found_ttl
+
+    def get(self, kind, key, loader):
+        """Return the cached value of kind for key, or load and cache it.
+
+        loader() is called on a miss. If it raises novaclient's NotFound,
+        that is cached and raised again on later hits until it expires.
+        """
+        cache_key = '%s:%s' % (kind, key)
+        now = time.time()
+        entry = self.store.get(cache_key)
+        if entry is not None and entry['expires'] > now:
+            metrics.incr('nova.cache.%s.hit' % kind)
+            if entry.get('not_found'):
+                raise exceptions.NotFound(404, entry.get('message'))
+            return entry['value']
+
+        metrics.incr('nova.cache.%s.miss' % kind)
+        try:
+            value = loader()
+        except exceptions.NotFound as e:
+            self.store.set(cache_key, {'expires': now + self.not_found_ttl,
+                                       'not_found': True,
+                                       'message': getattr(e, 'message',
+                                                          None)})
+            raise
+
+        self.store.set(cache_key, {'expires': now + self.ttls[kind],
+                                   'value': value})
+        return value
+
+    def invalidate(self, kind, key):
+        self.store.delete('%s:%s' % (kind, key))
+
+
+def create_nova_cache():
+    """Build the NovaCache described by the configuration.
+
+    Must be called before the worker forks so the children share the cache.
+    Returns None when caching is disabled.
+    """
+    conf = CONF.nova_cache
+    if not conf.enabled:
+        return None
+
+    store = state_store.create_state_store(
+        conf.shared_state_dir,
+        shared=CONF.worker.max_child_processes > 0,
+        prefix='qonos-nova-cache-')
+    return NovaCache(store,
+                     ttls={'server': conf.server_ttl_sec,
+                           'retention': conf.retention_ttl_sec},
+                     not_found_ttl=conf.not_found_ttl_sec)
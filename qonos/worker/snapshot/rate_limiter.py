@@ -0,0 +1,196 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Token bucket rate limiting for the Nova calls made by snapshot workers.
+
+Every call through a RateLimitedNovaClient takes a token from the bucket of
+the job's tenant and from the bucket of the API family being called. When a
+bucket is empty the call sleeps until a token would have been refilled.
+"""
+
+import time
+
+from oslo.config import cfg
+
+from qonos.common import metrics
+from qonos.common import state_store
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+nova_rate_limit_opts = [
+    cfg.BoolOpt('enabled', default=False,
+                help=_('Throttle the Nova calls made by snapshot workers')),
+    cfg.FloatOpt('tenant_requests_per_sec', default=0,
+                 help=_('Nova requests per second allowed for a single '
+                        'tenant. 0 disables the per-tenant limit')),
+    cfg.IntOpt('tenant_burst', default=5,
+               help=_('Number of requests a tenant may make at once before '
+                      'being throttled')),
+    cfg.DictOpt('api_family_requests_per_sec', default={},
+                help=_('Nova requests per second allowed per API family, '
+                       'e.g. "servers:5,image_create:1,images:10,'
+                       'retention:5". Families without a value are not '
+                       'limited')),
+    cfg.IntOpt('api_family_burst', default=5,
+               help=_('Number of requests an API family may receive at once '
+                      'before being throttled')),
+    cfg.StrOpt('shared_state_dir', default=None,
+               help=_('Directory holding the token buckets so that they are '
+                      'shared between processes. When unset and the worker '
+                      'forks children, a temporary directory is used')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(nova_rate_limit_opts, group='nova_rate_limit')
+CONF.import_opt('max_child_processes', 'qonos.worker.worker', group='worker')
+
+# NOTE: Maps (client attribute, method) to the API family it is limited
+# under. Methods not listed here are limited under the attribute name.
+_API_FAMILIES = {
+    ('servers', 'get'): 'servers',
+    ('servers', 'create_image'): 'image_create',
+    ('images', 'get'): 'images',
+    ('images', 'list'): 'images',
+    ('images', 'delete'): 'images',
+    ('rax_scheduled_images_python_novaclient_ext', 'get'): 'retention',
+}
+
+_LIMITED_MANAGERS = set(manager for manager, method in _API_FAMILIES)
+
+
+def _take_token(state, now, rate, burst):
+    """Reserve one token from a bucket state of [tokens, last_refill].
+
+    The token count may go negative; the caller must then wait until the
+    bucket refills back to zero before making its request.
+    """
+    if state is None:
+        tokens = float(burst)
+    else:
+        tokens, last_refill = state
+        tokens = min(float(burst), tokens + (now - last_refill) * rate)
+    return [tokens - 1, now]
+
+
+class RateLimiter(object):
+
+    def __init__(self, store, tenant_rate=0, tenant_burst=1,
+                 family_rates=None, family_burst=1):
+        self.store = store
+        self.tenant_rate = tenant_rate
+        self.tenant_burst = tenant_burst
+        self.family_rates = family_rates or {}
+        self.family_burst = family_burst
+
+    def _reserve(self, key, rate, burst, now):
+        tokens, last_refill = self.store.update(
+            key, lambda state: _take_token(state, now, rate, burst))
+        if tokens >= 0:
+            return 0.0
+        return -tokens / rate
+
+    def acquire(self, tenant, family):
+        """Block until a request for tenant on family may be made.
+
+        Returns the number of seconds spent waiting.
+        """
+        now = time.time()
+        wait = 0.0
+        if self.tenant_rate > 0:
+            wait = max(wait, self._reserve('tenant:%s' % tenant,
+                                           self.tenant_rate,
+                                           self.tenant_burst, now))
+
+        family_rate = self.family_rates.get(family, 0)
+        if family_rate > 0:
+            wait = max(wait, self._reserve('family:%s' % family,
+                                           family_rate,
+                                           self.family_burst, now))
+
+        metrics.timing('nova.rate_limit.wait', wait)
+        metrics.timing('nova.rate_limit.wait.%s' % family, wait)
+        if wait > 0:
+            LOG.debug(_('Throttling Nova %(family)s request for tenant '
+                        '%(tenant)s for %(wait).3f seconds')
+                      % {'family': family, 'tenant': tenant, 'wait': wait})
+            time.sleep(wait)
+        return wait
+
+
+class _RateLimitedManager(object):
+
+    def __init__(self, manager, name, limiter, tenant):
+        self._manager = manager
+        self._name = name
+        self._limiter = limiter
+        self._tenant = tenant
+
+    def __getattr__(self, attr):
+        value = getattr(self._manager, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        family = _API_FAMILIES.get((self._name, attr), self._name)
+
+        def throttled(*args, **kwargs):
+            self._limiter.acquire(self._tenant, family)
+            return value(*args, **kwargs)
+        return throttled
+
+
+class RateLimitedNovaClient(object):
+    """Wraps a Nova client so its API calls go through a RateLimiter."""
+
+    def __init__(self, client, limiter, tenant):
+        self._client = client
+        self._limiter = limiter
+        self._tenant = tenant
+
+    def __getattr__(self, attr):
+        value = getattr(self._client, attr)
+        if attr in _LIMITED_MANAGERS:
+            return _RateLimitedManager(value, attr, self._limiter,
+                                       self._tenant)
+        return value
+
+
+def create_rate_limiter():
+    """Build the RateLimiter described by the configuration.
+
+    Must be called before the worker forks so the children share the
+    buckets. Returns None when rate limiting is disabled.
+    """
+    if not CONF.nova_rate_limit.enabled:
+        return None
+
+    conf = CONF.nova_rate_limit
+    family_rates = {}
+    for family, rate in conf.api_family_requests_per_sec.iteritems():
+        family_rates[family] = float(rate)
+
+    store = state_store.create_state_store(
+        conf.shared_state_dir,
+        shared=CONF.worker.max_child_processes > 0,
+        prefix='qonos-nova-rate-limit-')
+    return RateLimiter(store,
+                       tenant_rate=conf.tenant_requests_per_sec,
+                       tenant_burst=conf.tenant_burst,
+                       family_rates=family_rates,
+                       family_burst=conf.api_family_burst)
@@ -20,6 +20,7 @@ from oslo.config import cfg
 import rax_scheduled_images_python_novaclient_ext
 
 import qonos.openstack.common.log as logging
+from qonos.worker.snapshot import rate_limiter
 
 
 LOG = logging.getLogger(__name__)
@@ -46,6 +47,7 @@ class NovaClientFactory(object):
     def __init__(self):
         self.nova_client = None
         self.current_job_id = None
+        self.rate_limiter = rate_limiter.create_rate_limiter()
 
     def get_nova_client(self, job):
         if(self.nova_client is not None and
@@ -80,6 +82,9 @@ class NovaClientFactory(object):
                                          insecure=insecure,
                                          extensions=[sched_image_ext],
                                          http_log_debug=debug)
+        if self.rate_limiter is not None:
+            self.nova_client = rate_limiter.RateLimitedNovaClient(
+                self.nova_client, self.rate_limiter, tenant)
         self.current_job_id = job['id']
 
         return self.nova_client
@@ -26,11 +26,14 @@ from novaclient import exceptions
 from oslo.config import cfg
 
 from qonos.common import exception as exc
+from qonos.common import state_store
 from qonos.common import timeutils
 from qonos.openstack.common.gettextutils import _
 from qonos.openstack.common import importutils
 import qonos.openstack.common.log as logging
 import qonos.qonosclient.exception as qonos_ex
+from qonos.worker.snapshot import duration_history
+from qonos.worker.snapshot import nova_cache
 from qonos.worker import worker
 
 
@@ -42,6 +45,22 @@ snapshot_worker_opts = [
                        'NovaClientFactory'),
     cfg.IntOpt('image_poll_interval_sec', default=30,
                help=_('How often to poll Nova for the image status')),
+    cfg.BoolOpt('adaptive_image_poll', default=True,
+                help=_('Pace image status polls using the durations of '
+                       'previous snapshots of the instance or flavor')),
+    cfg.IntOpt('image_poll_min_interval_sec', default=10,
+               help=_('Shortest wait between adaptive image status polls, '
+                      'in seconds')),
+    cfg.IntOpt('image_poll_max_interval_sec', default=150,
+               help=_('Longest wait between adaptive image status polls, '
+                      'in seconds. Never more than half of '
+                      'job_timeout_extension_threshold_sec')),
+    cfg.FloatOpt('snapshot_history_smoothing', default=0.3,
+                 help=_('Weight of the newest duration in the moving '
+                        'average of snapshot durations')),
+    cfg.StrOpt('snapshot_history_dir', default=None,
+               help=_('Directory in which snapshot durations are kept. When '
+                      'unset the history only lasts as long as the worker')),
     cfg.IntOpt('job_update_interval_sec', default=300,
                help=_('How often to update the job status, in seconds')),
     cfg.IntOpt('job_timeout_initial_value_sec', default=3600,
@@ -67,6 +86,7 @@ snapshot_worker_opts = [
 
 CONF = cfg.CONF
 CONF.register_opts(snapshot_worker_opts, group='snapshot_worker')
+CONF.import_opt('max_child_processes', 'qonos.worker.worker', group='worker')
 
 _FAILED_IMAGE_STATUSES = ['KILLED', 'DELETED', 'PENDING_DELETE', 'ERROR']
 
@@ -78,6 +98,7 @@ class SnapshotProcessor(worker.JobProcessor):
     def __init__(self):
         super(SnapshotProcessor, self).__init__()
         self.current_job = None
+        self.flavor_id = None
 
     def init_processor(self, worker, nova_client_factory=None):
         super(SnapshotProcessor, self).init_processor(worker)
@@ -95,6 +116,22 @@ class SnapshotProcessor(worker.JobProcessor):
         self.initial_timeout = datetime.timedelta(
             seconds=CONF.snapshot_worker.job_timeout_initial_value_sec)
         self.image_poll_interval = CONF.snapshot_worker.image_poll_interval_sec
+        self.image_poll_min_interval = (CONF.snapshot_worker
+                                        .image_poll_min_interval_sec)
+        # NOTE: Keep the wait short enough that _update_job still gets a
+        # chance to extend the timeout before it is reached.
+        self.image_poll_max_interval = min(
+            CONF.snapshot_worker.image_poll_max_interval_sec,
+            CONF.snapshot_worker.job_timeout_extension_threshold_sec / 2)
+        self.duration_history = None
+        if CONF.snapshot_worker.adaptive_image_poll:
+            store = state_store.create_state_store(
+                CONF.snapshot_worker.snapshot_history_dir,
+                shared=CONF.worker.max_child_processes > 0,
+                prefix='qonos-snapshot-history-')
+            self.duration_history = duration_history.DurationHistory(
+                store, CONF.snapshot_worker.snapshot_history_smoothing)
+        self.nova_cache = nova_cache.create_nova_cache()
         self.timeout_backoff_increment = datetime.timedelta(
             seconds=CONF.snapshot_worker.job_timeout_backoff_increment_sec)
         self.timeout_backoff_factor = (CONF.snapshot_worker
@@ -183,12 +220,17 @@ class SnapshotProcessor(worker.JobProcessor):
             self._job_cancelled(job, msg)
             return
 
+        self.flavor_id = None
+        image_started = time.time()
+        created_image = False
         image_id = self._get_image_id(job)
         if image_id is None:
             image_id = self._create_image(job, instance_id,
                                           schedule)
             if image_id is None:
                 return
+            image_started = time.time()
+            created_image = True
         else:
             LOG.info(_("[%(worker_tag)s] Resuming image: %(image_id)s")
                      % {'worker_tag': self.get_worker_tag(),
@@ -208,9 +250,15 @@ class SnapshotProcessor(worker.JobProcessor):
                 except exc.OutOfTimeException:
                     retry = False
                 else:
-                    time.sleep(self.image_poll_interval)
+                    time.sleep(self._get_image_poll_interval(
+                        instance_id, time.time() - image_started))
 
         if active:
+            # NOTE: The start of a resumed image is unknown, so only
+            # snapshots created by this run are added to the history.
+            if created_image and self.duration_history is not None:
+                self.duration_history.record(time.time() - image_started,
+                                             instance_id, self.flavor_id)
             self._process_retention(instance_id,
                                     self.current_job['schedule_id'])
             self._job_succeeded(self.current_job)
@@ -269,14 +317,16 @@ class SnapshotProcessor(worker.JobProcessor):
         metadata = {
             "org.openstack__1__created_by": "scheduled_images_service"}
 
+        server = None
         try:
             instance_name_msg = ("[%(worker_tag)s] Getting instance name for "
                                  "instance_id %(instance_id)s"
                                  % {'worker_tag': self.get_worker_tag(),
                                     'instance_id': instance_id})
             LOG.info(instance_name_msg)
-            server_name = self._get_nova_client().servers.\
-                get(instance_id).name
+            server = self._get_server(instance_id)
+            server_name = server['name']
+            self.flavor_id = server['flavor_id']
             msg = ("[%(worker_tag)s] Creating image for instance %(instance)s"
                    % {'worker_tag': self.get_worker_tag(),
                       'instance': server_name})
@@ -286,6 +336,10 @@ class SnapshotProcessor(worker.JobProcessor):
                 self.generate_image_name(schedule, server_name),
                 metadata)
         except exceptions.NotFound:
+            # NOTE: A server found, maybe in the cache, is gone; a NotFound
+            # of the lookup itself is left cached.
+            if server is not None and self.nova_cache is not None:
+                self.nova_cache.invalidate('server', instance_id)
             msg = ('Instance %(instance_id)s specified by job %(job_id)s '
                    'was not found.' %
                    {'instance_id': instance_id, 'job_id': job['id']})
@@ -300,6 +354,17 @@ class SnapshotProcessor(worker.JobProcessor):
         self._add_job_metadata(image_id=image_id)
         return image_id
 
+    def _get_server(self, instance_id):
+        def load():
+            server = self._get_nova_client().servers.get(instance_id)
+            flavor = getattr(server, 'flavor', None)
+            flavor_id = flavor.get('id') if isinstance(flavor, dict) else None
+            return {'name': server.name, 'flavor_id': flavor_id}
+
+        if self.nova_cache is None:
+            return load()
+        return self.nova_cache.get('server', instance_id, load)
+
     def generate_image_name(self, schedule, server_name):
         """
         Creates a string based on the specified server name and current time.
@@ -357,6 +422,16 @@ class SnapshotProcessor(worker.JobProcessor):
             raise exc.PollingException(err_msg)
         return image_status
 
+    def _get_image_poll_interval(self, instance_id, elapsed):
+        if self.duration_history is None:
+            return self.image_poll_interval
+
+        expected = self.duration_history.expected_duration(instance_id,
+                                                           self.flavor_id)
+        return duration_history.next_poll_interval(
+            elapsed, expected, self.image_poll_interval,
+            self.image_poll_min_interval, self.image_poll_max_interval)
+
     def _process_retention(self, instance_id, schedule_id):
         LOG.debug(_("Processing retention."))
         retention = self._get_retention(instance_id)
@@ -391,10 +466,17 @@ class SnapshotProcessor(worker.JobProcessor):
     def _get_retention(self, instance_id):
         ret_str = None
         retention = 0
+
+        def load():
+            return self._get_nova_client().\
+                rax_scheduled_images_python_novaclient_ext.get(
+                    instance_id).retention
+
         try:
-            result = self._get_nova_client().\
-                rax_scheduled_images_python_novaclient_ext.get(instance_id)
-            ret_str = result.retention
+            if self.nova_cache is None:
+                ret_str = load()
+            else:
+                ret_str = self.nova_cache.get('retention', instance_id, load)
             retention = int(ret_str or 0)
         except exceptions.NotFound:
             msg = (_('[%(worker_tag)s] Could not retrieve retention for '
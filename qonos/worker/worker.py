@@ -21,6 +21,7 @@ import time
 
 from oslo.config import cfg
 
+from qonos.common import metrics
 from qonos.common import utils
 from qonos.openstack.common.gettextutils import _
 from qonos.openstack.common import importutils
@@ -190,6 +191,7 @@ class WorkerBase(object):
         self._on_shutdown()
         self._unregister_worker()
         self.processor.cleanup_processor()
+        metrics.log_stats(LOG)
 
     def _register_worker(self):
         LOG.info(_('[%(worker_tag)s] Registering worker with pid %(pid)s')
@@ -389,6 +391,8 @@ class MultiChildWorker(WorkerBase):
         """This is the entry point of the newly spawned child process."""
 
         self._process_job(job)
+        metrics.log_stats(LOG)
+        utils.flush_notifications()
 
         # os._exit() is the way to exit from childs after a fork(), in
         # constrast to the regular sys.exit()